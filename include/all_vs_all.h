@@ -0,0 +1,146 @@
+#ifndef ALL_VS_ALL_H
+#define ALL_VS_ALL_H
+
+#include "intern.h"
+
+/* All-vs-all mode, scores every pair of input sequences into an N x N int32 matrix
+ * Only distinct sequences are aligned, into the cells of their first rows, which repeated rows copy afterwards
+ * The pair space is cut into square tiles of TILE_SEQS sequences per side so both blocks of a tile
+ * stay in L1/L2, threads pull upper triangle tiles from a shared counter and mirror the results */
+
+#define MATRIX_MAGIC "SEQALNMX"
+#define TILE_SEQS (MAX_SEQ_LEN >= 512 ? 16 : MAX_SEQ_LEN <= 64 ? 128 : 8192 / MAX_SEQ_LEN)
+#define FAN_OUT_ROWS (64)
+
+// Output file layout, followed by count * count native endian int32 scores in row major order
+typedef struct {
+    char magic[8];
+    uint64_t count;
+    uint32_t element_size;
+    uint32_t reserved;
+    char padding[40];
+} MatrixHeader;
+
+typedef struct {
+    SequenceTable seqs;    // tiles cover the distinct sequences
+    int* scores;    // NULL when not writing, tiles are scored into a per thread buffer instead
+    size_t rows;    // input rows, the matrix is rows x rows
+    size_t* source;    // first row with the sequence of every row
+    const ScoringMatrix* scoring;
+    size_t blocks;
+    size_t num_tiles;
+    size_t next_tile;
+    size_t next_rows;
+} AllVsAll;
+
+// Tiles are numbered row by row over the upper triangle of blocks, so consecutive tiles share their first block
+INLINE void tile_blocks(const AllVsAll* ctx, size_t tile, size_t* block1, size_t* block2) {
+    size_t row = 0;
+    while (tile >= ctx->blocks - row) {
+        tile -= ctx->blocks - row;
+        row++;
+    }
+    *block1 = row;
+    *block2 = row + tile;
+}
+
+INLINE void all_vs_all_job(ThreadWork* work, void* arg) {
+    AllVsAll* ctx = (AllVsAll*)arg;
+    AlignTask* tasks = (AlignTask*)malloc(sizeof(AlignTask) * TILE_SEQS * TILE_SEQS);
+    int* tile_scores = ctx->scores ? NULL : (int*)malloc(sizeof(int) * TILE_SEQS * TILE_SEQS);
+    const size_t count = ctx->seqs.seqs.count;
+    const size_t* first_row = ctx->seqs.first_row;
+    const size_t rows = ctx->rows;
+
+    size_t tile;
+    while ((tile = __atomic_fetch_add(&ctx->next_tile, 1, __ATOMIC_RELAXED)) < ctx->num_tiles) {
+        size_t block1, block2;
+        tile_blocks(ctx, tile, &block1, &block2);
+        const size_t lo1 = block1 * TILE_SEQS, hi1 = lo1 + TILE_SEQS < count ? lo1 + TILE_SEQS : count;
+        const size_t lo2 = block2 * TILE_SEQS, hi2 = lo2 + TILE_SEQS < count ? lo2 + TILE_SEQS : count;
+
+        size_t n = 0;
+        for (size_t i = lo1; i < hi1; i++) {
+            for (size_t j = (lo2 > i ? lo2 : i); j < hi2; j++, n++) {
+                tasks[n] = interned_task(&ctx->seqs, i, &ctx->seqs, j, ctx->scoring);
+                tasks[n].score = ctx->scores ? &ctx->scores[first_row[i] * rows + first_row[j]] : &tile_scores[n];
+            }
+        }
+        align_tasks(&work->lanes, tasks, 0, n, true);
+
+        if (ctx->scores) {
+            for (size_t i = lo1; i < hi1; i++) {
+                for (size_t j = (lo2 > i + 1 ? lo2 : i + 1); j < hi2; j++) {
+                    ctx->scores[first_row[j] * rows + first_row[i]] = ctx->scores[first_row[i] * rows + first_row[j]];
+                }
+            }
+        }
+    }
+
+    free(tasks);
+    free(tile_scores);
+}
+
+// Repeated rows copy the row of the first appearance of their sequence, at the columns of the first appearances
+INLINE void fan_out_job(ThreadWork* work, void* arg) {
+    (void)work;
+    AllVsAll* ctx = (AllVsAll*)arg;
+    const size_t rows = ctx->rows;
+    const size_t* source = ctx->source;
+    int* scores = ctx->scores;
+
+    size_t lo;
+    while ((lo = __atomic_fetch_add(&ctx->next_rows, FAN_OUT_ROWS, __ATOMIC_RELAXED)) < rows) {
+        const size_t hi = lo + FAN_OUT_ROWS < rows ? lo + FAN_OUT_ROWS : rows;
+        for (size_t i = lo; i < hi; i++) {
+            const int* from = scores + source[i] * rows;
+            int* to = scores + i * rows;
+            // Cells of first appearances in a first appearance row are the ones other rows read
+            const bool first = source[i] == i;
+            for (size_t j = 0; j < rows; j++) {
+                if (!first || source[j] != j) to[j] = from[source[j]];
+            }
+        }
+    }
+}
+
+INLINE void align_all_vs_all(char* current, char* end, const ScoringMatrix* scoring) {
+    AllVsAll ctx = {0};
+    ctx.scoring = scoring;
+    intern_init(&ctx.seqs, scoring);
+    intern_rows(&ctx.seqs, current, end);
+    const size_t count = ctx.seqs.rows;
+    const size_t distinct = ctx.seqs.seqs.count;
+    ctx.rows = count;
+    ctx.blocks = (distinct + TILE_SEQS - 1) / TILE_SEQS;
+    ctx.num_tiles = ctx.blocks * (ctx.blocks + 1) / 2;
+
+    MappedFile output = {0};
+    if (g_config.write) {
+        output = map_output_file(g_config.output_file, sizeof(MatrixHeader) + sizeof(int32_t) * count * count);
+        MatrixHeader header = {.count = count, .element_size = sizeof(int32_t)};
+        memcpy(header.magic, MATRIX_MAGIC, sizeof(header.magic));
+        memcpy(output.data, &header, sizeof(header));
+        ctx.scores = (int*)(output.data + sizeof(MatrixHeader));
+    }
+
+    const bool fan_out = ctx.scores && distinct < count;
+    if (fan_out) {
+        ctx.source = (size_t*)malloc(sizeof(size_t) * count);
+        for (size_t i = 0; i < count; i++) ctx.source[i] = ctx.seqs.first_row[ctx.seqs.ids[i]];
+    }
+
+    if (g_config.multithread) {
+        run_job(all_vs_all_job, &ctx);
+        if (fan_out) run_job(fan_out_job, &ctx);
+    } else {
+        run_job_here(all_vs_all_job, &ctx);
+        if (fan_out) run_job_here(fan_out_job, &ctx);
+    }
+
+    if (g_config.write) unmap_output_file(&output);
+    free(ctx.source);
+    intern_free(&ctx.seqs);
+}
+
+#endif
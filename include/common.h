@@ -4,40 +4,60 @@
 #include "user.h"
 #include "macros.h"
 
-#ifdef MODE_TUNE
-#undef MODE_WRITE
-#define MODE_WRITE 0
-#endif
-
-#define BLOSUM_SIZE (20)
+#define MAX_ALPHABET (32)    // residues of the largest substitution matrix, NCBI protein matrices have 24
 #define ALIGN_BUF (MAX_SEQ_LEN * 2)
 
+typedef enum {
+    ALIGN_GLOBAL,       // Needleman-Wunsch, both sequences end to end
+    ALIGN_LOCAL,        // Smith-Waterman, the best scoring pair of substrings
+    ALIGN_SEMIGLOBAL    // end to end with free leading and trailing gaps
+} AlignMode;
+
+#define NO_THRESHOLD (INT_MIN)
+#define SCORE_DISCARDED (INT_MIN)    // score only result of a pair that stopped early below the threshold
+
 typedef struct {
-    int matrix[BLOSUM_SIZE][BLOSUM_SIZE];
+    int matrix[MAX_ALPHABET][MAX_ALPHABET];    // zero past size
+    char alphabet[MAX_ALPHABET + 1];
+    int size;
+    int8_t lookup[UCHAR_MAX + 1];    // residue index of every character, -1 for the ones not in the alphabet
+    int columns[MAX_ALPHABET][MAX_ALPHABET + 1];    // column c of matrix behind a 0 for index -1
+    int gap_penalty;
+    int gap_open;      // first residue of an affine gap
+    int gap_extend;    // every further residue
+    bool affine;
+    AlignMode mode;
+    int threshold;     // pairs scoring below it are not needed, NO_THRESHOLD to keep every pair
+    int min_score;
+    int max_score;
 } ScoringMatrix;
 
+// Kinds of alignment columns, two bits each
+typedef enum {
+    OP_MATCH,       // same residue in both
+    OP_MISMATCH,
+    OP_INSERT,      // residue of seq2 against a gap in seq1
+    OP_DELETE       // residue of seq1 against a gap in seq2
+} AlignOp;
+
+#define ALIGN_OPS ((ALIGN_BUF + 3) / 4)
+
+// The gapped strings are rendered from ops and the two sequences only when an output needs them
 typedef struct {
-    char seq1_aligned[ALIGN_BUF];
-    char seq2_aligned[ALIGN_BUF];
+    uint8_t ops[ALIGN_OPS];    // column k in bits 2 * (k % 4) of byte k / 4
+    int length;                // columns
+    int start1;                // local alignments start this far into seq1
+    int start2;
     int score;
-    #if SIMILARITY_ANALYSIS == 1
     int matches;
     int mismatches;
     int gaps;
     double similarity;
-    #endif
 } Alignment;
 
-typedef struct {
-    #ifdef _WIN32
-    HANDLE handle;
-    DWORD bytes_written;
-    #else
-    int fd;
-    #endif
-    char buffer[WRITE_BUF];
-    size_t pos;
-} WriteBuffer;
+INLINE AlignOp get_op(const Alignment* restrict result, const int k) {
+    return (AlignOp)((result->ops[k >> 2] >> ((k & 3) * 2)) & 3);
+}
 
 INLINE void* mat_aligned_alloc(size_t alignment, size_t size) {
 #ifdef _WIN32
@@ -49,6 +69,33 @@ INLINE void* mat_aligned_alloc(size_t alignment, size_t size) {
 #endif
 }
 
+#define SMALL_PAGE (4 * KiB)
+#define HUGE_PAGE (2 * MiB)
+
+// Large buffers that live for the whole run, backed by transparent huge pages where the system has them
+INLINE void* arena_alloc(size_t size) {
+#ifdef _WIN32
+    return VirtualAlloc(NULL, size, MEM_COMMIT | MEM_RESERVE, PAGE_READWRITE);
+#else
+    size = (size + HUGE_PAGE - 1) & ~(size_t)(HUGE_PAGE - 1);
+    void* ptr = mmap(NULL, size, PROT_READ | PROT_WRITE, MAP_PRIVATE | MAP_ANONYMOUS, -1, 0);
+    if (ptr == MAP_FAILED) return NULL;
+    #ifdef MADV_HUGEPAGE
+    madvise(ptr, size, MADV_HUGEPAGE);
+    #endif
+    return ptr;
+#endif
+}
+
+INLINE void arena_free(void* ptr, size_t size) {
+#ifdef _WIN32
+    (void)size;
+    VirtualFree(ptr, 0, MEM_RELEASE);
+#else
+    munmap(ptr, (size + HUGE_PAGE - 1) & ~(size_t)(HUGE_PAGE - 1));
+#endif
+}
+
 INLINE double get_time(void) {
 #ifdef _WIN32
     static double freq_inv = 0.0;
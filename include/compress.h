@@ -0,0 +1,282 @@
+#ifndef COMPRESS_H
+#define COMPRESS_H
+
+#include "config.h"
+
+#ifdef USE_ZLIB
+#include <zlib.h>
+#endif
+#ifdef USE_ZSTD
+#include <zstd.h>
+#endif
+
+/* gzip and zstd inputs and outputs, compiled in when the Makefile finds zlib.h and zstd.h
+ * Compressed inputs are recognised by their first bytes and streamed like stdin, decompressing on the reader thread
+ * An OUTPUT_FILE ending in .gz or .zst compresses every write buffer on its own thread into a separate gzip member
+ * or zstd frame, gunzip and zstd -d read the concatenation as one file */
+
+#define RAW_CHUNK (1 * MiB)    // compressed bytes read at a time
+#define GZIP_LEVEL (1)    // output is usually written faster than it compresses, so the fast levels
+#define ZSTD_LEVEL (3)
+
+typedef enum {
+    CODEC_NONE,
+    CODEC_GZIP,
+    CODEC_ZSTD
+} Codec;
+
+INLINE Codec detect_codec(const unsigned char* data, const size_t size) {
+    if (size >= 2 && data[0] == 0x1F && data[1] == 0x8B) return CODEC_GZIP;
+    if (size >= 4 && data[0] == 0x28 && data[1] == 0xB5 && data[2] == 0x2F && data[3] == 0xFD) return CODEC_ZSTD;
+    return CODEC_NONE;
+}
+
+INLINE bool has_suffix(const char* path, const char* suffix) {
+    const size_t len = strlen(path), suffix_len = strlen(suffix);
+    return len >= suffix_len && !strcmp(path + len - suffix_len, suffix);
+}
+
+INLINE Codec output_codec(void) {
+    if (has_suffix(g_config.output_file, ".gz")) return CODEC_GZIP;
+    if (has_suffix(g_config.output_file, ".zst")) return CODEC_ZSTD;
+    return CODEC_NONE;
+}
+
+// Codec of a file from its first bytes, files that cannot be read fail once they are opened
+INLINE Codec file_codec(const char* path) {
+    unsigned char magic[4];
+    FILE* file = fopen(path, "rb");
+    if (!file) return CODEC_NONE;
+    const size_t size = fread(magic, 1, sizeof(magic), file);
+    fclose(file);
+    return detect_codec(magic, size);
+}
+
+// Stops with an error for codecs the build was compiled without
+INLINE void require_codec(const Codec codec, const char* path) {
+    #ifndef USE_ZLIB
+    if (codec == CODEC_GZIP) config_error("gzip needs a build with zlib installed, ", path);
+    #endif
+    #ifndef USE_ZSTD
+    if (codec == CODEC_ZSTD) config_error("zstd needs a build with libzstd installed, ", path);
+    #endif
+    (void)codec, (void)path;
+}
+
+// Input read through the codec its first bytes name, stdin or a file
+typedef struct {
+    Codec codec;
+    #ifdef _WIN32
+    HANDLE handle;
+    #else
+    int fd;
+    #endif
+    unsigned char* raw;    // bytes read but not decoded yet
+    size_t raw_pos;
+    size_t raw_size;
+    bool raw_eof;
+    bool in_frame;    // a gzip member or zstd frame was started and not finished
+    #ifdef USE_ZLIB
+    z_stream zs;
+    #endif
+    #ifdef USE_ZSTD
+    ZSTD_DCtx* zd;
+    #endif
+} Decoder;
+
+// One read of at most size bytes, 0 once the input ends
+INLINE size_t read_raw(Decoder* d, void* buffer, const size_t size) {
+    for (;;) {
+        #ifdef _WIN32
+        DWORD got = 0;
+        if (!ReadFile(d->handle, buffer, size > MiB ? (DWORD)MiB : (DWORD)size, &got, NULL) &&
+            GetLastError() != ERROR_BROKEN_PIPE) {
+            config_error("Cannot read input ", g_config.input_file);
+        }
+        #else
+        ssize_t got = read(d->fd, buffer, size);
+        if (got < 0 && errno == EINTR) continue;
+        if (got < 0) config_error("Cannot read input ", g_config.input_file);
+        #endif
+        return got;
+    }
+}
+
+INLINE void fill_raw(Decoder* d) {
+    if (d->raw_pos < d->raw_size || d->raw_eof) return;
+    d->raw_pos = 0;
+    d->raw_size = read_raw(d, d->raw, RAW_CHUNK);
+    d->raw_eof = !d->raw_size;
+}
+
+// Reads the first bytes of stdin (path NULL) or the file to tell the codec
+INLINE void open_decoder(Decoder* d, const char* path) {
+    memset(d, 0, sizeof(*d));
+    #ifdef _WIN32
+    d->handle = path ? CreateFileA(path, GENERIC_READ, FILE_SHARE_READ, NULL, OPEN_EXISTING, FILE_FLAG_SEQUENTIAL_SCAN, NULL)
+                     : GetStdHandle(STD_INPUT_HANDLE);
+    if (d->handle == INVALID_HANDLE_VALUE) config_error("Cannot open input file ", path);
+    #else
+    d->fd = path ? open(path, O_RDONLY) : STDIN_FILENO;
+    if (d->fd < 0) config_error("Cannot open input file ", path);
+    #endif
+    d->raw = (unsigned char*)malloc(RAW_CHUNK);
+    memset(d->raw, 0, 4);    // inputs shorter than the magic numbers compare against zeros
+
+    // A pipe may hand out fewer bytes than the magic numbers take
+    while (d->raw_size < 4 && !d->raw_eof) {
+        const size_t got = read_raw(d, d->raw + d->raw_size, RAW_CHUNK - d->raw_size);
+        d->raw_size += got;
+        d->raw_eof = !got;
+    }
+    d->codec = detect_codec(d->raw, d->raw_size);
+    require_codec(d->codec, path ? path : "stdin");
+
+    #ifdef USE_ZLIB
+    // 32 on top of the window bits reads both gzip and zlib headers
+    if (d->codec == CODEC_GZIP && inflateInit2(&d->zs, 15 + 32) != Z_OK) config_error("Cannot start gzip decoder", "");
+    #endif
+    #ifdef USE_ZSTD
+    if (d->codec == CODEC_ZSTD && !(d->zd = ZSTD_createDCtx())) config_error("Cannot start zstd decoder", "");
+    #endif
+}
+
+INLINE void close_decoder(Decoder* d) {
+    #ifdef USE_ZLIB
+    if (d->codec == CODEC_GZIP) inflateEnd(&d->zs);
+    #endif
+    #ifdef USE_ZSTD
+    if (d->codec == CODEC_ZSTD) ZSTD_freeDCtx(d->zd);
+    #endif
+    #ifdef _WIN32
+    if (d->handle != GetStdHandle(STD_INPUT_HANDLE)) CloseHandle(d->handle);
+    #else
+    if (d->fd != STDIN_FILENO) close(d->fd);
+    #endif
+    free(d->raw);
+}
+
+// Decodes up to size bytes of the next gzip members or zstd frames, 0 once the input ends
+INLINE size_t decode_chunk(Decoder* d, char* out, const size_t size) {
+    #ifdef USE_ZLIB
+    if (d->codec == CODEC_GZIP) {
+        d->zs.next_out = (Bytef*)out;
+        d->zs.avail_out = (uInt)size;
+        d->zs.next_in = d->raw + d->raw_pos;
+        d->zs.avail_in = (uInt)(d->raw_size - d->raw_pos);
+        const int ret = inflate(&d->zs, Z_NO_FLUSH);
+        if (ret != Z_OK && ret != Z_STREAM_END && ret != Z_BUF_ERROR) config_error("Corrupt gzip input ", g_config.input_file);
+        const size_t consumed = d->raw_size - d->raw_pos - d->zs.avail_in;
+        if (ret == Z_STREAM_END) inflateReset(&d->zs);    // concatenated members, as written by the CSV output
+        if (consumed || ret == Z_STREAM_END) d->in_frame = ret != Z_STREAM_END;
+        d->raw_pos += consumed;
+        return size - d->zs.avail_out;
+    }
+    #endif
+    #ifdef USE_ZSTD
+    if (d->codec == CODEC_ZSTD) {
+        ZSTD_inBuffer in = {d->raw, d->raw_size, d->raw_pos};
+        ZSTD_outBuffer to = {out, size, 0};
+        const size_t ret = ZSTD_decompressStream(d->zd, &to, &in);
+        if (ZSTD_isError(ret)) config_error("Corrupt zstd input ", g_config.input_file);
+        if (in.pos > d->raw_pos || to.pos) d->in_frame = ret != 0;
+        d->raw_pos = in.pos;
+        return to.pos;
+    }
+    #endif
+    const size_t n = d->raw_size - d->raw_pos < size ? d->raw_size - d->raw_pos : size;
+    memcpy(out, d->raw + d->raw_pos, n);
+    d->raw_pos += n;
+    return n;
+}
+
+INLINE size_t decode(Decoder* d, char* out, const size_t size) {
+    if (d->codec == CODEC_NONE && d->raw_pos == d->raw_size) return d->raw_eof ? 0 : read_raw(d, out, size);
+    for (;;) {
+        fill_raw(d);
+        const bool raw_left = d->raw_pos < d->raw_size;
+        const size_t got = decode_chunk(d, out, size);
+        if (got) return got;
+        if (!raw_left && d->raw_eof) {
+            if (d->in_frame) config_error("Compressed input ends early ", g_config.input_file);
+            return 0;
+        }
+    }
+}
+
+// One compressor per write buffer, each block becomes a gzip member or zstd frame of its own
+typedef struct {
+    Codec codec;
+    #ifdef USE_ZLIB
+    z_stream zs;
+    #endif
+    #ifdef USE_ZSTD
+    ZSTD_CCtx* zc;
+    #endif
+} Encoder;
+
+INLINE void open_encoder(Encoder* e, const Codec codec) {
+    memset(e, 0, sizeof(*e));
+    e->codec = codec;
+    #ifdef USE_ZLIB
+    // 16 on top of the window bits writes a gzip header and trailer
+    if (codec == CODEC_GZIP && deflateInit2(&e->zs, GZIP_LEVEL, Z_DEFLATED, 15 + 16, 8, Z_DEFAULT_STRATEGY) != Z_OK) {
+        config_error("Cannot start gzip encoder", "");
+    }
+    #endif
+    #ifdef USE_ZSTD
+    if (codec == CODEC_ZSTD) {
+        e->zc = ZSTD_createCCtx();
+        if (!e->zc) config_error("Cannot start zstd encoder", "");
+        ZSTD_CCtx_setParameter(e->zc, ZSTD_c_compressionLevel, ZSTD_LEVEL);
+    }
+    #endif
+}
+
+INLINE void close_encoder(Encoder* e) {
+    #ifdef USE_ZLIB
+    if (e->codec == CODEC_GZIP) deflateEnd(&e->zs);
+    #endif
+    #ifdef USE_ZSTD
+    if (e->codec == CODEC_ZSTD) ZSTD_freeCCtx(e->zc);
+    #endif
+    (void)e;
+}
+
+// Largest block size blocks of size bytes compress to
+INLINE size_t encode_bound(Encoder* e, const size_t size) {
+    #ifdef USE_ZLIB
+    if (e->codec == CODEC_GZIP) return deflateBound(&e->zs, size);
+    #endif
+    #ifdef USE_ZSTD
+    if (e->codec == CODEC_ZSTD) return ZSTD_compressBound(size);
+    #endif
+    (void)e;
+    return size;
+}
+
+// Compresses one block into out, which holds encode_bound bytes, and returns its compressed size
+INLINE size_t encode_block(Encoder* e, const char* data, const size_t size, char* out, const size_t capacity) {
+    #ifdef USE_ZLIB
+    if (e->codec == CODEC_GZIP) {
+        deflateReset(&e->zs);
+        e->zs.next_in = (Bytef*)data;
+        e->zs.avail_in = (uInt)size;
+        e->zs.next_out = (Bytef*)out;
+        e->zs.avail_out = (uInt)capacity;
+        if (deflate(&e->zs, Z_FINISH) != Z_STREAM_END) config_error("Cannot compress output ", g_config.output_file);
+        return capacity - e->zs.avail_out;
+    }
+    #endif
+    #ifdef USE_ZSTD
+    if (e->codec == CODEC_ZSTD) {
+        const size_t packed = ZSTD_compress2(e->zc, out, capacity, data, size);
+        if (ZSTD_isError(packed)) config_error("Cannot compress output ", g_config.output_file);
+        return packed;
+    }
+    #endif
+    (void)e, (void)data, (void)size, (void)out, (void)capacity;
+    return 0;
+}
+
+#endif
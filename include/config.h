@@ -0,0 +1,313 @@
+#ifndef CONFIG_H
+#define CONFIG_H
+
+#include "scoring.h"
+
+#define MAX_CSV_COLS (64)
+#define MAX_OPTION_LEN (MAX_CSV_LINE * 2)
+
+/* Runtime settings, defaults come from user.h
+ * Overridden by "--config FILE" (KEY=VALUE lines using the user.h names) and command line flags,
+ * applied in the order they appear */
+typedef struct {
+    char input_file[MAX_PATH];
+    char output_file[MAX_PATH];
+    char query_file[MAX_PATH];
+    char matrix_file[MAX_PATH];
+    char result_store_file[MAX_PATH];
+    int top_k;
+    int gap_penalty;
+    int affine;
+    int gap_open;
+    int gap_extend;
+    int local;
+    int semiglobal;
+    int threshold;
+    int score_threshold;
+    int batch_size;
+    int result_cache_mb;
+    int write_buffer_kb;
+    int write_buffers;
+    int write_drop_cache;
+    int multithread;
+    int similarity_analysis;
+    int write;
+    int all_vs_all;
+    int binary;
+    int read_seq_pos;
+    int read_cols;
+    char write_header[MAX_OPTION_LEN];
+    int write_seq1_pos;
+    int write_score_pos;
+    int write_align_pos;
+    int write_matches_pos;
+    int write_mismatches_pos;
+    int write_gaps_pos;
+    int write_similarity_pos;
+    char align_fmt[MAX_OPTION_LEN];
+    int align_cigar;
+} Config;
+
+static Config g_config = {
+    .input_file = "" INPUT_FILE,
+    .output_file = "" OUTPUT_FILE,
+    .query_file = "" QUERY_FILE,
+    .matrix_file = "" MATRIX_FILE,
+    .result_store_file = "" RESULT_STORE_FILE,
+    .top_k = TOP_K,
+    .gap_penalty = GAP_PENALTY,
+    .affine = MODE_AFFINE,
+    .gap_open = GAP_OPEN,
+    .gap_extend = GAP_EXTEND,
+    .local = MODE_LOCAL,
+    .semiglobal = MODE_SEMIGLOBAL,
+    .threshold = MODE_THRESHOLD,
+    .score_threshold = SCORE_THRESHOLD,
+    .batch_size = BATCH_SIZE,
+    .result_cache_mb = RESULT_CACHE_MB,
+    .write_buffer_kb = WRITE_BUFFER_KB,
+    .write_buffers = WRITE_BUFFERS,
+    .write_drop_cache = WRITE_DROP_CACHE,
+    .multithread = MODE_MULTITHREAD,
+    .similarity_analysis = SIMILARITY_ANALYSIS,
+    .write = MODE_WRITE,
+    .all_vs_all = MODE_ALL_VS_ALL,
+    .binary = MODE_BINARY,
+    .read_seq_pos = READ_CSV_SEQ_POS,
+    .read_cols = READ_CSV_COLS,
+    .write_header = WRITE_CSV_HEADER,
+    .write_seq1_pos = WRITE_CSV_SEQ1_POS,
+    .write_score_pos = WRITE_CSV_SCORE_POS,
+    .write_align_pos = WRITE_CSV_ALIGN_POS,
+    .write_matches_pos = WRITE_CSV_MATCHES_POS,
+    .write_mismatches_pos = WRITE_CSV_MISMATCHES_POS,
+    .write_gaps_pos = WRITE_CSV_GAPS_POS,
+    .write_similarity_pos = WRITE_CSV_SIMILARITY_POS,
+    .align_fmt = WRITE_CSV_ALIGN_FMT,
+    .align_cigar = WRITE_CSV_ALIGN_CIGAR,
+};
+
+typedef enum {
+    OPT_STR,
+    OPT_INT,
+    OPT_BOOL
+} OptionType;
+
+typedef struct {
+    const char* key;
+    const char* flag;
+    OptionType type;
+    size_t offset;
+    size_t size;
+} Option;
+
+#define OPTION(key, flag, type, field) {key, flag, type, offsetof(Config, field), sizeof(((Config*)0)->field)}
+
+static const Option OPTIONS[] = {
+    OPTION("INPUT_FILE", "--input", OPT_STR, input_file),
+    OPTION("OUTPUT_FILE", "--output", OPT_STR, output_file),
+    OPTION("QUERY_FILE", "--query", OPT_STR, query_file),
+    OPTION("TOP_K", "--top-k", OPT_INT, top_k),
+    OPTION("MATRIX_FILE", "--matrix", OPT_STR, matrix_file),
+    OPTION("GAP_PENALTY", "--gap-penalty", OPT_INT, gap_penalty),
+    OPTION("MODE_AFFINE", "--affine", OPT_BOOL, affine),
+    OPTION("GAP_OPEN", "--gap-open", OPT_INT, gap_open),
+    OPTION("GAP_EXTEND", "--gap-extend", OPT_INT, gap_extend),
+    OPTION("MODE_LOCAL", "--local", OPT_BOOL, local),
+    OPTION("MODE_SEMIGLOBAL", "--semiglobal", OPT_BOOL, semiglobal),
+    OPTION("MODE_THRESHOLD", "--threshold", OPT_BOOL, threshold),
+    OPTION("SCORE_THRESHOLD", "--score-threshold", OPT_INT, score_threshold),
+    OPTION("BATCH_SIZE", "--batch-size", OPT_INT, batch_size),
+    OPTION("RESULT_CACHE_MB", "--result-cache-mb", OPT_INT, result_cache_mb),
+    OPTION("RESULT_STORE_FILE", "--result-store", OPT_STR, result_store_file),
+    OPTION("WRITE_BUFFER_KB", "--write-buffer-kb", OPT_INT, write_buffer_kb),
+    OPTION("WRITE_BUFFERS", "--write-buffers", OPT_INT, write_buffers),
+    OPTION("WRITE_DROP_CACHE", "--write-drop-cache", OPT_BOOL, write_drop_cache),
+    OPTION("MODE_MULTITHREAD", "--multithread", OPT_BOOL, multithread),
+    OPTION("SIMILARITY_ANALYSIS", "--similarity", OPT_BOOL, similarity_analysis),
+    OPTION("MODE_WRITE", "--write", OPT_BOOL, write),
+    OPTION("MODE_ALL_VS_ALL", "--all-vs-all", OPT_BOOL, all_vs_all),
+    OPTION("MODE_BINARY", "--binary", OPT_BOOL, binary),
+    OPTION("READ_CSV_SEQ_POS", "--read-seq-pos", OPT_INT, read_seq_pos),
+    OPTION("READ_CSV_COLS", "--read-cols", OPT_INT, read_cols),
+    OPTION("WRITE_CSV_HEADER", "--write-header", OPT_STR, write_header),
+    OPTION("WRITE_CSV_SEQ1_POS", "--write-seq1-pos", OPT_INT, write_seq1_pos),
+    OPTION("WRITE_CSV_SCORE_POS", "--write-score-pos", OPT_INT, write_score_pos),
+    OPTION("WRITE_CSV_ALIGN_POS", "--write-align-pos", OPT_INT, write_align_pos),
+    OPTION("WRITE_CSV_MATCHES_POS", "--write-matches-pos", OPT_INT, write_matches_pos),
+    OPTION("WRITE_CSV_MISMATCHES_POS", "--write-mismatches-pos", OPT_INT, write_mismatches_pos),
+    OPTION("WRITE_CSV_GAPS_POS", "--write-gaps-pos", OPT_INT, write_gaps_pos),
+    OPTION("WRITE_CSV_SIMILARITY_POS", "--write-similarity-pos", OPT_INT, write_similarity_pos),
+    OPTION("WRITE_CSV_ALIGN_FMT", "--align-fmt", OPT_STR, align_fmt),
+    OPTION("WRITE_CSV_ALIGN_CIGAR", "--align-cigar", OPT_BOOL, align_cigar),
+};
+
+#define NUM_OPTIONS (sizeof(OPTIONS) / sizeof(OPTIONS[0]))
+
+INLINE void config_error(const char* message, const char* detail) {
+    fprintf(stderr, "Error: %s%s\n", message, detail);
+    exit(1);
+}
+
+INLINE void set_option(const Option* opt, const char* value) {
+    char* field = (char*)&g_config + opt->offset;
+    switch (opt->type) {
+        case OPT_STR: {
+            size_t len = strlen(value);
+            while (len && (value[len - 1] == '\n' || value[len - 1] == '\r')) len--;
+            if (len >= opt->size) config_error("Value too long for ", opt->key);
+            memcpy(field, value, len);
+            field[len] = '\0';
+            break;
+        }
+        case OPT_INT:
+        case OPT_BOOL: {
+            char* end;
+            long parsed = strtol(value, &end, 10);
+            while (*end == '\r' || *end == '\n' || *end == ' ') end++;
+            if (end == value || *end) config_error("Invalid numeric value for ", opt->key);
+            if (opt->type == OPT_BOOL) parsed = parsed != 0;
+            *(int*)field = (int)parsed;
+            break;
+        }
+    }
+}
+
+INLINE const Option* find_option(const char* name, bool is_flag) {
+    for (size_t i = 0; i < NUM_OPTIONS; i++) {
+        if (strcmp(name, is_flag ? OPTIONS[i].flag : OPTIONS[i].key) == 0) {
+            return &OPTIONS[i];
+        }
+    }
+    return NULL;
+}
+
+INLINE void load_config_file(const char* path) {
+    FILE* file = fopen(path, "r");
+    if (!file) config_error("Cannot open config file ", path);
+
+    char line[MAX_OPTION_LEN + MAX_PATH];
+    while (fgets(line, sizeof(line), file)) {
+        if (line[0] == '#' || line[0] == '\n' || line[0] == '\r') continue;
+        char* sep = strchr(line, '=');
+        if (!sep) config_error("Expected KEY=VALUE in config file, got ", line);
+        *sep = '\0';
+        const Option* opt = find_option(line, false);
+        if (!opt) config_error("Unknown config key ", line);
+        set_option(opt, sep + 1);
+    }
+
+    fclose(file);
+}
+
+INLINE void print_usage(const char* program) {
+    printf("Usage: %s [--config FILE] [OPTIONS]\n\nOptions (config file key in brackets):\n", program);
+    for (size_t i = 0; i < NUM_OPTIONS; i++) {
+        printf("  %-26s[%s]\n", OPTIONS[i].flag, OPTIONS[i].key);
+    }
+}
+
+INLINE void validate_config(void) {
+    if (!g_config.input_file[0]) config_error("No input file, use --input or set INPUT_FILE", "");
+    if (g_config.batch_size < 2) config_error("BATCH_SIZE must be at least 2", "");
+    if (g_config.read_cols < 1 || g_config.read_cols > MAX_CSV_COLS / 2 - 3) {
+        config_error("READ_CSV_COLS out of range", "");
+    }
+    if (g_config.read_seq_pos < 0 || g_config.read_seq_pos >= g_config.read_cols) {
+        config_error("READ_CSV_SEQ_POS must be a valid input column", "");
+    }
+    if (g_config.write && !g_config.output_file[0]) {
+        config_error("No output file, use --output or set OUTPUT_FILE", "");
+    }
+    if (g_config.query_file[0] && g_config.all_vs_all) {
+        config_error("QUERY_FILE and MODE_ALL_VS_ALL cannot be combined", "");
+    }
+    if (g_config.binary && (g_config.all_vs_all || g_config.query_file[0])) {
+        config_error("MODE_BINARY only applies to pairs of neighbouring rows", "");
+    }
+    if (g_config.top_k < 1) config_error("TOP_K must be at least 1", "");
+    if (!strcmp(g_config.output_file, "-") && g_config.write && (g_config.all_vs_all || g_config.binary)) {
+        config_error("MODE_ALL_VS_ALL and MODE_BINARY outputs are mapped, OUTPUT_FILE cannot be stdout (-)", "");
+    }
+    if (g_config.affine && (g_config.gap_extend >= 0 || g_config.gap_open > g_config.gap_extend)) {
+        config_error("GAP_EXTEND must be negative and GAP_OPEN at most GAP_EXTEND", "");
+    }
+    if (g_config.local && g_config.semiglobal) config_error("MODE_LOCAL and MODE_SEMIGLOBAL cannot be combined", "");
+    if (g_config.threshold && (g_config.all_vs_all || g_config.binary)) {
+        config_error("MODE_THRESHOLD only applies to pair CSV output and search mode", "");
+    }
+    if (g_config.write_buffer_kb < 1 || (size_t)g_config.write_buffer_kb * KiB < 4 * MAX_CSV_LINE) {
+        config_error("WRITE_BUFFER_KB must hold at least four CSV lines", "");
+    }
+    if (g_config.result_cache_mb < 0) config_error("RESULT_CACHE_MB must be at least 0", "");
+    if (g_config.write_buffers < 2) config_error("WRITE_BUFFERS must be at least 2", "");
+}
+
+// Substitution matrix, gap, mode and threshold settings on top of init_scoring_matrix
+INLINE void configure_scoring(ScoringMatrix* restrict scoring) {
+    if (g_config.matrix_file[0]) {
+        const char* error = load_matrix(scoring, g_config.matrix_file);
+        if (error) config_error(error, g_config.matrix_file);
+    }
+    scoring->gap_penalty = g_config.gap_penalty;
+    scoring->affine = g_config.affine;
+    scoring->gap_open = g_config.gap_open;
+    scoring->gap_extend = g_config.gap_extend;
+    scoring->mode = g_config.local ? ALIGN_LOCAL : g_config.semiglobal ? ALIGN_SEMIGLOBAL : ALIGN_GLOBAL;
+    scoring->threshold = g_config.threshold ? g_config.score_threshold : NO_THRESHOLD;
+}
+
+// Pairs below SCORE_THRESHOLD are left out of the CSV and search output
+INLINE bool below_threshold(const int score) {
+    return g_config.threshold && score < g_config.score_threshold;
+}
+
+// INPUT_FILE "-" streams the input from stdin, OUTPUT_FILE "-" writes the CSV to stdout
+INLINE bool stdin_input(void) {
+    return strcmp(g_config.input_file, "-") == 0;
+}
+
+INLINE bool stdout_output(void) {
+    return strcmp(g_config.output_file, "-") == 0;
+}
+
+// Neighbouring rows are paired and written with the configured CSV format
+INLINE bool pair_mode(void) {
+    return !g_config.all_vs_all && !g_config.query_file[0];
+}
+
+// CSV lines go through the writer thread, binary and all-vs-all outputs are mapped instead
+INLINE bool csv_output(void) {
+    return g_config.write && !g_config.all_vs_all && !g_config.binary;
+}
+
+// Without an alignment or similarity column only the score is needed
+INLINE bool score_only_mode(void) {
+    return !g_config.write || (g_config.write_align_pos < 0 && !g_config.similarity_analysis);
+}
+
+INLINE void parse_args(int argc, char** argv) {
+    for (int i = 1; i < argc; i++) {
+        if (strcmp(argv[i], "--help") == 0 || strcmp(argv[i], "-h") == 0) {
+            print_usage(argv[0]);
+            exit(0);
+        }
+        if (i + 1 >= argc) config_error("Missing value for ", argv[i]);
+        if (strcmp(argv[i], "--config") == 0) {
+            load_config_file(argv[++i]);
+            continue;
+        }
+        const Option* opt = find_option(argv[i], true);
+        if (!opt) config_error("Unknown option ", argv[i]);
+        set_option(opt, argv[++i]);
+    }
+
+    #ifdef MODE_TUNE
+    g_config.write = 0;
+    if (!strcmp(g_config.input_file, "-")) config_error("Tuning needs an INPUT_FILE, it cannot read stdin (-)", "");
+    #endif
+
+    validate_config();
+}
+
+#endif
@@ -2,28 +2,46 @@
 #define CSV_H
 
 #include "files.h"
+#include "thread.h"
 
+// View of one input row, points into the input mapping and is only valid while it is mapped
 typedef struct {
     const char* seq;
-    const char* other_data;
+    const char* line;    // first column, the other columns are read from here when writing
     size_t len;
+    size_t line_len;    // up to the line break
 } Data;
 
-#if MODE_WRITE == 1
+typedef enum {
+    COL_SEQ1,
+    COL_SEQ2,
+    COL_SCORE,
+    COL_ALIGN,
+    COL_MATCHES,
+    COL_MISMATCHES,
+    COL_GAPS,
+    COL_SIMILARITY,
+    COL_DATA1,
+    COL_DATA2,
+    COL_UNSET
+} ColumnKind;
+
 typedef struct {
     const char* parts[3];
-    size_t lengths[3]; 
-    size_t data_pos[2 * READ_CSV_COLS - 2 + SIMILARITY_ANALYSIS * 4];
-    int8_t col_to_data[2 * READ_CSV_COLS + 2 + SIMILARITY_ANALYSIS * 4];
+    size_t lengths[3];
+    uint8_t kind[MAX_CSV_COLS];
+    uint8_t field[MAX_CSV_COLS];
+    size_t num_cols;
+    size_t fixed_len;    // most a row writes besides the text of both input lines
 } Format;
 
+#define NUMERIC_COL_MAX (16)    // an int or a similarity percentage
+
 static Format fmt = {
     .parts = {NULL},
     .lengths = {0},
-    .data_pos = {0},
-    .col_to_data = {-1}
+    .num_cols = 0
 };
-#endif
 
 INLINE char* skip_header(char* current, char* end) {
     while (current < end) {
@@ -35,14 +53,88 @@ INLINE char* skip_header(char* current, char* end) {
     return current;
 }
 
+// Start of the last row of data, at data when there is none, blank lines after it are left out
+INLINE size_t last_row_start(const char* data, size_t size) {
+    while (size && (data[size - 1] == ' ' || data[size - 1] == '\r' || data[size - 1] == '\n')) size--;
+    while (size && data[size - 1] != '\n') size--;
+    return size;
+}
+
+// Joins the reader, takes its buffer as the window and carries what follows the window over to the next one
+INLINE bool next_window(InputStream* stream, char** current, char** end, const bool overlap) {
+    if (stream->reading) {
+        pthread_join(stream->reader, NULL);
+        stream->reading = false;
+    } else if (!stream->eof) {
+        stream_reader(stream);
+    }
+    stream->current = !stream->current;
+    char* data = stream->buffers[stream->current];
+    const size_t size = stream->filled;
+    if (!size) return false;
+
+    size_t window = size;
+    if (!stream->eof) {
+        while (window && data[window - 1] != '\n') window--;
+        if (!window) config_error("Input line longer than the stdin window", "");
+    }
+
+    // The partial line at the end, and with overlap the last row before it, start the next window
+    const size_t carry = overlap ? last_row_start(data, window) : window;
+    stream->filled = 0;
+    if (!stream->eof) {
+        memcpy(stream->buffers[!stream->current], data + carry, size - carry);
+        stream->filled = size - carry;
+        stream->reading = true;
+        pthread_create(&stream->reader, NULL, stream_reader, stream);
+    }
+
+    data[window] = '\0';
+    *current = data;
+    *end = data + window;
+    return true;
+}
+
+/* Next part of the input, the whole mapping once or the next stdin window, false once everything was handed out
+ * With overlap the last row of a window is also the first row of the next, so the pair across them is not lost
+ * The first part starts after the header, which is kept in files->header */
+INLINE bool next_input(Files* files, char** current, char** end, const bool overlap) {
+    if (files->stream) {
+        if (!next_window(files->stream, current, end, overlap)) return false;
+    } else {
+        if (files->handed_out) return false;
+        files->handed_out = true;
+        *current = files->file_data;
+        *end = files->file_data + files->data_size;
+    }
+
+    if (!files->header) {
+        char* data = skip_header(*current, *end);
+        size_t len = data - *current;
+        while (len && ((*current)[len - 1] == '\n' || (*current)[len - 1] == '\r')) len--;
+        files->header = (char*)malloc(len + 1);
+        memcpy(files->header, *current, len);
+        files->header[len] = '\0';
+        *current = data;
+    }
+    return true;
+}
+
+INLINE void set_column(int pos, ColumnKind kind) {
+    if (pos < 0 || (size_t)pos >= fmt.num_cols) config_error("Output column position out of range", "");
+    if (fmt.kind[pos] != COL_UNSET) config_error("Output columns must have unique positions", "");
+    fmt.kind[pos] = kind;
+}
+
 INLINE void init_format(void) {
-    #if MODE_WRITE == 1
-    const char* format = WRITE_CSV_ALIGN_FMT;
+    if (!csv_output()) return;
+
+    const char* format = g_config.align_fmt;
     size_t part = 0;
     fmt.parts[part] = format;
     
     while (*format) {
-        if (format[0] == '%' && format[1] == 's') {
+        if (format[0] == '%' && format[1] == 's' && part < 2) {
             fmt.lengths[part] = format - fmt.parts[part];
             format += 2;
             part++;
@@ -52,76 +144,113 @@ INLINE void init_format(void) {
         }
     }
     fmt.lengths[part] = format - fmt.parts[part];
+    if (part != 2) config_error("Alignment format must contain exactly two %s placeholders", "");
+
+    const bool has_align = g_config.write_align_pos >= 0;
+    fmt.num_cols = 2 * g_config.read_cols + 1 + has_align + g_config.similarity_analysis * 4;
+    memset(fmt.kind, COL_UNSET, sizeof(fmt.kind));
 
-    memset(fmt.col_to_data, -1, sizeof(fmt.col_to_data));
-
-    bool write_used[2 * READ_CSV_COLS + 2 + SIMILARITY_ANALYSIS * 4] = {false};
-    write_used[WRITE_CSV_SEQ1_POS] = true;
-    write_used[WRITE_CSV_SEQ1_POS + 1] = true;
-    write_used[WRITE_CSV_SCORE_POS] = true;
-    write_used[WRITE_CSV_ALIGN_POS] = true;
-    #if SIMILARITY_ANALYSIS == 1
-    write_used[WRITE_CSV_MATCHES_POS] = true;
-    write_used[WRITE_CSV_MISMATCHES_POS] = true;
-    write_used[WRITE_CSV_GAPS_POS] = true;
-    write_used[WRITE_CSV_SIMILARITY_POS] = true;
-    #endif
+    set_column(g_config.write_seq1_pos, COL_SEQ1);
+    set_column(g_config.write_seq1_pos + 1, COL_SEQ2);
+    set_column(g_config.write_score_pos, COL_SCORE);
+    if (has_align) set_column(g_config.write_align_pos, COL_ALIGN);
+    if (g_config.similarity_analysis) {
+        set_column(g_config.write_matches_pos, COL_MATCHES);
+        set_column(g_config.write_mismatches_pos, COL_MISMATCHES);
+        set_column(g_config.write_gaps_pos, COL_GAPS);
+        set_column(g_config.write_similarity_pos, COL_SIMILARITY);
+    }
     
-    size_t idx = 0;
-    for(size_t i = 0; i < 2 * READ_CSV_COLS + 2 + SIMILARITY_ANALYSIS * 4 && idx < (READ_CSV_COLS - 1); i++) {
-        if(!write_used[i]) {
-            fmt.data_pos[idx] = i;
-            fmt.col_to_data[i] = idx;
-            fmt.col_to_data[i + 1] = idx;
-            write_used[i] = write_used[i + 1] = true;
-            idx++;
-            i++;
+    // Remaining columns are the other input columns, first row then second row
+    uint8_t field = 0;
+    for (size_t i = 0; i < fmt.num_cols; i++) {
+        if (fmt.kind[i] != COL_UNSET) continue;
+        if (i + 1 >= fmt.num_cols || fmt.kind[i + 1] != COL_UNSET) {
+            config_error("Output data columns must come in adjacent pairs", "");
         }
+        fmt.kind[i] = COL_DATA1;
+        fmt.kind[i + 1] = COL_DATA2;
+        fmt.field[i] = fmt.field[i + 1] = field++;
+        i++;
+    }
+
+    // Separators and line break, the numeric columns and both aligned rows with the format around them
+    fmt.fixed_len = fmt.num_cols + NUMERIC_COL_MAX * (1 + g_config.similarity_analysis * 4);
+    if (has_align) fmt.fixed_len += fmt.lengths[0] + fmt.lengths[1] + fmt.lengths[2] + 2 * ALIGN_BUF;
+}
+
+// Most bytes buffer_output writes for the pair, data columns and sequences are copied from the two lines
+INLINE size_t output_bound(const Data* prev, const Data* curr) {
+    return prev->line_len + curr->line_len + fmt.fixed_len;
+}
+
+// Copies the other input column `field`, the sequence column is not counted
+INLINE char* copy_field(char* restrict buf, const char* restrict line, size_t field) {
+    size_t col = field + (field >= (size_t)g_config.read_seq_pos);
+    while (col && *line && *line != '\n' && *line != '\r') {
+        if (*line++ == ',') col--;
     }
-    #endif
+    while (*line && *line != ',' && *line != '\n' && *line != '\r') *buf++ = *line++;
+    return buf;
 }
 
-#if MODE_WRITE == 1
-INLINE size_t buffer_output(char buffer[WRITE_BUF], size_t pos, const Data* restrict prev, const Data* restrict curr, const Alignment* restrict result) {
+// Run lengths of the alignment columns, each followed by its CIGAR letter
+INLINE char* write_cigar(char* restrict buf, const Alignment* restrict result) {
+    static const char letters[] = "=XID";
+    for (int k = 0; k < result->length;) {
+        const AlignOp op = get_op(result, k);
+        int run = 1;
+        while (k + run < result->length && get_op(result, k + run) == op) run++;
+        buf = int_to_str(buf, run);
+        *buf++ = letters[op];
+        k += run;
+    }
+    return buf;
+}
+
+INLINE size_t buffer_output(char* buffer, size_t pos, const Data* restrict prev, const Data* restrict curr, const Alignment* restrict result) {
     char* buf = &buffer[pos];
     char* start = buf;
     
-    for (size_t col = 0; col < 4 + (READ_CSV_COLS - 1) * 2 + SIMILARITY_ANALYSIS * 4; col++) {
+    for (size_t col = 0; col < fmt.num_cols; col++) {
         if (col > 0) *buf++ = ',';
-        int8_t data_idx = fmt.col_to_data[col];
-        if (data_idx >= 0) {
-            const char* str = (col == fmt.data_pos[data_idx]) ? prev->other_data : curr->other_data;
-            while(*str) *buf++ = *str++;
-            continue;
-        }
-        switch (col) {
-            case WRITE_CSV_SEQ1_POS:
+        switch (fmt.kind[col]) {
+            case COL_DATA1:
+                buf = copy_field(buf, prev->line, fmt.field[col]);
+                break;
+            case COL_DATA2:
+                buf = copy_field(buf, curr->line, fmt.field[col]);
+                break;
+            case COL_SEQ1:
                 buf = fast_strcpy(buf, prev->seq, prev->len);
                 break;
-            case (WRITE_CSV_SEQ1_POS + 1):
+            case COL_SEQ2:
                 buf = fast_strcpy(buf, curr->seq, curr->len);
                 break;
-            case WRITE_CSV_SCORE_POS:
+            case COL_SCORE:
                 buf = int_to_str(buf, result->score);
                 break;
-            case WRITE_CSV_ALIGN_POS:
+            case COL_ALIGN:
+                if (g_config.align_cigar) {
+                    buf = write_cigar(buf, result);
+                    break;
+                }
                 buf = fast_strcpy(buf, fmt.parts[0], fmt.lengths[0]);
-                buf = fast_strcpy(buf, result->seq1_aligned, strlen(result->seq1_aligned));
+                buf = render_aligned(result, prev->seq, OP_INSERT, buf);
                 buf = fast_strcpy(buf, fmt.parts[1], fmt.lengths[1]);
-                buf = fast_strcpy(buf, result->seq2_aligned, strlen(result->seq2_aligned));
+                buf = render_aligned(result, curr->seq, OP_DELETE, buf);
                 buf = fast_strcpy(buf, fmt.parts[2], fmt.lengths[2]);
                 break;
-            #if SIMILARITY_ANALYSIS == 1
-            case WRITE_CSV_MATCHES_POS:
+            case COL_MATCHES:
                 buf = int_to_str(buf, result->matches);
                 break;
-            case WRITE_CSV_MISMATCHES_POS:
+            case COL_MISMATCHES:
                 buf = int_to_str(buf, result->mismatches);
                 break;
-            case WRITE_CSV_GAPS_POS:
+            case COL_GAPS:
                 buf = int_to_str(buf, result->gaps);
                 break;
-            case WRITE_CSV_SIMILARITY_POS: {
+            case COL_SIMILARITY: {
                 int percentage = (int)(result->similarity * 10000);
                 buf = int_to_str(buf, percentage / 100);
                 *buf++ = '.';
@@ -131,81 +260,293 @@ INLINE size_t buffer_output(char buffer[WRITE_BUF], size_t pos, const Data* rest
                 *buf++ = '%';
                 break;
             }
-            #endif
         }
     }
     
     *buf++ = '\n';
     return buf - start;
 }
-#endif
-
-INLINE size_t parse_csv_line(char** restrict current, 
-                            char seq[MAX_SEQ_LEN],
-                            char other_data[MAX_CSV_LINE - MAX_SEQ_LEN]) {
-    char* p = *current;
-    char* write_pos = NULL;
-    size_t col = 0;
-    size_t data_write_pos = 0;
-    size_t seq_len = 0;
-
-    while (*p && (*p == ' ' || *p == '\r' || *p == '\n')) p++;
-
-    #ifdef USE_AVX
-    const veci_t delim_vec = set1_epi8(',');
-    const veci_t nl_vec = set1_epi8('\n');
-    const veci_t cr_vec = set1_epi8('\r');
-
-    while (*p && *p != '\n' && *p != '\r') {
-        write_pos = (col == READ_CSV_SEQ_POS) ? seq : other_data + data_write_pos;
-        while (*p && *p != ',' && *p != '\n' && *p != '\r') {
-            veci_t data = loadu((veci_t*)p);
-            veci_t is_delim = or_si(
-                or_si(
-                    cmpeq_epi8(data, delim_vec),
-                    cmpeq_epi8(data, nl_vec)
-                ),
-                cmpeq_epi8(data, cr_vec)
-            );
-            num_t mask = movemask_epi8(is_delim);
-
-            if (mask) {
-                num_t pos = ctz(mask);
-                storeu((veci_t*)write_pos, data);
-                write_pos[pos] = '\0';
-                write_pos += pos;
-                p += pos;
-                break;
-            }
 
-            storeu((veci_t*)write_pos, data);
-            p += BYTES;
-            write_pos += BYTES;
-            
-            PREFETCH(p + MAX_CSV_LINE);
+// Alignments are kept in buffers of ALIGN_BUF operations, longer rows can only be scored
+INLINE void check_alignable(const Data* row) {
+    if (LIKELY(row->len < MAX_SEQ_LEN)) return;
+    char detail[64];
+    snprintf(detail, sizeof(detail), "%zu residues, MAX_SEQ_LEN is %d", row->len, MAX_SEQ_LEN);
+    config_error("Alignment and similarity columns need sequences shorter than MAX_SEQ_LEN, a row has ", detail);
+}
+
+// Finds the sequence column of the next row without copying it, blank lines are skipped
+INLINE size_t view_csv_line(char** restrict current, Data* restrict row) {
+    const char* p = *current;
+    const size_t seq_pos = g_config.read_seq_pos;
+
+    while (*p == ' ' || *p == '\r' || *p == '\n') p++;
+    row->line = row->seq = p;
+    row->len = 0;
+
+    for (size_t col = 0; *p && *p != '\n' && *p != '\r'; col++) {
+        const char* field = p;
+        while (*p && *p != ',' && *p != '\n' && *p != '\r') p++;
+        if (col == seq_pos) {
+            row->seq = field;
+            row->len = p - field;
+        }
+        if (*p == ',') p++;
+    }
+    row->line_len = p - row->line;
+
+    while (*p == '\n' || *p == '\r') p++;
+    *current = (char*)p;
+    return row->len;
+}
+
+/* Binary columnar output for pair mode, each column is one contiguous little endian array so NumPy can memmap it
+ * Row i is the pair of input rows i and i + 1, the rows are indexed before aligning so every column has a fixed place
+ * The alignment heap holds seq1 then seq2 aligned for row i between align_offsets[i] and align_offsets[i + 1] */
+
+#define COLUMN_MAGIC "SEQALNCL"
+#define MAX_COLUMNS (8)
+
+typedef struct {
+    char name[16];
+    char dtype[8];      // NumPy dtype string
+    uint64_t offset;    // from the start of the file, a multiple of CACHE_LINE
+    uint64_t length;    // elements
+} ColumnInfo;
+
+typedef struct {
+    char magic[8];
+    uint64_t count;
+    uint32_t num_columns;
+    uint32_t reserved;
+    ColumnInfo columns[MAX_COLUMNS];
+    char padding[40];
+} ColumnHeader;
+
+// Columns left out of the output are NULL
+typedef struct {
+    MappedFile file;
+    size_t count;
+    int32_t* score;
+    int32_t* matches;
+    int32_t* mismatches;
+    int32_t* gaps;
+    double* similarity;
+    uint64_t* align_offsets;    // count + 1 entries
+    char* heap;
+    size_t heap_size;
+} ColumnOutput;
+
+INLINE size_t add_column(ColumnHeader* header, size_t* size, const char* name, const char* dtype,
+                         size_t elem_size, size_t length) {
+    ColumnInfo* column = &header->columns[header->num_columns++];
+    strncpy(column->name, name, sizeof(column->name) - 1);
+    strncpy(column->dtype, dtype, sizeof(column->dtype) - 1);
+    column->offset = (*size + CACHE_LINE - 1) & ~(size_t)(CACHE_LINE - 1);
+    column->length = length;
+    *size = column->offset + elem_size * length;
+    return column->offset;
+}
+
+// The file is mapped with room for the longest possible alignments and cut to the real heap size when closed
+INLINE void open_columns(ColumnOutput* out, const size_t count) {
+    ColumnHeader header = {.count = count};
+    memcpy(header.magic, COLUMN_MAGIC, sizeof(header.magic));
+    size_t size = sizeof(ColumnHeader);
+    const bool has_stats = g_config.similarity_analysis;
+    const bool has_align = g_config.write_align_pos >= 0;
+
+    size_t offsets[7] = {0};
+    offsets[0] = add_column(&header, &size, "score", "<i4", sizeof(int32_t), count);
+    if (has_stats) {
+        offsets[1] = add_column(&header, &size, "matches", "<i4", sizeof(int32_t), count);
+        offsets[2] = add_column(&header, &size, "mismatches", "<i4", sizeof(int32_t), count);
+        offsets[3] = add_column(&header, &size, "gaps", "<i4", sizeof(int32_t), count);
+        offsets[4] = add_column(&header, &size, "similarity", "<f8", sizeof(double), count);
+    }
+    if (has_align) {
+        offsets[5] = add_column(&header, &size, "align_offsets", "<u8", sizeof(uint64_t), count + 1);
+        offsets[6] = add_column(&header, &size, "alignment", "|S1", 1, 0);
+        size += count * 2 * ALIGN_BUF;
+    }
+
+    out->file = map_output_file(g_config.output_file, size);
+    char* base = out->file.data;
+    out->count = count;
+    out->score = (int32_t*)(base + offsets[0]);
+    out->matches = has_stats ? (int32_t*)(base + offsets[1]) : NULL;
+    out->mismatches = has_stats ? (int32_t*)(base + offsets[2]) : NULL;
+    out->gaps = has_stats ? (int32_t*)(base + offsets[3]) : NULL;
+    out->similarity = has_stats ? (double*)(base + offsets[4]) : NULL;
+    out->align_offsets = has_align ? (uint64_t*)(base + offsets[5]) : NULL;
+    out->heap = has_align ? base + offsets[6] : NULL;
+    out->heap_size = 0;
+    if (has_align) out->align_offsets[0] = 0;
+    memcpy(base, &header, sizeof(header));
+}
+
+// Fixed width columns, safe to call from any thread for distinct rows
+INLINE void store_columns(ColumnOutput* restrict out, const size_t row, const Alignment* restrict result) {
+    out->score[row] = result->score;
+    if (out->matches) {
+        out->matches[row] = result->matches;
+        out->mismatches[row] = result->mismatches;
+        out->gaps[row] = result->gaps;
+        out->similarity[row] = result->similarity;
+    }
+}
+
+// Heap offsets depend on every earlier row, call in row order from one thread
+INLINE void store_alignment(ColumnOutput* restrict out, const size_t row, const Alignment* restrict result,
+                            const char* seq1, const char* seq2) {
+    if (!out->heap) return;
+    char* dst = out->heap + out->heap_size;
+    dst = render_aligned(result, seq1, OP_INSERT, dst);
+    render_aligned(result, seq2, OP_DELETE, dst);
+    out->heap_size += 2 * result->length;
+    out->align_offsets[row + 1] = out->heap_size;
+}
+
+INLINE void close_columns(ColumnOutput* out) {
+    size_t size = out->file.size;
+    if (out->heap) {
+        ColumnHeader* header = (ColumnHeader*)out->file.data;
+        header->columns[header->num_columns - 1].length = out->heap_size;
+        size = out->heap - out->file.data + out->heap_size;
+    }
+    truncate_output_file(&out->file, size);
+}
+
+/* Row index of the input mapping, the data is cut into byte ranges that are scanned in parallel
+ * A row belongs to the range holding the start of its line, so each range skips to its first full line
+ * and finishes the line it ends in, the row crossing a range boundary is seen exactly once */
+
+#define INDEX_RANGE_BYTES (1 * MiB)
+
+typedef struct {
+    const char* base;
+    size_t* starts;    // line start of each row, view_csv_line skips the leading spaces itself
+    size_t count;
+} RowIndex;
+
+typedef struct {
+    const char* base;
+    const char* end;
+    size_t num_ranges;
+    size_t next_range;
+    size_t** starts;
+    size_t* counts;
+} IndexJob;
+
+// Rows are lines with anything besides spaces, the same ones view_csv_line stops at
+INLINE size_t index_range(const char* base, const char* lo, const char* hi, const char* end, size_t** starts) {
+    size_t count = 0, capacity = 1024;
+    *starts = (size_t*)malloc(sizeof(size_t) * capacity);
+
+    const char* line = lo;
+    if (lo != base) {
+        line = (const char*)memchr(lo - 1, '\n', end - lo + 1);
+        if (!line) return 0;
+        line++;
+    }
+
+    while (line < hi) {
+        const char* p = line;
+        while (p < end && (*p == ' ' || *p == '\r')) p++;
+        if (p < end && *p != '\n' && *p) {
+            if (count == capacity) {
+                capacity *= 2;
+                *starts = (size_t*)realloc(*starts, sizeof(size_t) * capacity);
+            }
+            (*starts)[count++] = line - base;
         }
-    #else
-    while (*p && *p != '\n' && *p != '\r') {
-        write_pos = (col == READ_CSV_SEQ_POS) ? seq : other_data + data_write_pos;
-        
-        while (*p && *p != ',' && *p != '\n' && *p != '\r') {
-            *write_pos++ = *p++;
+        const char* newline = (const char*)memchr(p, '\n', end - p);
+        if (!newline) break;
+        line = newline + 1;
+    }
+    return count;
+}
+
+INLINE void index_job(ThreadWork* work, void* arg) {
+    (void)work;
+    IndexJob* job = (IndexJob*)arg;
+    size_t range;
+    while ((range = __atomic_fetch_add(&job->next_range, 1, __ATOMIC_RELAXED)) < job->num_ranges) {
+        const char* lo = job->base + range * INDEX_RANGE_BYTES;
+        const char* hi = lo + INDEX_RANGE_BYTES < job->end ? lo + INDEX_RANGE_BYTES : job->end;
+        job->counts[range] = index_range(job->base, lo, hi, job->end, &job->starts[range]);
+    }
+}
+
+INLINE void index_rows(RowIndex* index, const char* current, const char* end) {
+    IndexJob job = {.base = current, .end = end};
+    job.num_ranges = ((size_t)(end - current) + INDEX_RANGE_BYTES - 1) / INDEX_RANGE_BYTES;
+    job.starts = (size_t**)malloc(sizeof(size_t*) * (job.num_ranges + 1));
+    job.counts = (size_t*)malloc(sizeof(size_t) * (job.num_ranges + 1));
+    if (g_config.multithread) {
+        run_job(index_job, &job);
+    } else {
+        run_job_here(index_job, &job);
+    }
+
+    index->base = current;
+    index->count = 0;
+    for (size_t r = 0; r < job.num_ranges; r++) index->count += job.counts[r];
+    index->starts = (size_t*)malloc(sizeof(size_t) * (index->count + 1));
+
+    // Range offsets are already relative to the start of the data
+    size_t row = 0;
+    for (size_t r = 0; r < job.num_ranges; r++) {
+        memcpy(index->starts + row, job.starts[r], sizeof(size_t) * job.counts[r]);
+        row += job.counts[r];
+        free(job.starts[r]);
+    }
+    free(job.starts);
+    free(job.counts);
+}
+
+INLINE void free_row_index(RowIndex* index) {
+    free(index->starts);
+}
+
+// All sequences of a file back to back, for modes that need random access to every row
+typedef struct {
+    char* data;
+    size_t* offsets;
+    size_t* lengths;
+    size_t count;
+} SequenceSet;
+
+INLINE void load_sequences(SequenceSet* set, char* current, char* end) {
+    size_t capacity = 1024, data_capacity = 1024 * MAX_SEQ_LEN, data_size = 0;
+    Data row;
+    set->offsets = (size_t*)malloc(sizeof(size_t) * capacity);
+    set->lengths = (size_t*)malloc(sizeof(size_t) * capacity);
+    set->data = (char*)malloc(data_capacity);
+    set->count = 0;
+
+    while (current < end && *current) {
+        size_t len = view_csv_line(&current, &row);
+        if (set->count == capacity) {
+            capacity *= 2;
+            set->offsets = (size_t*)realloc(set->offsets, sizeof(size_t) * capacity);
+            set->lengths = (size_t*)realloc(set->lengths, sizeof(size_t) * capacity);
         }
-    #endif
-        *write_pos = '\0';
-        
-        if (col == READ_CSV_SEQ_POS) {
-            seq_len = write_pos - seq;
-        } else {
-            data_write_pos = write_pos - other_data + 1;
+        if (data_size + len > data_capacity) {
+            data_capacity = 2 * (data_capacity + len);
+            set->data = (char*)realloc(set->data, data_capacity);
         }
-        
-        if (*p == ',') { p++; col++; }
+        memcpy(set->data + data_size, row.seq, len);
+        set->offsets[set->count] = data_size;
+        set->lengths[set->count++] = len;
+        data_size += len;
     }
-    
-    while (*p && (*p == '\n' || *p == '\r')) p++;
-    *current = p;
-    return seq_len;
+}
+
+INLINE void free_sequences(SequenceSet* set) {
+    free(set->data);
+    free(set->offsets);
+    free(set->lengths);
 }
 
 #endif
\ No newline at end of file
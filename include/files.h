@@ -2,9 +2,73 @@
 #define ARGS_H
 
 #include "seqalign.h"
+#include "config.h"
+#include "compress.h"
+
+/* Output goes through a ring of buffers, the caller fills one while a writer thread writes the others in order
+ * Handing a buffer off only blocks when every other buffer is still queued, so alignment never waits on a single write */
+
+typedef struct {
+    char* data;
+    size_t size;
+    bool last;    // tells the writer thread to stop after this one
+    // Compressed outputs only, the compressor of the slot packs it between being filled and written
+    char* packed;
+    size_t packed_size;
+    size_t packed_capacity;
+    Encoder encoder;
+    sem_t filled;
+    sem_t compressed;
+    pthread_t compressor;
+    bool stop;
+} WriteSlot;
+
+// Shared with the writer thread, on the heap so the WriteBuffer holding it can be copied
+typedef struct {
+    #ifdef _WIN32
+    HANDLE handle;
+    #else
+    int fd;
+    #endif
+    WriteSlot* slots;
+    int num_slots;
+    sem_t free_slots;
+    sem_t full_slots;
+    pthread_t thread;
+    Codec codec;
+} WriteRing;
+
+typedef struct {
+    #ifdef _WIN32
+    HANDLE handle;
+    #else
+    int fd;
+    #endif
+    char* buffer;    // slot being filled
+    size_t pos;
+    size_t capacity;
+    int head;    // index of the slot being filled
+    WriteRing* ring;
+} WriteBuffer;
+
+/* INPUT_FILE "-" and compressed inputs are read instead of mapped, in windows of whole lines so memory stays at two
+ * windows however long the input is, a reader thread reads and decompresses the next window while the current one
+ * is aligned */
+
+#define STREAM_WINDOW (32 * MiB)
 
 typedef struct {
-    char* file_data;
+    char* buffers[2];    // CACHE_LINE bytes of padding past STREAM_WINDOW, like read_file
+    int current;    // buffer of the window being aligned, the reader fills the other one
+    size_t filled;    // bytes in the buffer being filled, starting with the lines carried over
+    bool eof;
+    bool reading;
+    pthread_t reader;
+    Decoder decoder;
+} InputStream;
+
+typedef struct {
+    char* file_data;    // NULL when the input is streamed
     size_t data_size;
     #ifdef _WIN32
     HANDLE hFile;
@@ -12,55 +76,399 @@ typedef struct {
     #else
     int fd;
     #endif
-    #if MODE_WRITE == 1
+    InputStream* stream;    // NULL when the input is mapped
+    bool loaded;    // a stream read whole into file_data, for modes that need the whole input
+    bool handed_out;    // the mapping was handed out as the only part of the input
+    char* header;    // first line of the input, copied since stdin windows are reused
     WriteBuffer writer;
-    #endif
 } Files;
 
-INLINE void flush_buffer(WriteBuffer* wb) {
+// Output file mapped for writing, used for binary outputs that are filled in out of order
+typedef struct {
+    char* data;
+    size_t size;
     #ifdef _WIN32
-    WriteFile(wb->handle, wb->buffer, (DWORD)wb->pos, &wb->bytes_written, NULL);
+    HANDLE hFile;
+    HANDLE hMapping;
     #else
-    write(wb->fd, wb->buffer, wb->pos);
+    int fd;
     #endif
-    wb->pos = 0;
+} MappedFile;
+
+INLINE MappedFile map_output_file(const char* path, size_t size) {
+    MappedFile file = {0};
+    file.size = size;
+
+    #ifdef _WIN32
+    file.hFile = CreateFileA(path, GENERIC_READ | GENERIC_WRITE, 0, NULL, CREATE_ALWAYS, FILE_ATTRIBUTE_NORMAL, NULL);
+    if (file.hFile == INVALID_HANDLE_VALUE) config_error("Cannot open output file ", path);
+    file.hMapping = CreateFileMapping(file.hFile, NULL, PAGE_READWRITE, (DWORD)((uint64_t)size >> 32), (DWORD)size, NULL);
+    if (!file.hMapping) config_error("Cannot map output file ", path);
+    file.data = (char*)MapViewOfFile(file.hMapping, FILE_MAP_WRITE, 0, 0, size);
+    #else
+    file.fd = open(path, O_RDWR | O_CREAT | O_TRUNC, 0644);
+    if (file.fd < 0) config_error("Cannot open output file ", path);
+    if (ftruncate(file.fd, size) != 0) config_error("Cannot resize output file ", path);
+    file.data = mmap(NULL, size, PROT_READ | PROT_WRITE, MAP_SHARED, file.fd, 0);
+    if (file.data == MAP_FAILED) config_error("Cannot map output file ", path);
+    #endif
+
+    return file;
 }
 
-INLINE Files get_files(void) {
-    Files files = {0};
+INLINE void unmap_output_file(MappedFile* file) {
+    #ifdef _WIN32
+    FlushViewOfFile(file->data, 0);
+    UnmapViewOfFile(file->data);
+    CloseHandle(file->hMapping);
+    CloseHandle(file->hFile);
+    #else
+    munmap(file->data, file->size);
+    close(file->fd);
+    #endif
+}
 
+// Same as unmap_output_file, then cuts the file to the first size bytes for outputs mapped at their upper bound
+INLINE void truncate_output_file(MappedFile* file, size_t size) {
     #ifdef _WIN32
-    files.hFile = CreateFileA(INPUT_FILE, GENERIC_READ, FILE_SHARE_READ, NULL, OPEN_EXISTING, FILE_FLAG_SEQUENTIAL_SCAN, NULL);
-    files.hMapping = CreateFileMapping(files.hFile, NULL, PAGE_READONLY, 0, 0, NULL);
-    files.file_data = (char*)MapViewOfFile(files.hMapping, FILE_MAP_READ, 0, 0, 0);
-    LARGE_INTEGER file_size;
-    GetFileSizeEx(files.hFile, &file_size);
-    files.data_size = file_size.QuadPart;
+    FlushViewOfFile(file->data, 0);
+    UnmapViewOfFile(file->data);
+    CloseHandle(file->hMapping);
+    LARGE_INTEGER end = {.QuadPart = (LONGLONG)size};
+    SetFilePointerEx(file->hFile, end, NULL, FILE_BEGIN);
+    SetEndOfFile(file->hFile);
+    CloseHandle(file->hFile);
     #else
-    files.fd = open(INPUT_FILE, O_RDONLY);
-    struct stat sb;
-    fstat(files.fd, &sb);
-    files.data_size = sb.st_size;
-    files.file_data = mmap(NULL, files.data_size, PROT_READ, MAP_PRIVATE, files.fd, 0);
-    madvise(files.file_data, files.data_size, MADV_SEQUENTIAL);
+    munmap(file->data, file->size);
+    if (ftruncate(file->fd, size) != 0) config_error("Cannot resize output file ", g_config.output_file);
+    close(file->fd);
     #endif
+}
+
+// Whole file with CACHE_LINE bytes of zero padding so vector loads may read past the end, free() when done
+INLINE char* read_file(const char* path, size_t* size) {
+    FILE* file = fopen(path, "rb");
+    if (!file) config_error("Cannot open file ", path);
+    fseek(file, 0, SEEK_END);
+    *size = ftell(file);
+    fseek(file, 0, SEEK_SET);
+    char* data = (char*)calloc(*size + CACHE_LINE + 1, 1);
+    if (fread(data, 1, *size, file) != *size) config_error("Cannot read file ", path);
+    fclose(file);
+    return data;
+}
 
-    #if MODE_WRITE == 1
+INLINE void write_all(WriteRing* ring, const char* data, size_t size) {
+    while (size) {
+        #ifdef _WIN32
+        DWORD written = 0;
+        if (!WriteFile(ring->handle, data, size > MiB ? (DWORD)MiB : (DWORD)size, &written, NULL) || !written) {
+            config_error("Cannot write output file ", g_config.output_file);
+        }
+        #else
+        ssize_t written = write(ring->fd, data, size);
+        if (written < 0 && errno == EINTR) continue;
+        if (written <= 0) config_error("Cannot write output file ", g_config.output_file);
+        #endif
+        data += written;
+        size -= written;
+    }
+}
+
+// Starts writeback of each slot as it is written and drops the previous one from the page cache once it is on disk
+INLINE void drop_written(WriteRing* ring, const uint64_t offset, const size_t size, const size_t prev_size) {
+    #ifdef __linux__
+    sync_file_range(ring->fd, offset, size, SYNC_FILE_RANGE_WRITE);
+    if (prev_size) {
+        sync_file_range(ring->fd, offset - prev_size, prev_size,
+                        SYNC_FILE_RANGE_WAIT_BEFORE | SYNC_FILE_RANGE_WRITE | SYNC_FILE_RANGE_WAIT_AFTER);
+        posix_fadvise(ring->fd, offset - prev_size, prev_size, POSIX_FADV_DONTNEED);
+    }
+    #else
+    (void)ring, (void)offset, (void)size, (void)prev_size;
+    #endif
+}
+
+INLINE T_Func compressor_thread(void* arg) {
+    WriteSlot* slot = (WriteSlot*)arg;
+    for (;;) {
+        sem_wait(&slot->filled);
+        if (slot->stop) break;
+        slot->packed_size = slot->size ? encode_block(&slot->encoder, slot->data, slot->size, slot->packed,
+                                                      slot->packed_capacity) : 0;
+        // Once written the slot can be refilled as the last one before this thread looks at it again
+        const bool last = slot->last;
+        sem_post(&slot->compressed);
+        if (last) break;
+    }
+    T_Ret(NULL);
+}
+
+// Slots are written in order, compressed ones as soon as their compressor is done with them
+INLINE T_Func writer_thread(void* arg) {
+    WriteRing* ring = (WriteRing*)arg;
+    uint64_t offset = 0;
+    size_t prev_size = 0;
+    for (int tail = 0;; tail = (tail + 1) % ring->num_slots) {
+        WriteSlot* slot = &ring->slots[tail];
+        sem_wait(ring->codec ? &slot->compressed : &ring->full_slots);
+        const char* data = ring->codec ? slot->packed : slot->data;
+        const size_t size = ring->codec ? slot->packed_size : slot->size;
+        write_all(ring, data, size);
+        if (g_config.write_drop_cache && size) {
+            drop_written(ring, offset, size, prev_size);
+            offset += size;
+            prev_size = size;
+        }
+        if (slot->last) break;
+        sem_post(&ring->free_slots);
+    }
+    T_Ret(NULL);
+}
+
+// Hands a filled slot to its compressor, or straight to the writer thread
+INLINE void queue_slot(WriteRing* ring, const int s) {
+    sem_post(ring->codec ? &ring->slots[s].filled : &ring->full_slots);
+}
+
+INLINE void start_writer(WriteBuffer* wb) {
+    WriteRing* ring = (WriteRing*)calloc(1, sizeof(WriteRing));
     #ifdef _WIN32
-    HANDLE hFileOut = CreateFileA(OUTPUT_FILE, GENERIC_WRITE, 0, NULL, CREATE_ALWAYS, FILE_FLAG_SEQUENTIAL_SCAN, NULL);
-    files.writer.handle = hFileOut;
+    ring->handle = wb->handle;
     #else
-    files.writer.fd = open(OUTPUT_FILE, O_WRONLY | O_CREAT | O_TRUNC, 0644);
+    ring->fd = wb->fd;
     #endif
-    const char* header = WRITE_CSV_HEADER;
-    size_t header_len = strlen(header);
-    memcpy(files.writer.buffer, header, header_len);
-    files.writer.pos = header_len;
+    ring->num_slots = g_config.write_buffers;
+    ring->slots = (WriteSlot*)calloc(ring->num_slots, sizeof(WriteSlot));
+    ring->codec = output_codec();
+    wb->capacity = (size_t)g_config.write_buffer_kb * KiB;
+    for (int s = 0; s < ring->num_slots; s++) {
+        WriteSlot* slot = &ring->slots[s];
+        slot->data = (char*)malloc(wb->capacity);
+        if (!ring->codec) continue;
+        open_encoder(&slot->encoder, ring->codec);
+        slot->packed_capacity = encode_bound(&slot->encoder, wb->capacity);
+        slot->packed = (char*)malloc(slot->packed_capacity);
+        sem_init(&slot->filled, 0, 0);
+        sem_init(&slot->compressed, 0, 0);
+        pthread_create(&slot->compressor, NULL, compressor_thread, slot);
+    }
+    sem_init(&ring->free_slots, 0, ring->num_slots - 1);
+    sem_init(&ring->full_slots, 0, 0);
+    pthread_create(&ring->thread, NULL, writer_thread, ring);
+
+    wb->ring = ring;
+    wb->head = 0;
+    wb->buffer = ring->slots[0].data;
+    wb->pos = 0;
+}
+
+// Hands the filled slot to the writer thread and continues in the next free one
+INLINE void flush_buffer(WriteBuffer* wb) {
+    if (!wb->pos) return;
+    WriteRing* ring = wb->ring;
+    ring->slots[wb->head].size = wb->pos;
+    queue_slot(ring, wb->head);
+    sem_wait(&ring->free_slots);
+    wb->head = (wb->head + 1) % ring->num_slots;
+    wb->buffer = ring->slots[wb->head].data;
+    wb->pos = 0;
+}
+
+// Makes room for size more bytes, false when they cannot fit even an empty buffer and need write_data instead
+INLINE bool reserve_buffer(WriteBuffer* wb, const size_t size) {
+    if (UNLIKELY(size > wb->capacity)) return false;
+    if (wb->capacity - wb->pos < size) flush_buffer(wb);
+    return true;
+}
+
+// Appends a caller-owned buffer, it is copied into the ring so the caller can reuse it right away
+INLINE void write_data(WriteBuffer* wb, const char* data, size_t size) {
+    while (size) {
+        size_t n = wb->capacity - wb->pos < size ? wb->capacity - wb->pos : size;
+        memcpy(wb->buffer + wb->pos, data, n);
+        wb->pos += n;
+        data += n;
+        size -= n;
+        if (wb->pos == wb->capacity) flush_buffer(wb);
+    }
+}
+
+// Writes everything that is left and closes the output file
+INLINE void close_writer(WriteBuffer* wb) {
+    WriteRing* ring = wb->ring;
+    ring->slots[wb->head].size = wb->pos;
+    ring->slots[wb->head].last = true;
+    queue_slot(ring, wb->head);
+    pthread_join(ring->thread, NULL);
+
+    // The compressor of the last slot stopped after it, the others are waiting for a slot that never comes
+    for (int s = 0; ring->codec && s < ring->num_slots; s++) {
+        WriteSlot* slot = &ring->slots[s];
+        if (s != wb->head) {
+            slot->stop = true;
+            sem_post(&slot->filled);
+        }
+        pthread_join(slot->compressor, NULL);
+        close_encoder(&slot->encoder);
+        sem_destroy(&slot->filled);
+        sem_destroy(&slot->compressed);
+        free(slot->packed);
+    }
+
+    #ifdef _WIN32
+    CloseHandle(wb->handle);
+    #else
+    close(wb->fd);
     #endif
+    sem_destroy(&ring->free_slots);
+    sem_destroy(&ring->full_slots);
+    for (int s = 0; s < ring->num_slots; s++) free(ring->slots[s].data);
+    free(ring->slots);
+    free(ring);
+}
+
+// Fills the buffer the window being aligned is not in until it is full or the input ends
+INLINE T_Func stream_reader(void* arg) {
+    InputStream* stream = (InputStream*)arg;
+    char* buffer = stream->buffers[!stream->current];
+    while (stream->filled < STREAM_WINDOW) {
+        const size_t got = decode(&stream->decoder, buffer + stream->filled, STREAM_WINDOW - stream->filled);
+        if (!got) {
+            stream->eof = true;
+            break;
+        }
+        stream->filled += got;
+    }
+    T_Ret(NULL);
+}
+
+// Input from stdin when path is NULL
+INLINE InputStream* open_stream(const char* path) {
+    InputStream* stream = (InputStream*)calloc(1, sizeof(InputStream));
+    for (int b = 0; b < 2; b++) stream->buffers[b] = (char*)calloc(STREAM_WINDOW + CACHE_LINE + 1, 1);
+    stream->current = 1;    // the first window is read into buffer 0
+    open_decoder(&stream->decoder, path);
+    return stream;
+}
+
+INLINE void close_stream(InputStream* stream) {
+    if (stream->reading) pthread_join(stream->reader, NULL);
+    close_decoder(&stream->decoder);
+    free(stream->buffers[0]);
+    free(stream->buffers[1]);
+    free(stream);
+}
+
+// All-vs-all, binary outputs and tuning need every row at once, their streamed inputs are read whole instead
+INLINE bool whole_input(void) {
+    #ifdef MODE_TUNE
+    return true;
+    #else
+    return g_config.all_vs_all || (pair_mode() && g_config.write && g_config.binary);
+    #endif
+}
+
+INLINE void load_stream(Files* files) {
+    InputStream* stream = files->stream;
+    size_t capacity = STREAM_WINDOW, size = 0;
+    char* data = (char*)malloc(capacity + CACHE_LINE + 1);
+    for (size_t got = 1; got;) {
+        if (capacity - size < RAW_CHUNK) {
+            capacity *= 2;
+            data = (char*)realloc(data, capacity + CACHE_LINE + 1);
+        }
+        got = decode(&stream->decoder, data + size, capacity - size);
+        size += got;
+    }
+    memset(data + size, 0, CACHE_LINE + 1);
+
+    close_stream(stream);
+    files->stream = NULL;
+    files->file_data = data;
+    files->data_size = size;
+    files->loaded = true;
+}
+
+INLINE void map_input(Files* files) {
+    #ifdef _WIN32
+    files->hFile = CreateFileA(g_config.input_file, GENERIC_READ, FILE_SHARE_READ, NULL, OPEN_EXISTING, FILE_FLAG_SEQUENTIAL_SCAN, NULL);
+    if (files->hFile == INVALID_HANDLE_VALUE) config_error("Cannot open input file ", g_config.input_file);
+    files->hMapping = CreateFileMapping(files->hFile, NULL, PAGE_READONLY, 0, 0, NULL);
+    files->file_data = (char*)MapViewOfFile(files->hMapping, FILE_MAP_READ, 0, 0, 0);
+    LARGE_INTEGER file_size;
+    GetFileSizeEx(files->hFile, &file_size);
+    files->data_size = file_size.QuadPart;
+    #else
+    files->fd = open(g_config.input_file, O_RDONLY);
+    if (files->fd < 0) config_error("Cannot open input file ", g_config.input_file);
+    struct stat sb;
+    fstat(files->fd, &sb);
+    files->data_size = sb.st_size;
+    files->file_data = mmap(NULL, files->data_size, PROT_READ, MAP_PRIVATE, files->fd, 0);
+    madvise(files->file_data, files->data_size, MADV_SEQUENTIAL);
+    #endif
+}
+
+INLINE Files get_files(void) {
+    Files files = {0};
+
+    if (stdin_input()) {
+        files.stream = open_stream(NULL);
+    } else if (file_codec(g_config.input_file)) {
+        files.stream = open_stream(g_config.input_file);
+    } else {
+        map_input(&files);
+    }
+    if (files.stream && whole_input()) load_stream(&files);
+
+    const Codec codec = output_codec();
+    if (codec && g_config.write && !csv_output()) config_error("Only CSV outputs can be compressed, ", g_config.output_file);
+    require_codec(codec, g_config.output_file);
+
+    if (csv_output()) {
+        if (stdout_output()) {
+            // The output takes over stdout, everything printed from here on goes to stderr
+            fflush(stdout);
+            #ifdef _WIN32
+            files.writer.handle = (HANDLE)_get_osfhandle(_dup(_fileno(stdout)));
+            _dup2(_fileno(stderr), _fileno(stdout));
+            #else
+            files.writer.fd = dup(STDOUT_FILENO);
+            dup2(STDERR_FILENO, STDOUT_FILENO);
+            #endif
+        } else {
+            #ifdef _WIN32
+            HANDLE hFileOut = CreateFileA(g_config.output_file, GENERIC_WRITE, 0, NULL, CREATE_ALWAYS, FILE_FLAG_SEQUENTIAL_SCAN, NULL);
+            if (hFileOut == INVALID_HANDLE_VALUE) config_error("Cannot open output file ", g_config.output_file);
+            files.writer.handle = hFileOut;
+            #else
+            files.writer.fd = open(g_config.output_file, O_WRONLY | O_CREAT | O_TRUNC, 0644);
+            if (files.writer.fd < 0) config_error("Cannot open output file ", g_config.output_file);
+            #endif
+        }
+        start_writer(&files.writer);
+        if (pair_mode()) {
+            const char* header = g_config.write_header;
+            size_t header_len = strlen(header);
+            memcpy(files.writer.buffer, header, header_len);
+            files.writer.pos = header_len;
+            if (!header_len || header[header_len - 1] != '\n') files.writer.buffer[files.writer.pos++] = '\n';
+        }
+    }
     return files;
 }
 
 INLINE void free_files(Files* files) {
+    free(files->header);
+    if (files->stream) {
+        close_stream(files->stream);
+        return;
+    }
+    if (files->loaded) {
+        free(files->file_data);
+        return;
+    }
     #ifdef _WIN32
     UnmapViewOfFile(files->file_data);
     CloseHandle(files->hMapping);
@@ -69,15 +477,6 @@ INLINE void free_files(Files* files) {
     munmap(files->file_data, files->data_size);
     close(files->fd);
     #endif
-
-    #if MODE_WRITE == 1
-    flush_buffer(&files->writer);
-    #ifdef _WIN32
-    CloseHandle(files->writer.handle);
-    #else
-    close(files->writer.fd);
-    #endif
-    #endif
 }
 
 #endif
\ No newline at end of file
@@ -0,0 +1,138 @@
+#ifndef INTERN_H
+#define INTERN_H
+
+#include "csv.h"
+
+/* Distinct sequences of a set of rows, each one stored once with its residue indices and rows refer to it by id
+ * Modes that align rows against many others (all-vs-all, search) only align distinct sequences and fan the results
+ * back out to the rows, every residue is translated once per distinct sequence instead of once per pair */
+
+typedef struct {
+    SequenceSet seqs;    // distinct sequences in order of first appearance
+    int8_t* indices;     // residue indices of seqs.data, at the same offsets
+    size_t* first_row;   // row of the first appearance of every id
+    size_t* ids;         // id of every interned row
+    size_t rows;
+    uint32_t* slots;     // open addressing over the ids, id + 1 per slot and 0 when empty
+    size_t slot_mask;
+    size_t row_capacity;
+    size_t seq_capacity;
+    size_t data_capacity;
+    const ScoringMatrix* scoring;
+} SequenceTable;
+
+INLINE void intern_init(SequenceTable* table, const ScoringMatrix* scoring) {
+    memset(table, 0, sizeof(*table));
+    table->scoring = scoring;
+    table->row_capacity = table->seq_capacity = 1024;
+    table->data_capacity = 1024 * MAX_SEQ_LEN;
+    table->ids = (size_t*)malloc(sizeof(size_t) * table->row_capacity);
+    table->first_row = (size_t*)malloc(sizeof(size_t) * table->seq_capacity);
+    table->seqs.offsets = (size_t*)malloc(sizeof(size_t) * table->seq_capacity);
+    table->seqs.lengths = (size_t*)malloc(sizeof(size_t) * table->seq_capacity);
+    table->seqs.data = (char*)malloc(table->data_capacity);
+    table->indices = (int8_t*)malloc(table->data_capacity);
+    table->slot_mask = 2 * table->seq_capacity - 1;
+    table->slots = (uint32_t*)calloc(table->slot_mask + 1, sizeof(uint32_t));
+}
+
+// Keeps the buffers for the next set of rows
+INLINE void intern_reset(SequenceTable* table) {
+    table->rows = table->seqs.count = 0;
+    memset(table->slots, 0, sizeof(uint32_t) * (table->slot_mask + 1));
+}
+
+INLINE void intern_free(SequenceTable* table) {
+    free_sequences(&table->seqs);
+    free(table->indices);
+    free(table->first_row);
+    free(table->ids);
+    free(table->slots);
+}
+
+INLINE const char* interned_seq(const SequenceTable* table, const size_t id) {
+    return table->seqs.data + table->seqs.offsets[id];
+}
+
+INLINE const int8_t* interned_indices(const SequenceTable* table, const size_t id) {
+    return table->indices + table->seqs.offsets[id];
+}
+
+INLINE uint32_t* intern_slot(SequenceTable* table, const char* seq, const size_t len) {
+    size_t slot = hash_residues(seq, len, len) & table->slot_mask;
+    while (table->slots[slot]) {
+        const size_t id = table->slots[slot] - 1;
+        if (table->seqs.lengths[id] == len && !memcmp(interned_seq(table, id), seq, len)) break;
+        slot = (slot + 1) & table->slot_mask;
+    }
+    return &table->slots[slot];
+}
+
+// Slots stay at most half full
+INLINE void grow_slots(SequenceTable* table) {
+    free(table->slots);
+    table->slot_mask = 2 * table->slot_mask + 1;
+    table->slots = (uint32_t*)calloc(table->slot_mask + 1, sizeof(uint32_t));
+    for (size_t id = 0; id < table->seqs.count; id++) {
+        *intern_slot(table, interned_seq(table, id), table->seqs.lengths[id]) = (uint32_t)id + 1;
+    }
+}
+
+// Adds the next row and returns its id, a new id only for a sequence that was not interned yet
+INLINE size_t intern_row(SequenceTable* table, const char* seq, const size_t len) {
+    if (table->rows == table->row_capacity) {
+        table->row_capacity *= 2;
+        table->ids = (size_t*)realloc(table->ids, sizeof(size_t) * table->row_capacity);
+    }
+
+    uint32_t* slot = intern_slot(table, seq, len);
+    if (*slot) return table->ids[table->rows++] = *slot - 1;
+
+    SequenceSet* seqs = &table->seqs;
+    const size_t id = seqs->count++;
+    const size_t offset = id ? seqs->offsets[id - 1] + seqs->lengths[id - 1] : 0;
+    if (seqs->count > table->seq_capacity) {
+        table->seq_capacity *= 2;
+        seqs->offsets = (size_t*)realloc(seqs->offsets, sizeof(size_t) * table->seq_capacity);
+        seqs->lengths = (size_t*)realloc(seqs->lengths, sizeof(size_t) * table->seq_capacity);
+        table->first_row = (size_t*)realloc(table->first_row, sizeof(size_t) * table->seq_capacity);
+    }
+    if (offset + len > table->data_capacity) {
+        table->data_capacity = 2 * (table->data_capacity + len);
+        seqs->data = (char*)realloc(seqs->data, table->data_capacity);
+        table->indices = (int8_t*)realloc(table->indices, table->data_capacity);
+    }
+    memcpy(seqs->data + offset, seq, len);
+    seq_to_indices8(seq, len, table->indices + offset, table->scoring);
+    seqs->offsets[id] = offset;
+    seqs->lengths[id] = len;
+    table->first_row[id] = table->rows;
+    *slot = (uint32_t)id + 1;
+    if (2 * seqs->count > table->slot_mask) grow_slots(table);
+    return table->ids[table->rows++] = id;
+}
+
+// Interns every row of the input
+INLINE void intern_rows(SequenceTable* table, char* current, char* end) {
+    Data row;
+    while (current < end && *current) {
+        view_csv_line(&current, &row);
+        intern_row(table, row.seq, row.len);
+    }
+}
+
+// Task of two interned sequences, its residue indices are already translated
+INLINE AlignTask interned_task(const SequenceTable* table1, const size_t id1,
+                               const SequenceTable* table2, const size_t id2, const ScoringMatrix* scoring) {
+    return (AlignTask){
+        .seq1 = interned_seq(table1, id1),
+        .seq2 = interned_seq(table2, id2),
+        .len1 = table1->seqs.lengths[id1],
+        .len2 = table2->seqs.lengths[id2],
+        .scoring = scoring,
+        .indices1 = interned_indices(table1, id1),
+        .indices2 = interned_indices(table2, id2)
+    };
+}
+
+#endif
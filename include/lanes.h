@@ -0,0 +1,507 @@
+#ifndef LANES_H
+#define LANES_H
+
+#include "seqalign.h"
+
+typedef struct {
+    const char* seq1;
+    const char* seq2;
+    size_t len1;
+    size_t len2;
+    const ScoringMatrix* scoring;
+    Alignment* result;
+    int* score;    // score only tasks write here and leave result untouched, with a threshold every task is scored here first
+    const int8_t* indices1;    // residue indices of interned sequences, NULL to translate them per pair
+    const int8_t* indices2;
+} AlignTask;
+
+// With a threshold only pairs whose score reaches it are aligned again with a traceback
+INLINE void align_task(AlignTask* restrict task, const bool score_only, ProfileCache* restrict cache) {
+    const bool filter = task->scoring->threshold != NO_THRESHOLD;
+    if (score_only || filter) {
+        *task->score = align_score_cached(cache, task->seq1, task->len1, task->seq2, task->len2, task->scoring);
+    }
+    if (!score_only && (!filter || *task->score >= task->scoring->threshold)) {
+        *task->result = align_sequences(task->seq1, task->len1, task->seq2, task->len2, task->scoring);
+    }
+}
+
+/* Inter-sequence batching, NUM_ELEMS16 pairs run the same DP recurrence in lockstep, one pair per 16-bit lane
+ * Pairs are bucketed by their longer sequence so a group's padded rectangle stays close to each pair's own,
+ * cells outside a pair's rectangle never feed back into it so ragged lengths need no masking */
+
+#ifdef USE_AVX
+
+#define LANES NUM_ELEMS16
+#define LANE_TABLE (MAX_ALPHABET + 1)
+
+typedef struct {
+    veci_t* matrix;     // one vector per DP cell, lane l holds the cell of the l-th pair in the group
+    veci_t* offsets;    // table row of each seq1 residue, per column
+    veci_t* gaps;       // Gotoh only, the E then the F matrix, allocated by the first Gotoh group
+    veci_t* row_max;    // best cell of each row, after the F matrix
+    size_t* order;
+    size_t* sorted;
+    size_t order_cap;
+    int8_t indices1[LANES][FULL_DP_LEN];
+    int8_t indices2[LANES][FULL_DP_LEN];
+    int table[LANE_TABLE * LANE_TABLE];    // scoring matrix with a zero row and column for unknown residues
+    ProfileCache profile;                  // pairs that do not fit the lanes
+} LaneScratch;
+
+INLINE void lanes_init(LaneScratch* restrict s) {
+    s->matrix = (veci_t*)mat_aligned_alloc(BYTES, sizeof(veci_t) * FULL_DP_CELLS);
+    s->offsets = (veci_t*)mat_aligned_alloc(BYTES, sizeof(veci_t) * (FULL_DP_LEN + 1));
+    s->gaps = s->row_max = NULL;
+    s->order = s->sorted = NULL;
+    s->order_cap = 0;
+    profile_cache_init(&s->profile);
+}
+
+INLINE void lanes_free(LaneScratch* restrict s) {
+    mat_aligned_free(s->matrix);
+    mat_aligned_free(s->offsets);
+    if (s->gaps) mat_aligned_free(s->gaps);
+    free(s->order);
+    free(s->sorted);
+    profile_cache_free(&s->profile);
+}
+
+// Substitution scores for table indices in 16-bit lanes
+INLINE veci_t lane_scores(const int* restrict table, const veci_t index) {
+    #ifdef __AVX2__
+    __m256i lo = _mm256_i32gather_epi32(table, _mm256_cvtepi16_epi32(_mm256_castsi256_si128(index)), 4);
+    __m256i hi = _mm256_i32gather_epi32(table, _mm256_cvtepi16_epi32(_mm256_extracti128_si256(index, 1)), 4);
+    return _mm256_permute4x64_epi64(_mm256_packs_epi32(lo, hi), 0xD8);
+    #else
+    int16_t lanes[LANES] ALIGN;
+    storeu((veci_t*)lanes, index);
+    for (int l = 0; l < LANES; l++) lanes[l] = table[lanes[l]];
+    return loadu((const veci_t*)lanes);
+    #endif
+}
+
+INLINE int16_t lane_at(const veci_t* restrict matrix, const int cols, const int lane, const int i, const int j) {
+    return ((const int16_t*)(matrix + i * cols + j))[lane];
+}
+
+INLINE int16_t lane_cell(const LaneScratch* restrict s, const int cols, const int lane, const int i, const int j) {
+    return lane_at(s->matrix, cols, lane, i, j);
+}
+
+// Same walk and tie-breaking as align_full, reading one lane of the shared matrix
+INLINE void lane_traceback(const LaneScratch* restrict s, const int cols, const int lane,
+                           const AlignTask* restrict task, const int gap) {
+    Alignment* result = task->result;
+    uint8_t ops[ALIGN_BUF];
+    const int8_t* seq1_indices = s->indices1[lane];
+    const int8_t* seq2_indices = s->indices2[lane];
+    int pos = 0;
+    int i = task->len2, j = task->len1;
+
+    while (i > 0 || j > 0) {
+        int curr_score = lane_cell(s, cols, lane, i, j);
+        int move = 0;
+
+        if (i > 0 && j > 0) {
+            int diag_score = lane_cell(s, cols, lane, i - 1, j - 1);
+            int match_score = s->table[(seq1_indices[j - 1] + 1) * LANE_TABLE + seq2_indices[i - 1] + 1];
+            if (curr_score != diag_score + match_score) {
+                move = (curr_score == lane_cell(s, cols, lane, i - 1, j) + gap) ? 1 : 2;
+            }
+        } else {
+            move = (i > 0) ? 1 : 2;
+        }
+
+        if (move) {
+            ops[pos++] = move == 1 ? OP_INSERT : OP_DELETE;
+        } else {
+            ops[pos++] = task->seq1[j - 1] == task->seq2[i - 1] ? OP_MATCH : OP_MISMATCH;
+        }
+
+        i += next_i[move];
+        j += next_j[move];
+    }
+
+    reverse_ops(ops, pos);
+    result->score = lane_cell(s, cols, lane, task->len2, task->len1);
+    finish_alignment(result, ops, pos);
+}
+
+// Where align_gotoh would end the traceback of one lane, see its comment for the order of ties
+INLINE int lane_end(const LaneScratch* restrict s, const int cols, const int lane, const AlignTask* restrict task,
+                    int* end_i, int* end_j) {
+    const int len1 = task->len1, len2 = task->len2;
+    const AlignMode mode = task->scoring->mode;
+    *end_i = len2;
+    *end_j = len1;
+    if (mode == ALIGN_GLOBAL) return lane_cell(s, cols, lane, len2, len1);
+
+    if (mode == ALIGN_LOCAL) {
+        // The first row holding the best cell, then its first column, row 0 is all zeros
+        int best = 0;
+        *end_i = *end_j = 0;
+        for (int i = 1; i <= len2; i++) {
+            const int value = ((const int16_t*)(s->row_max + i))[lane];
+            if (value > best) {
+                best = value;
+                *end_i = i;
+            }
+        }
+        while (*end_i && lane_cell(s, cols, lane, *end_i, *end_j) != best) (*end_j)++;
+        return best;
+    }
+
+    int best = lane_cell(s, cols, lane, len2, len1);
+    for (int i = 0; i < len2; i++) {
+        if (lane_cell(s, cols, lane, i, len1) > best) {
+            best = lane_cell(s, cols, lane, i, len1);
+            *end_i = i;
+        }
+    }
+    for (int j = 0; j < len1; j++) {
+        if (lane_cell(s, cols, lane, len2, j) > best) {
+            best = lane_cell(s, cols, lane, len2, j);
+            *end_i = len2;
+            *end_j = j;
+        }
+    }
+    return best;
+}
+
+// The moves of align_gotoh worked out from the H, E and F values of one lane
+INLINE void lane_traceback_gotoh(const LaneScratch* restrict s, const int cols, const int lane,
+                                 const AlignTask* restrict task) {
+    Alignment* result = task->result;
+    uint8_t ops[ALIGN_BUF];
+    const veci_t* e = s->gaps;
+    const veci_t* f = s->gaps + FULL_DP_CELLS;
+    const int open = open_penalty(task->scoring);
+    const AlignMode mode = task->scoring->mode;
+    const int8_t* seq1_indices = s->indices1[lane];
+    const int8_t* seq2_indices = s->indices2[lane];
+    int pos = 0;
+    int i, j;
+    int state = 0;
+
+    result->score = lane_end(s, cols, lane, task, &i, &j);
+    for (int k = task->len1; mode == ALIGN_SEMIGLOBAL && k > j; k--) ops[pos++] = OP_DELETE;
+    for (int k = task->len2; mode == ALIGN_SEMIGLOBAL && k > i; k--) ops[pos++] = OP_INSERT;
+
+    while (i > 0 || j > 0) {
+        int curr_score = lane_cell(s, cols, lane, i, j);
+        if (!state && mode == ALIGN_LOCAL && curr_score == 0) break;
+        int move = i == 0 ? 2 : j == 0 ? 1 : state;
+
+        if (!move) {
+            int match_score = s->table[(seq1_indices[j - 1] + 1) * LANE_TABLE + seq2_indices[i - 1] + 1];
+            if (curr_score != lane_cell(s, cols, lane, i - 1, j - 1) + match_score) {
+                move = curr_score == lane_at(e, cols, lane, i, j) ? 1 : 2;
+            }
+        }
+
+        if (move == 1) {
+            ops[pos++] = OP_INSERT;
+            state = (j > 0 && lane_at(e, cols, lane, i, j) == lane_cell(s, cols, lane, i - 1, j) + open) ? 0 : 1;
+        } else if (move == 2) {
+            ops[pos++] = OP_DELETE;
+            state = (i > 0 && lane_at(f, cols, lane, i, j) == lane_cell(s, cols, lane, i, j - 1) + open) ? 0 : 2;
+        } else {
+            ops[pos++] = task->seq1[j - 1] == task->seq2[i - 1] ? OP_MATCH : OP_MISMATCH;
+        }
+
+        i += next_i[move];
+        j += next_j[move];
+    }
+    result->start1 = j;
+    result->start2 = i;
+
+    reverse_ops(ops, pos);
+    finish_alignment(result, ops, pos);
+}
+
+// Table offsets of every residue of the group, columns past a pair's seq1 point at the zero row
+INLINE void lane_setup(LaneScratch* restrict s, AlignTask* const* group, const int count, const int cols) {
+    int16_t* offsets = (int16_t*)s->offsets;
+
+    memset(s->offsets, 0, sizeof(veci_t) * cols);
+    for (int l = 0; l < count; l++) {
+        const AlignTask* task = group[l];
+        if (task->indices1) {
+            memcpy(s->indices1[l], task->indices1, task->len1);
+            memcpy(s->indices2[l], task->indices2, task->len2);
+        } else {
+            seq_to_indices8(task->seq1, task->len1, s->indices1[l], task->scoring);
+            seq_to_indices8(task->seq2, task->len2, s->indices2[l], task->scoring);
+        }
+        for (int j = 1; j <= (int)task->len1; j++) {
+            offsets[j * LANES + l] = (s->indices1[l][j - 1] + 1) * LANE_TABLE;
+        }
+    }
+}
+
+/* Aligns up to LANES tasks together, rows are len2, columns len1
+ * Score only groups keep two rows and read each score once its last row is done */
+INLINE void align_group(LaneScratch* restrict s, AlignTask* const* group, const int count,
+                        const int rows, const int cols, const bool score_only) {
+    const int gap = group[0]->scoring->gap_penalty;
+    const veci_t gap_vec = set1_epi16(gap);
+    int16_t row_offsets[LANES] ALIGN;
+
+    lane_setup(s, group, count, cols);
+    memset(row_offsets, 0, sizeof(row_offsets));
+
+    for (int j = 0; j < cols; j++) s->matrix[j] = set1_epi16(j * gap);
+
+    for (int i = 1; i < rows; i++) {
+        veci_t* restrict prev = s->matrix + (score_only ? (i - 1) & 1 : i - 1) * cols;
+        veci_t* restrict curr = s->matrix + (score_only ? i & 1 : i) * cols;
+
+        for (int l = 0; l < count; l++) {
+            row_offsets[l] = i <= (int)group[l]->len2 ? s->indices2[l][i - 1] + 1 : 0;
+        }
+        const veci_t row_offset = loadu((const veci_t*)row_offsets);
+
+        veci_t left = set1_epi16(i * gap);
+        veci_t diag = prev[0];
+        curr[0] = left;
+        for (int j = 1; j < cols; j++) {
+            veci_t up = prev[j];
+            veci_t h = adds_epi16(diag, lane_scores(s->table, adds_epi16(s->offsets[j], row_offset)));
+            h = max_epi16(h, adds_epi16(up, gap_vec));
+            h = max_epi16(h, adds_epi16(left, gap_vec));
+            curr[j] = h;
+            left = h;
+            diag = up;
+        }
+
+        if (score_only) {
+            for (int l = 0; l < count; l++) {
+                if ((int)group[l]->len2 == i) *group[l]->score = ((int16_t*)(curr + group[l]->len1))[l];
+            }
+        }
+    }
+
+    if (score_only) {
+        // Pairs with an empty seq2 end on row 0
+        for (int l = 0; l < count; l++) {
+            if (group[l]->len2 == 0) *group[l]->score = group[l]->len1 * gap;
+        }
+    } else {
+        for (int l = 0; l < count; l++) lane_traceback(s, cols, l, group[l], gap);
+    }
+}
+
+/* align_group with Gotoh's recurrence, E and F are kept per cell next to H for the traceback
+ * Score only groups keep two rows of H, update a single row of E in place and drop
+ * pairs from the group once they end or can no longer reach the threshold */
+INLINE void align_group_gotoh(LaneScratch* restrict s, AlignTask* const* group, const int count,
+                              const int rows, const int cols, const bool score_only) {
+    const ScoringMatrix* scoring = group[0]->scoring;
+    const AlignMode mode = scoring->mode;
+    const bool filter = score_only && scoring->threshold != NO_THRESHOLD;
+    const veci_t open = set1_epi16(open_penalty(scoring));
+    const veci_t extend = set1_epi16(extend_penalty(scoring));
+    const veci_t neg_inf = set1_epi16(INT16_MIN);
+    const veci_t floor = mode == ALIGN_LOCAL ? set1_epi16(0) : neg_inf;
+    int16_t row_offsets[LANES] ALIGN;
+    int16_t row_best[LANES] ALIGN;
+    int best[LANES];    // score only, local: best cell so far, semi-global: best of the last column so far
+    bool active[LANES];
+    int pending = 0;
+
+    if (!s->gaps) s->gaps = (veci_t*)mat_aligned_alloc(BYTES, sizeof(veci_t) * (2 * FULL_DP_CELLS + FULL_DP_LEN + 1));
+    s->row_max = s->gaps + 2 * FULL_DP_CELLS;
+    lane_setup(s, group, count, cols);
+    memset(row_offsets, 0, sizeof(row_offsets));
+
+    for (int j = 0; j < cols; j++) {
+        s->matrix[j] = set1_epi16(edge_cost(scoring, j));
+        s->gaps[j] = neg_inf;
+    }
+    for (int l = 0; l < count; l++) {
+        best[l] = mode == ALIGN_GLOBAL ? INT_MIN : 0;
+        active[l] = group[l]->len2 > 0;
+        pending += active[l];
+        // Pairs with an empty seq2 end on row 0
+        if (score_only && !active[l]) *group[l]->score = edge_cost(scoring, group[l]->len1);
+    }
+
+    for (int i = 1; i < rows && (pending || !score_only); i++) {
+        veci_t* restrict prev = s->matrix + (score_only ? (i - 1) & 1 : i - 1) * cols;
+        veci_t* restrict curr = s->matrix + (score_only ? i & 1 : i) * cols;
+        veci_t* e_prev = s->gaps + (score_only ? 0 : i - 1) * cols;
+        veci_t* e_curr = s->gaps + (score_only ? 0 : i) * cols;
+        veci_t* f_curr = s->gaps + FULL_DP_CELLS + (score_only ? 0 : i) * cols;
+
+        for (int l = 0; l < count; l++) {
+            row_offsets[l] = i <= (int)group[l]->len2 ? s->indices2[l][i - 1] + 1 : 0;
+        }
+        const veci_t row_offset = loadu((const veci_t*)row_offsets);
+
+        veci_t left = set1_epi16(edge_cost(scoring, i));
+        veci_t f = neg_inf;
+        veci_t diag = prev[0];
+        veci_t row_max = left;
+        curr[0] = e_curr[0] = left;
+        f_curr[0] = neg_inf;
+        for (int j = 1; j < cols; j++) {
+            veci_t up = prev[j];
+            veci_t e = max_epi16(adds_epi16(up, open), adds_epi16(e_prev[j], extend));
+            f = max_epi16(adds_epi16(left, open), adds_epi16(f, extend));
+            veci_t h = adds_epi16(diag, lane_scores(s->table, adds_epi16(s->offsets[j], row_offset)));
+            h = max_epi16(h, e);
+            h = max_epi16(h, f);
+            h = max_epi16(h, floor);
+            curr[j] = h;
+            e_curr[j] = e;
+            f_curr[j] = f;
+            row_max = max_epi16(row_max, h);
+            left = h;
+            diag = up;
+        }
+
+        // Cells past a pair's rectangle only copy its cells with a zero score or lower them, so row_max stays a bound
+        if (!score_only) {
+            s->row_max[i] = row_max;
+            continue;
+        }
+
+        storeu((veci_t*)row_best, row_max);
+        for (int l = 0; l < count; l++) {
+            if (!active[l]) continue;
+            const int len1 = group[l]->len1, len2 = group[l]->len2;
+            const int corner = ((int16_t*)(curr + len1))[l];
+            if (mode == ALIGN_LOCAL && row_best[l] > best[l]) best[l] = row_best[l];
+            if (mode == ALIGN_SEMIGLOBAL && corner > best[l]) best[l] = corner;
+
+            if (i == len2) {
+                if (mode == ALIGN_GLOBAL) best[l] = corner;
+                for (int j = 0; mode == ALIGN_SEMIGLOBAL && j < len1; j++) {
+                    if (((int16_t*)(curr + j))[l] > best[l]) best[l] = ((int16_t*)(curr + j))[l];
+                }
+                *group[l]->score = best[l];
+            } else if (filter && best[l] < scoring->threshold &&
+                       reach_bound(scoring, row_best[l], len2 - i) < scoring->threshold) {
+                *group[l]->score = SCORE_DISCARDED;
+            } else {
+                continue;
+            }
+            active[l] = false;
+            pending--;
+        }
+    }
+
+    if (!score_only) {
+        for (int l = 0; l < count; l++) lane_traceback_gotoh(s, cols, l, group[l]);
+    }
+}
+
+INLINE bool lane_fits(const AlignTask* restrict task, const ScoringMatrix* restrict scoring) {
+    return task->len1 <= FULL_DP_LEN && task->len2 <= FULL_DP_LEN && task->scoring == scoring &&
+           striped_fits(task->len1, task->len2, scoring);
+}
+
+// Stable counting sort of the task indices in `in` by len1 or len2
+INLINE void sort_by_len(const AlignTask* tasks, const size_t* restrict in, size_t* restrict out,
+                        const size_t count, const bool by_len1) {
+    size_t buckets[FULL_DP_LEN + 2] = {0};
+    for (size_t k = 0; k < count; k++) {
+        buckets[(by_len1 ? tasks[in[k]].len1 : tasks[in[k]].len2) + 1]++;
+    }
+    for (int b = 1; b <= FULL_DP_LEN + 1; b++) buckets[b] += buckets[b - 1];
+    for (size_t k = 0; k < count; k++) {
+        out[buckets[by_len1 ? tasks[in[k]].len1 : tasks[in[k]].len2]++] = in[k];
+    }
+}
+
+// Runs the first count tasks of s->sorted in groups of LANES
+INLINE void align_groups(LaneScratch* restrict s, AlignTask* tasks, const size_t count, const bool score_only) {
+    const ScoringMatrix* scoring = tasks[s->sorted[0]].scoring;
+    const bool gotoh = !linear_engine(scoring) || (score_only && scoring->threshold != NO_THRESHOLD);
+    AlignTask* group[LANES];
+    for (size_t g = 0; g < count; g += LANES) {
+        const int group_count = count - g < LANES ? count - g : LANES;
+        int rows = 1, cols = 1;
+        for (int l = 0; l < group_count; l++) {
+            group[l] = &tasks[s->sorted[g + l]];
+            if ((int)group[l]->len2 + 1 > rows) rows = group[l]->len2 + 1;
+            if ((int)group[l]->len1 + 1 > cols) cols = group[l]->len1 + 1;
+        }
+        if (gotoh) {
+            align_group_gotoh(s, group, group_count, rows, cols, score_only);
+        } else {
+            align_group(s, group, group_count, rows, cols, score_only);
+        }
+    }
+}
+
+INLINE void align_tasks(LaneScratch* restrict s, AlignTask* tasks, const size_t start, const size_t end,
+                        const bool score_only) {
+    if (start >= end) return;
+    const size_t count = end - start;
+    if (count > s->order_cap) {
+        free(s->order);
+        free(s->sorted);
+        s->order_cap = count;
+        s->order = (size_t*)malloc(sizeof(size_t) * count);
+        s->sorted = (size_t*)malloc(sizeof(size_t) * count);
+    }
+
+    /* Pairs that do not fit the lanes are aligned one at a time in task order, so runs of tasks sharing a seq1
+     * reuse its profile, the rest are sorted by len1 then len2 */
+    const ScoringMatrix* scoring = tasks[start].scoring;
+    size_t batched = 0;
+    profile_cache_reset(&s->profile);
+    for (size_t t = start; t < end; t++) {
+        if (lane_fits(&tasks[t], scoring)) {
+            s->sorted[batched++] = t;
+        } else {
+            align_task(&tasks[t], score_only, &s->profile);
+        }
+    }
+    if (!batched) return;
+    sort_by_len(tasks, s->sorted, s->order, batched, false);
+    sort_by_len(tasks, s->order, s->sorted, batched, true);
+
+    for (int r = 0; r < LANE_TABLE; r++) {
+        for (int c = 0; c < LANE_TABLE; c++) {
+            s->table[r * LANE_TABLE + c] = (r && c) ? scoring->matrix[r - 1][c - 1] : 0;
+        }
+    }
+
+    // Same as align_task, the pairs that reach the threshold keep their order and are grouped again
+    if (!score_only && scoring->threshold != NO_THRESHOLD) {
+        align_groups(s, tasks, batched, true);
+        size_t kept = 0;
+        for (size_t k = 0; k < batched; k++) {
+            if (*tasks[s->sorted[k]].score >= scoring->threshold) s->sorted[kept++] = s->sorted[k];
+        }
+        batched = kept;
+    }
+    align_groups(s, tasks, batched, score_only);
+}
+
+#else
+
+typedef struct {
+    ProfileCache profile;
+} LaneScratch;
+
+INLINE void lanes_init(LaneScratch* restrict s) {
+    profile_cache_init(&s->profile);
+}
+
+INLINE void lanes_free(LaneScratch* restrict s) {
+    profile_cache_free(&s->profile);
+}
+
+INLINE void align_tasks(LaneScratch* restrict s, AlignTask* tasks, const size_t start, const size_t end,
+                        const bool score_only) {
+    profile_cache_reset(&s->profile);
+    for (size_t t = start; t < end; t++) align_task(&tasks[t], score_only, &s->profile);
+}
+
+#endif
+
+#endif
@@ -14,7 +14,17 @@
 #include <Shlwapi.h>
 #endif
 
+#include <synchapi.h>
+
 typedef HANDLE pthread_t;
+#define pthread_create(t, _, sr, a) (void)(*t = CreateThread(NULL, 0, (LPTHREAD_START_ROUTINE)sr, a, 0, NULL))
+#define pthread_join(t, _) WaitForSingleObject(t, INFINITE)
+
+typedef HANDLE sem_t;
+#define sem_init(sem, _, value) *sem = CreateSemaphore(NULL, value, LONG_MAX, NULL)
+#define sem_post(sem) ReleaseSemaphore(*sem, 1, NULL)
+#define sem_wait(sem) WaitForSingleObject(*sem, INFINITE)
+#define sem_destroy(sem) CloseHandle(*sem)
 
 #define T_Func DWORD WINAPI
 #define T_Ret(x) return (DWORD)(size_t)(x)
@@ -40,6 +50,8 @@ typedef HANDLE pthread_t;
 #include <sys/stat.h>
 #include <sys/sysinfo.h>
 #include <pthread.h>
+#include <semaphore.h>
+#include <errno.h>
 
 #define T_Func void*
 #define T_Ret(x) return (x)
@@ -116,6 +128,13 @@ typedef HANDLE pthread_t;
     #define setzero_si _mm256_setzero_si256
     #define and_si _mm256_and_si256
     #define setr_indicies _mm256_setr_epi32(1,2,3,4,5,6,7,8)
+    #define NUM_ELEMS16 (16)
+    #define adds_epi16 _mm256_adds_epi16
+    #define max_epi16 _mm256_max_epi16
+    #define cmpgt_epi16 _mm256_cmpgt_epi16
+    #define set1_epi16 _mm256_set1_epi16
+    // Moves every 16-bit lane up by one across the whole register and puts x in lane 0
+    #define shift_in_epi16(v, x) _mm256_insert_epi16(_mm256_alignr_epi8((v), _mm256_permute2x128_si256((v), (v), 0x08), 14), (x), 0)
 #elif defined(__SSE2__)
     #define USE_AVX
     typedef __m128i veci_t;
@@ -135,6 +154,12 @@ typedef HANDLE pthread_t;
     #define setzero_si _mm_setzero_si128
     #define and_si _mm_and_si128
     #define setr_indicies _mm_setr_epi32(1,2,3,4)
+    #define NUM_ELEMS16 (8)
+    #define adds_epi16 _mm_adds_epi16
+    #define max_epi16 _mm_max_epi16
+    #define cmpgt_epi16 _mm_cmpgt_epi16
+    #define set1_epi16 _mm_set1_epi16
+    #define shift_in_epi16(v, x) _mm_insert_epi16(_mm_slli_si128((v), 2), (x), 0)
 #endif
 
 #endif
\ No newline at end of file
@@ -0,0 +1,218 @@
+#ifndef RESULT_CACHE_H
+#define RESULT_CACHE_H
+
+#include "lanes.h"
+
+/* Results of pairs that were already aligned, looked up by the residues of both sequences so pairs repeated in the
+ * input (the large dataset is avpdb.csv over and over, exports repeat peptides) are copied instead of aligned again
+ * Sets of CACHE_WAYS entries with CLOCK eviction inside each set keep memory at RESULT_CACHE_MB, the sets are
+ * spread over CACHE_SHARDS locks so threads rarely wait on each other
+ * A pair is only kept once it missed twice, so inputs without repeats pay a lookup per pair and nothing more */
+
+#define CACHE_WAYS (8)
+#define CACHE_SHARDS (64)
+#define CACHE_KEY_LEN (2 * MAX_SEQ_LEN)    // pairs with more residues in total are always aligned
+#define CACHE_SEEN_BITS (128)
+#define CACHE_PREFETCH (16)    // tasks ahead whose set is prefetched
+
+// Everything a lookup reads besides the entry it finds, in one cache line
+typedef struct {
+    uint32_t tags[CACHE_WAYS];    // high half of the pair hash of every way, 0 when empty
+    uint64_t seen[CACHE_SEEN_BITS / 64];    // pairs of this set that missed once, cleared once half full
+    uint8_t referenced;    // bit per way, set by hits and cleared as the hand passes it
+    uint8_t hand;
+} ALIGN CacheSet;
+
+// Lookups and hits are only counted under the lock
+typedef struct {
+    int locked;
+    size_t lookups;
+    size_t hits;
+} ALIGN CacheShard;
+
+// Followed by the Alignment when alignments are kept, then the residues of seq1 and seq2
+typedef struct {
+    int score;
+    uint32_t len1;
+    uint32_t len2;
+} CacheEntry;
+
+#define CACHE_RESULT_OFFSET ((sizeof(CacheEntry) + 7) & ~(size_t)7)
+
+typedef struct {
+    CacheSet* sets;    // NULL when the cache is off
+    char* entries;
+    size_t set_mask;
+    size_t stride;
+    bool alignments;    // full results are kept, score only runs keep the score alone
+    void* arena;
+    size_t arena_size;
+    CacheShard shards[CACHE_SHARDS];
+} ResultCache;
+
+static ResultCache g_results;
+
+// Leaves the cache off when size_mb is 0 or its pages cannot be mapped
+INLINE void open_result_cache(ResultCache* cache, const size_t size_mb, const bool alignments) {
+    if (!size_mb) return;
+    cache->alignments = alignments;
+    cache->stride = (CACHE_RESULT_OFFSET + (alignments ? sizeof(Alignment) : 0) + CACHE_KEY_LEN + 7) & ~(size_t)7;
+    const size_t set_size = sizeof(CacheSet) + CACHE_WAYS * cache->stride;
+    // Number of sets is the largest power of two that fits size_mb, at least one
+    size_t count = 1;
+    while (2 * count * set_size <= size_mb * MiB) count *= 2;
+
+    // Fresh pages are zero, so every way starts out empty
+    cache->arena_size = count * set_size;
+    cache->arena = arena_alloc(cache->arena_size);
+    if (!cache->arena) return;
+    cache->sets = (CacheSet*)cache->arena;
+    cache->entries = (char*)(cache->sets + count);
+    cache->set_mask = count - 1;
+}
+
+// Prints the hit rate once the run is done
+INLINE void close_result_cache(ResultCache* cache) {
+    if (!cache->sets) return;
+    size_t lookups = 0, hits = 0;
+    for (int s = 0; s < CACHE_SHARDS; s++) {
+        lookups += cache->shards[s].lookups;
+        hits += cache->shards[s].hits;
+    }
+    printf("Result cache: %zu of %zu pairs reused (%.1f%%)\n", hits, lookups, lookups ? 100.0 * hits / lookups : 0.0);
+    arena_free(cache->arena, cache->arena_size);
+    cache->sets = NULL;
+}
+
+INLINE uint64_t hash_residues(const char* data, size_t len, uint64_t hash) {
+    uint64_t word;
+    for (; len >= sizeof(word); data += sizeof(word), len -= sizeof(word)) {
+        memcpy(&word, data, sizeof(word));
+        hash = (hash ^ word) * 0x9E3779B97F4A7C15ULL;
+        hash ^= hash >> 32;
+    }
+    word = 0;
+    memcpy(&word, data, len);
+    hash = (hash ^ word) * 0x9E3779B97F4A7C15ULL;
+    return hash ^ (hash >> 29);
+}
+
+// Hash of both sequences and their lengths, 0 for pairs too long to be kept
+// The low bits pick the set, the high half is the tag and the bits below it the seen bit
+INLINE uint64_t pair_hash(const AlignTask* restrict task) {
+    if (task->len1 + task->len2 > CACHE_KEY_LEN) return 0;
+    uint64_t hash = hash_residues(task->seq1, task->len1, (task->len1 << 32 | task->len2) * 0xFF51AFD7ED558CCDULL);
+    hash = hash_residues(task->seq2, task->len2, hash);
+    return hash | 1ULL << 32;
+}
+
+INLINE uint32_t hash_tag(const uint64_t hash) {
+    return (uint32_t)(hash >> 32);
+}
+
+INLINE CacheEntry* cache_entry(const ResultCache* cache, const size_t set, const int way) {
+    return (CacheEntry*)(cache->entries + (set * CACHE_WAYS + way) * cache->stride);
+}
+
+INLINE Alignment* entry_result(CacheEntry* entry) {
+    return (Alignment*)((char*)entry + CACHE_RESULT_OFFSET);
+}
+
+INLINE char* entry_key(const ResultCache* cache, CacheEntry* entry) {
+    return (char*)entry + CACHE_RESULT_OFFSET + (cache->alignments ? sizeof(Alignment) : 0);
+}
+
+// Equal hashes are not enough, the residues are compared as well
+INLINE bool entry_matches(const ResultCache* cache, CacheEntry* entry, const AlignTask* restrict task) {
+    const char* key = entry_key(cache, entry);
+    return entry->len1 == task->len1 && entry->len2 == task->len2 && !memcmp(key, task->seq1, task->len1) &&
+           !memcmp(key + task->len1, task->seq2, task->len2);
+}
+
+INLINE void lock_shard(CacheShard* shard) {
+    while (__atomic_exchange_n(&shard->locked, 1, __ATOMIC_ACQUIRE)) {
+        while (__atomic_load_n(&shard->locked, __ATOMIC_RELAXED)) _mm_pause();
+    }
+}
+
+INLINE void unlock_shard(CacheShard* shard) {
+    __atomic_store_n(&shard->locked, 0, __ATOMIC_RELEASE);
+}
+
+// Way of the set holding the pair, -1 if there is none
+INLINE int find_way(const ResultCache* cache, const size_t set, const uint64_t hash, const AlignTask* restrict task) {
+    for (int way = 0; way < CACHE_WAYS; way++) {
+        if (cache->sets[set].tags[way] == hash_tag(hash) && entry_matches(cache, cache_entry(cache, set, way), task)) return way;
+    }
+    return -1;
+}
+
+// Copies the result of an equal pair into the task, false if the cache has none
+INLINE bool result_cache_get(ResultCache* cache, const uint64_t hash, const AlignTask* restrict task) {
+    if (!hash || !cache->sets) return false;
+    const size_t set = hash & cache->set_mask;
+    CacheShard* shard = &cache->shards[set % CACHE_SHARDS];
+
+    lock_shard(shard);
+    shard->lookups++;
+    const int way = find_way(cache, set, hash, task);
+    if (way >= 0) {
+        CacheEntry* entry = cache_entry(cache, set, way);
+        if (cache->alignments) *task->result = *entry_result(entry);
+        *task->score = entry->score;
+        cache->sets[set].referenced |= 1 << way;
+        shard->hits++;
+    }
+    unlock_shard(shard);
+    return way >= 0;
+}
+
+/* Keeps the result of an aligned task the second time it misses, the first miss only marks it as seen
+ * An empty way is used first, then the first one the hand finds unreferenced */
+INLINE void result_cache_put(ResultCache* cache, const uint64_t hash, const AlignTask* restrict task) {
+    if (!hash || !cache->sets) return;
+    const size_t set = hash & cache->set_mask;
+    CacheShard* shard = &cache->shards[set % CACHE_SHARDS];
+    CacheSet* bucket = &cache->sets[set];
+    const int seen_bit = (hash >> 25) % CACHE_SEEN_BITS;
+    uint64_t* seen = &bucket->seen[seen_bit / 64];
+
+    lock_shard(shard);
+    if (!(*seen & 1ULL << (seen_bit % 64))) {
+        int marked = 0;
+        for (int w = 0; w < CACHE_SEEN_BITS / 64; w++) marked += __builtin_popcountll(bucket->seen[w]);
+        if (marked >= CACHE_SEEN_BITS / 2) memset(bucket->seen, 0, sizeof(bucket->seen));
+        *seen |= 1ULL << (seen_bit % 64);
+        unlock_shard(shard);
+        return;
+    }
+    // Another thread may have aligned the same pair meanwhile
+    if (find_way(cache, set, hash, task) >= 0) {
+        unlock_shard(shard);
+        return;
+    }
+    int way = 0;
+    while (way < CACHE_WAYS && bucket->tags[way]) way++;
+    if (way == CACHE_WAYS) {
+        while (bucket->referenced & (1 << bucket->hand)) {
+            bucket->referenced &= ~(1 << bucket->hand);
+            bucket->hand = (bucket->hand + 1) % CACHE_WAYS;
+        }
+        way = bucket->hand;
+        bucket->hand = (bucket->hand + 1) % CACHE_WAYS;
+    }
+
+    CacheEntry* entry = cache_entry(cache, set, way);
+    entry->score = *task->score;
+    entry->len1 = task->len1;
+    entry->len2 = task->len2;
+    if (cache->alignments) *entry_result(entry) = *task->result;
+    char* key = entry_key(cache, entry);
+    memcpy(key, task->seq1, task->len1);
+    memcpy(key + task->len1, task->seq2, task->len2);
+    bucket->tags[way] = hash_tag(hash);
+    bucket->referenced &= ~(1 << way);
+    unlock_shard(shard);
+}
+
+#endif
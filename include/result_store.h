@@ -0,0 +1,358 @@
+#ifndef RESULT_STORE_H
+#define RESULT_STORE_H
+
+#include "config.h"
+#include "result_cache.h"
+
+/* Results of earlier runs kept in RESULT_STORE_FILE, so rerunning an input that only grew aligns the new pairs alone
+ * The file is a header followed by records appended in the order pairs were aligned, each record holds the pair
+ * hash, a fingerprint of the scoring settings, the result and the residues of both sequences
+ * Records of the file are mapped and indexed once when the run starts, records aligned during the run are only
+ * appended, repeats inside a run are what the result cache is for */
+
+#define STORE_MAGIC "SEQALNRS"
+#define STORE_VERSION (1)
+#define STORE_HEADER_SIZE (64)
+#define STORE_RECORD_MAX (sizeof(StoreRecord) + sizeof(Alignment) + CACHE_KEY_LEN + 7)
+
+// Results are copied in and out as they are, so the layout has to match the build reading them
+typedef struct {
+    char magic[8];
+    uint32_t version;
+    uint32_t max_seq_len;
+    uint32_t alignment_size;
+} StoreHeader;
+
+// Followed by the Alignment when it has one, then the residues of seq1 and seq2, padded to 8 bytes
+typedef struct {
+    uint64_t hash;      // pair_hash of the residues
+    uint64_t params;    // scoring_fingerprint of the settings it was aligned with
+    int32_t score;
+    uint16_t len1;
+    uint16_t len2;
+    uint32_t alignment;    // 1 when the full Alignment follows, score only runs keep the score alone
+    uint32_t size;
+} StoreRecord;
+
+typedef struct {
+    char* data;    // file as it was when the run started, NULL when it was empty
+    size_t size;
+    #ifdef _WIN32
+    HANDLE hFile;
+    HANDLE hMapping;
+    #else
+    int fd;
+    #endif
+    uint64_t* slots;    // open addressing over the usable records, offset + 1 per slot and 0 when empty
+    size_t slot_mask;
+    uint64_t params;
+    bool alignments;
+    FILE* out;    // NULL when the store is off
+    CacheShard shard;    // guards appends and counts lookups and hits
+    size_t records;
+    size_t added;
+} ResultStore;
+
+static ResultStore g_store;
+
+// Substitution matrix, gaps, mode and threshold, everything the result of a pair depends on besides its residues
+INLINE uint64_t scoring_fingerprint(const ScoringMatrix* scoring) {
+    const int settings[] = {
+        scoring->size, scoring->gap_penalty, scoring->gap_open, scoring->gap_extend,
+        scoring->affine, scoring->mode, scoring->threshold
+    };
+    uint64_t hash = hash_residues((const char*)settings, sizeof(settings), STORE_VERSION);
+    hash = hash_residues(scoring->alphabet, scoring->size, hash);
+    for (int i = 0; i < scoring->size; i++) {
+        hash = hash_residues((const char*)scoring->matrix[i], sizeof(int) * scoring->size, hash);
+    }
+    return hash;
+}
+
+INLINE size_t store_slot_hash(const uint64_t hash) {
+    return (size_t)(hash * 0xFF51AFD7ED558CCDULL >> 20);
+}
+
+INLINE StoreRecord* store_record(const ResultStore* store, const uint64_t offset) {
+    return (StoreRecord*)(store->data + offset);
+}
+
+INLINE char* record_key(StoreRecord* record) {
+    return (char*)(record + 1) + (record->alignment ? sizeof(Alignment) : 0);
+}
+
+INLINE bool record_matches(StoreRecord* record, const uint64_t hash, const char* seq1, const size_t len1,
+                           const char* seq2, const size_t len2) {
+    const char* key = record_key(record);
+    return record->hash == hash && record->len1 == len1 && record->len2 == len2 && !memcmp(key, seq1, len1) &&
+           !memcmp(key + len1, seq2, len2);
+}
+
+// Slot holding the pair, or the empty slot it would go in
+INLINE uint64_t* store_slot(const ResultStore* store, const uint64_t hash, const char* seq1, const size_t len1,
+                            const char* seq2, const size_t len2) {
+    size_t slot = store_slot_hash(hash) & store->slot_mask;
+    while (store->slots[slot]) {
+        if (record_matches(store_record(store, store->slots[slot] - 1), hash, seq1, len1, seq2, len2)) break;
+        slot = (slot + 1) & store->slot_mask;
+    }
+    return &store->slots[slot];
+}
+
+// Slots stay at most half full
+INLINE void grow_store_slots(ResultStore* store) {
+    const uint64_t* old = store->slots;
+    const size_t old_count = store->slot_mask + 1;
+    store->slot_mask = 2 * old_count - 1;
+    store->slots = (uint64_t*)calloc(store->slot_mask + 1, sizeof(uint64_t));
+    for (size_t s = 0; s < old_count; s++) {
+        if (!old[s]) continue;
+        StoreRecord* record = store_record(store, old[s] - 1);
+        const char* key = record_key(record);
+        *store_slot(store, record->hash, key, record->len1, key + record->len1, record->len2) = old[s];
+    }
+    free((void*)old);
+}
+
+INLINE void map_store(ResultStore* store, const char* path) {
+    #ifdef _WIN32
+    store->hFile = CreateFileA(path, GENERIC_READ, FILE_SHARE_READ | FILE_SHARE_WRITE, NULL, OPEN_EXISTING,
+                               FILE_ATTRIBUTE_NORMAL, NULL);
+    if (store->hFile == INVALID_HANDLE_VALUE) return;
+    LARGE_INTEGER file_size;
+    GetFileSizeEx(store->hFile, &file_size);
+    store->size = file_size.QuadPart;
+    if (store->size) {
+        store->hMapping = CreateFileMapping(store->hFile, NULL, PAGE_READONLY, 0, 0, NULL);
+        if (!store->hMapping) config_error("Cannot map result store ", path);
+        store->data = (char*)MapViewOfFile(store->hMapping, FILE_MAP_READ, 0, 0, 0);
+    }
+    #else
+    store->fd = open(path, O_RDONLY);
+    if (store->fd < 0) return;
+    struct stat sb;
+    fstat(store->fd, &sb);
+    store->size = sb.st_size;
+    if (store->size) {
+        store->data = mmap(NULL, store->size, PROT_READ, MAP_PRIVATE, store->fd, 0);
+        if (store->data == MAP_FAILED) config_error("Cannot map result store ", path);
+    }
+    #endif
+}
+
+INLINE void unmap_store(ResultStore* store) {
+    #ifdef _WIN32
+    if (store->data) UnmapViewOfFile(store->data);
+    if (store->hMapping) CloseHandle(store->hMapping);
+    if (store->hFile != INVALID_HANDLE_VALUE) CloseHandle(store->hFile);
+    #else
+    if (store->data) munmap(store->data, store->size);
+    if (store->fd >= 0) close(store->fd);
+    #endif
+    store->data = NULL;
+}
+
+// Size of the complete records, the last one is cut short when an earlier run was stopped while appending
+INLINE size_t index_store(ResultStore* store, const char* path) {
+    const StoreHeader* header = (const StoreHeader*)store->data;
+    if (store->size < STORE_HEADER_SIZE || memcmp(header->magic, STORE_MAGIC, sizeof(header->magic))) {
+        config_error("Not a result store file ", path);
+    }
+    if (header->version != STORE_VERSION || header->max_seq_len != MAX_SEQ_LEN ||
+        header->alignment_size != sizeof(Alignment)) {
+        config_error("Result store was written by a different build (MAX_SEQ_LEN or version), ", path);
+    }
+
+    size_t offset = STORE_HEADER_SIZE;
+    while (offset + sizeof(StoreRecord) <= store->size) {
+        StoreRecord* record = store_record(store, offset);
+        const size_t result_size = record->alignment ? sizeof(Alignment) : 0;
+        if (record->size < sizeof(StoreRecord) + result_size + record->len1 + record->len2 ||
+            offset + record->size > store->size) {
+            break;
+        }
+        // Records of other settings stay in the file, score only records do not help runs that need alignments
+        if (record->params == store->params && (record->alignment || !store->alignments)) {
+            const char* key = record_key(record);
+            uint64_t* slot = store_slot(store, record->hash, key, record->len1, key + record->len1, record->len2);
+            if (!*slot) store->records++;
+            *slot = offset + 1;
+            if (2 * store->records > store->slot_mask) grow_store_slots(store);
+        }
+        offset += record->size;
+    }
+    return offset;
+}
+
+INLINE void truncate_store(const char* path, const size_t size) {
+    #ifdef _WIN32
+    HANDLE file = CreateFileA(path, GENERIC_WRITE, 0, NULL, OPEN_EXISTING, FILE_ATTRIBUTE_NORMAL, NULL);
+    LARGE_INTEGER end = {.QuadPart = (LONGLONG)size};
+    if (file == INVALID_HANDLE_VALUE || !SetFilePointerEx(file, end, NULL, FILE_BEGIN) || !SetEndOfFile(file)) {
+        config_error("Cannot repair result store ", path);
+    }
+    CloseHandle(file);
+    #else
+    if (truncate(path, size) != 0) config_error("Cannot repair result store ", path);
+    #endif
+}
+
+// Indexes the records usable with these settings and opens the file for appending, nothing when path is empty
+INLINE void open_result_store(ResultStore* store, const char* path, const ScoringMatrix* scoring,
+                              const bool alignments) {
+    if (!path[0]) return;
+    store->params = scoring_fingerprint(scoring);
+    store->alignments = alignments;
+    store->slot_mask = 1023;
+    store->slots = (uint64_t*)calloc(store->slot_mask + 1, sizeof(uint64_t));
+
+    map_store(store, path);
+    if (store->size) {
+        const size_t valid = index_store(store, path);
+        if (valid < store->size) {
+            printf("Result store: dropping %zu bytes of an incomplete record\n", store->size - valid);
+            unmap_store(store);
+            truncate_store(path, valid);
+            store->records = 0;
+            memset(store->slots, 0, sizeof(uint64_t) * (store->slot_mask + 1));
+            map_store(store, path);
+            index_store(store, path);
+        }
+    }
+
+    store->out = fopen(path, "ab");
+    if (!store->out) config_error("Cannot open result store ", path);
+    if (!store->size) {
+        char header[STORE_HEADER_SIZE] = {0};
+        StoreHeader* fields = (StoreHeader*)header;
+        memcpy(fields->magic, STORE_MAGIC, sizeof(fields->magic));
+        fields->version = STORE_VERSION;
+        fields->max_seq_len = MAX_SEQ_LEN;
+        fields->alignment_size = sizeof(Alignment);
+        fwrite(header, 1, sizeof(header), store->out);
+    }
+}
+
+// Prints how many pairs came from the file once the run is done
+INLINE void close_result_store(ResultStore* store) {
+    if (!store->out) return;
+    printf("Result store: %zu of %zu pairs read from file, %zu added\n", store->shard.hits, store->shard.lookups,
+           store->added);
+    if (fclose(store->out) != 0) config_error("Cannot write result store ", g_config.result_store_file);
+    store->out = NULL;
+    unmap_store(store);
+    free(store->slots);
+}
+
+// Copies the result of the pair from the file into the task, false if no earlier run aligned it
+INLINE bool result_store_get(const ResultStore* store, const uint64_t hash, const AlignTask* restrict task) {
+    if (!hash || !store->records) return false;
+    const uint64_t offset = *store_slot(store, hash, task->seq1, task->len1, task->seq2, task->len2);
+    if (!offset) return false;
+    StoreRecord* record = store_record(store, offset - 1);
+    if (store->alignments) memcpy(task->result, record + 1, sizeof(Alignment));
+    *task->score = record->score;
+    return true;
+}
+
+// Writes the record of an aligned task to out and returns its size, 0 for pairs too long to be kept
+INLINE size_t pack_record(const ResultStore* store, char* out, const uint64_t hash, const AlignTask* restrict task) {
+    if (!hash) return 0;
+    StoreRecord* record = (StoreRecord*)out;
+    const size_t result_size = store->alignments ? sizeof(Alignment) : 0;
+    *record = (StoreRecord){
+        .hash = hash,
+        .params = store->params,
+        .score = *task->score,
+        .len1 = (uint16_t)task->len1,
+        .len2 = (uint16_t)task->len2,
+        .alignment = store->alignments,
+        .size = (uint32_t)((sizeof(StoreRecord) + result_size + task->len1 + task->len2 + 7) & ~(size_t)7)
+    };
+    char* key = (char*)(record + 1);
+    if (result_size) memcpy(key, task->result, result_size);
+    key += result_size;
+    memcpy(key, task->seq1, task->len1);
+    memcpy(key + task->len1, task->seq2, task->len2);
+    memset(key + task->len1 + task->len2, 0, out + record->size - (key + task->len1 + task->len2));
+    return record->size;
+}
+
+// Appends packed records and counts the lookups that led to them, once per call so threads rarely wait
+INLINE void result_store_append(ResultStore* store, const char* records, const size_t size, const size_t added,
+                                const size_t lookups, const size_t hits) {
+    lock_shard(&store->shard);
+    if (size && fwrite(records, 1, size, store->out) != size) {
+        config_error("Cannot write result store ", g_config.result_store_file);
+    }
+    store->added += added;
+    store->shard.lookups += lookups;
+    store->shard.hits += hits;
+    unlock_shard(&store->shard);
+}
+
+// Tasks the caches could not answer and the records of their results, per thread and only growing
+typedef struct {
+    AlignTask* tasks;
+    uint64_t* hashes;
+    size_t capacity;
+    char* records;
+} CacheMisses;
+
+INLINE void free_cache_misses(CacheMisses* misses) {
+    free(misses->tasks);
+    free(misses->hashes);
+    free(misses->records);
+    *misses = (CacheMisses){0};
+}
+
+/* align_tasks behind g_results and g_store, pairs either one holds are copied and the rest are aligned together in
+ * their original order, then kept in both, the copied tasks still point at the caller's results */
+INLINE void align_tasks_cached(LaneScratch* restrict s, CacheMisses* restrict misses, AlignTask* tasks,
+                               const size_t start, const size_t end, const bool score_only) {
+    if (!g_results.sets && !g_store.out) {
+        align_tasks(s, tasks, start, end, score_only);
+        return;
+    }
+    if (end - start > misses->capacity) {
+        free_cache_misses(misses);
+        misses->capacity = end - start;
+        misses->tasks = (AlignTask*)malloc(sizeof(AlignTask) * misses->capacity);
+        misses->hashes = (uint64_t*)malloc(sizeof(uint64_t) * misses->capacity);
+        if (g_store.out) misses->records = (char*)malloc(STORE_RECORD_MAX * misses->capacity);
+    }
+
+    // Sets are prefetched a few tasks ahead, misses are compacted over the hashes already looked up
+    uint64_t* hashes = misses->hashes;
+    for (size_t t = start; t < end; t++) hashes[t - start] = pair_hash(&tasks[t]);
+    size_t count = 0, stored = 0;
+    for (size_t t = start; t < end; t++) {
+        if (g_results.sets && t + CACHE_PREFETCH < end) {
+            PREFETCH(&g_results.sets[hashes[t + CACHE_PREFETCH - start] & g_results.set_mask]);
+        }
+        const uint64_t hash = hashes[t - start];
+        if (result_cache_get(&g_results, hash, &tasks[t])) continue;
+        if (result_store_get(&g_store, hash, &tasks[t])) {
+            stored++;
+            continue;
+        }
+        misses->tasks[count] = tasks[t];
+        hashes[count++] = hash;
+    }
+    align_tasks(s, misses->tasks, 0, count, score_only);
+
+    size_t size = 0, added = 0;
+    for (size_t k = 0; k < count; k++) {
+        if (g_results.sets && k + CACHE_PREFETCH < count) {
+            PREFETCH(&g_results.sets[hashes[k + CACHE_PREFETCH] & g_results.set_mask]);
+        }
+        result_cache_put(&g_results, hashes[k], &misses->tasks[k]);
+        if (g_store.out && hashes[k]) {
+            size += pack_record(&g_store, misses->records + size, hashes[k], &misses->tasks[k]);
+            added++;
+        }
+    }
+    if (g_store.out) result_store_append(&g_store, misses->records, size, added, count + stored, stored);
+}
+
+#endif
@@ -5,13 +5,32 @@
 
 static const char AMINO_ACIDS[] = "ARNDCQEGHILKMFPSTWYV";
 
+#define MAX_MATRIX_LINE (1024)
+
 #ifdef USE_AVX
 static veci_t FIRST_ROW_INDICES;
-static veci_t GAP_PENALTY_VEC;
 #endif
 
-static int AMINO_LOOKUP[SCHAR_MAX + 1];
+// Lookup and score range of the matrix, once its alphabet, size and scores are set
+INLINE void finish_matrix(ScoringMatrix* restrict matrix) {
+    memset(matrix->lookup, -1, sizeof(matrix->lookup));
+    memset(matrix->columns, 0, sizeof(matrix->columns));
+    for (int i = 0; i < matrix->size; i++) {
+        matrix->lookup[(unsigned char)matrix->alphabet[i]] = i;
+        for (int j = 0; j < matrix->size; j++) matrix->columns[j][i + 1] = matrix->matrix[i][j];
+    }
+
+    matrix->min_score = matrix->max_score = matrix->matrix[0][0];
+    for (int i = 0; i < matrix->size; i++) {
+        for (int j = 0; j < matrix->size; j++) {
+            int value = matrix->matrix[i][j];
+            if (value < matrix->min_score) matrix->min_score = value;
+            if (value > matrix->max_score) matrix->max_score = value;
+        }
+    }
+}
 
+// Built in BLOSUM50, load_matrix replaces it
 INLINE void init_scoring_matrix(ScoringMatrix* restrict matrix) {
     const int blosum50[20][20] = {
         { 5,-2,-1,-2,-1,-1,-1, 0,-2,-1,-2,-1,-1,-3,-1, 1, 0,-3,-2, 0}, // A
@@ -35,20 +54,162 @@ INLINE void init_scoring_matrix(ScoringMatrix* restrict matrix) {
         {-2,-1,-2,-3,-3,-1,-2,-3, 2,-1,-1,-2, 0, 4,-3,-2,-2, 2, 8,-1}, // Y
         { 0,-3,-3,-4,-1,-3,-3,-4,-4, 4, 1,-3, 1,-1,-3,-2, 0,-3,-1, 5}};// V
     
-    memcpy(matrix->matrix, blosum50, sizeof(blosum50));
+    memset(matrix->matrix, 0, sizeof(matrix->matrix));
+    for (int i = 0; i < 20; i++) memcpy(matrix->matrix[i], blosum50[i], sizeof(blosum50[i]));
+    memcpy(matrix->alphabet, AMINO_ACIDS, sizeof(AMINO_ACIDS));
+    matrix->size = 20;
+    finish_matrix(matrix);
+    matrix->gap_penalty = GAP_PENALTY;
+    matrix->gap_open = GAP_OPEN;
+    matrix->gap_extend = GAP_EXTEND;
+    matrix->affine = MODE_AFFINE;
+    matrix->mode = ALIGN_GLOBAL;
+    matrix->threshold = NO_THRESHOLD;
 
+    #ifdef USE_AVX
     static bool initialized = false;
     if (UNLIKELY(!initialized)) {
-        memset(AMINO_LOOKUP, -1, sizeof(AMINO_LOOKUP));
-        for (int i = 0; i < (int)strlen(AMINO_ACIDS); i++) {
-            AMINO_LOOKUP[(int)AMINO_ACIDS[i]] = i;
-        }
-        #ifdef USE_AVX
         FIRST_ROW_INDICES = setr_indicies;
-        GAP_PENALTY_VEC = set1_epi32(GAP_PENALTY);
-        #endif
         initialized = true;
     }
+    #endif
+}
+
+INLINE bool matrix_space(const char c) {
+    return c == ' ' || c == '\t' || c == '\r' || c == '\n';
+}
+
+/* Replaces the scores and alphabet with a matrix in the NCBI text format (BLOSUM62, PAM250, NUC.4.4, ...),
+ * '#' comments, a line of single character residues, then one line per residue starting with it
+ * Returns NULL, or what is wrong with the file to be followed by its path */
+INLINE const char* load_matrix(ScoringMatrix* restrict matrix, const char* path) {
+    FILE* file = fopen(path, "r");
+    if (!file) return "Cannot open substitution matrix ";
+
+    char alphabet[MAX_ALPHABET + 1] = {0};
+    int scores[MAX_ALPHABET][MAX_ALPHABET];
+    bool seen[MAX_ALPHABET] = {false};
+    int size = 0, rows = 0;
+    const char* error = NULL;
+
+    char line[MAX_MATRIX_LINE];
+    while (!error && fgets(line, sizeof(line), file)) {
+        char* p = line;
+        while (matrix_space(*p)) p++;
+        if (!*p || *p == '#') continue;
+
+        if (!size) {
+            for (; *p && !error; p++) {
+                if (matrix_space(*p)) continue;
+                if (size == MAX_ALPHABET) error = "Too many residues in substitution matrix ";
+                else if (!matrix_space(p[1]) && p[1]) error = "Residues must be single characters in substitution matrix ";
+                else if (memchr(alphabet, *p, size)) error = "Repeated residue in substitution matrix ";
+                else alphabet[size++] = *p;
+            }
+            continue;
+        }
+
+        const char* letter = (const char*)memchr(alphabet, *p, size);
+        if (!letter || seen[letter - alphabet]) {
+            error = "Unknown or repeated residue row in substitution matrix ";
+            break;
+        }
+        const int r = letter - alphabet;
+        p++;
+        for (int c = 0; c < size; c++) {
+            char* end;
+            scores[r][c] = (int)strtol(p, &end, 10);
+            if (end == p) {
+                error = "Missing scores in substitution matrix ";
+                break;
+            }
+            p = end;
+        }
+        seen[r] = true;
+        rows++;
+    }
+    fclose(file);
+
+    if (!error && (!size || rows < size)) error = "Missing residue rows in substitution matrix ";
+    if (error) return error;
+
+    memset(matrix->matrix, 0, sizeof(matrix->matrix));
+    for (int r = 0; r < size; r++) memcpy(matrix->matrix[r], scores[r], sizeof(int) * size);
+    memcpy(matrix->alphabet, alphabet, sizeof(alphabet));
+    matrix->size = size;
+    finish_matrix(matrix);
+    return NULL;
+}
+
+/* Query profile of one seq1, row c + 1 holds the score of residue c against every position of seq1
+ * and row 0 is all 0 for unknown residues, so a DP row reads the one profile row of its seq2 residue
+ * instead of looking up matrix[seq1[j]][c] for every cell */
+typedef struct {
+    const int* rows;
+    size_t stride;    // ints per row, a sub range of seq1 keeps the stride of the whole sequence
+} Profile;
+
+INLINE size_t profile_ints(const ScoringMatrix* restrict scoring, const size_t len1) {
+    return (size_t)(scoring->size + 1) * len1;
+}
+
+// Row of residue c, -1 for unknown residues, seq1 residues outside the alphabet score 0 against everything
+INLINE void fill_profile_row(int* restrict rows, const int* restrict seq1_indices, const size_t len1,
+                             const ScoringMatrix* restrict scoring, const int c) {
+    int* restrict out = rows + (size_t)(c + 1) * len1;
+    if (c < 0) {
+        memset(out, 0, sizeof(int) * len1);
+        return;
+    }
+    const int* column = scoring->columns[c] + 1;
+    for (size_t j = 0; j < len1; j++) out[j] = column[seq1_indices[j]];
+}
+
+// rows holds profile_ints ints
+INLINE Profile build_profile(int* restrict rows, const int* restrict seq1_indices, const size_t len1,
+                             const ScoringMatrix* restrict scoring) {
+    for (int c = -1; c < scoring->size; c++) fill_profile_row(rows, seq1_indices, len1, scoring, c);
+    return (Profile){rows, len1};
+}
+
+INLINE const int* profile_row(const Profile profile, const int c2_idx) {
+    return profile.rows + (size_t)(c2_idx + 1) * profile.stride;
+}
+
+// Profile of seq1[lo..)
+INLINE Profile profile_from(const Profile profile, const size_t lo) {
+    return (Profile){profile.rows + lo, profile.stride};
+}
+
+// Linear gaps are the affine ones with gap_open == gap_extend == gap_penalty
+INLINE int open_penalty(const ScoringMatrix* restrict scoring) {
+    return scoring->affine ? scoring->gap_open : scoring->gap_penalty;
+}
+
+INLINE int extend_penalty(const ScoringMatrix* restrict scoring) {
+    return scoring->affine ? scoring->gap_extend : scoring->gap_penalty;
+}
+
+// Score of a gap of k residues
+INLINE int gap_cost(const ScoringMatrix* restrict scoring, const int k) {
+    return k ? open_penalty(scoring) + (k - 1) * extend_penalty(scoring) : 0;
+}
+
+// Score of k residues before the first aligned pair, only global alignment pays for them
+INLINE int edge_cost(const ScoringMatrix* restrict scoring, const int k) {
+    return scoring->mode == ALIGN_GLOBAL ? gap_cost(scoring, k) : 0;
+}
+
+// Global alignment with linear gaps runs on the linear engines, everything else on the Gotoh ones
+INLINE bool linear_engine(const ScoringMatrix* restrict scoring) {
+    return !scoring->affine && scoring->mode == ALIGN_GLOBAL;
+}
+
+/* Upper bound on any cell rows_left rows below a row whose best cell is row_best,
+ * gaps only lower a score and local and semi-global paths can restart from 0 */
+INLINE long long reach_bound(const ScoringMatrix* restrict scoring, int row_best, const int rows_left) {
+    if (scoring->mode != ALIGN_GLOBAL && row_best < 0) row_best = 0;
+    return row_best + (long long)rows_left * (scoring->max_score > 0 ? scoring->max_score : 0);
 }
 
 #endif
\ No newline at end of file
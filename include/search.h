@@ -0,0 +1,289 @@
+#ifndef SEARCH_H
+#define SEARCH_H
+
+#include "intern.h"
+
+/* Search mode, every input (database) row is aligned against every query and each query keeps its TOP_K best rows
+ * The database is streamed from the input mapping in batches, the distinct sequences of a batch are aligned against
+ * the distinct queries, then threads pull chunks of rows and push their scores into their own bounded heap
+ * per query, the heaps are merged after every part of the input and the lines of their hits copied out of it */
+
+#define SEARCH_CHUNK_PAIRS (16384)
+
+typedef struct {
+    int score;
+    size_t row;
+    const char* line;    // start of the database row in the input, then in Search.lines once its part is done
+} Hit;
+
+// Min-heap of at most k hits, the worst kept hit is on top
+typedef struct {
+    Hit* hits;
+    int size;
+} HitHeap;
+
+typedef struct {
+    SequenceTable queries;
+    const ScoringMatrix* scoring;
+    HitHeap* heaps;    // queries.rows per thread
+    AlignTask* tasks;    // one chunk per thread, kept for the whole search
+    int* scores;    // distinct query by distinct row of the batch, BATCH_SIZE apart
+    int num_threads;
+    char* lines[2];    // TOP_K lines per query, hits kept from earlier parts point into the one last filled
+    size_t line_capacity[2];
+    int line_buffer;
+
+    // Current database batch
+    Data* rows;
+    SequenceTable batch;
+    size_t first_row;
+    size_t rows_per_chunk;
+    size_t num_chunks;
+    size_t next_chunk;
+} Search;
+
+// Lower score first, equal scores keep the earlier row so results do not depend on thread timing
+INLINE bool hit_worse(const Hit* a, const Hit* b) {
+    return a->score < b->score || (a->score == b->score && a->row > b->row);
+}
+
+INLINE void heap_push(HitHeap* restrict heap, const int k, const Hit hit) {
+    Hit* hits = heap->hits;
+    int i;
+    if (heap->size < k) {
+        i = heap->size++;
+        while (i > 0 && hit_worse(&hit, &hits[(i - 1) / 2])) {
+            hits[i] = hits[(i - 1) / 2];
+            i = (i - 1) / 2;
+        }
+    } else if (hit_worse(&hits[0], &hit)) {
+        i = 0;
+        while (2 * i + 1 < heap->size) {
+            int child = 2 * i + 1;
+            if (child + 1 < heap->size && hit_worse(&hits[child + 1], &hits[child])) child++;
+            if (!hit_worse(&hits[child], &hit)) break;
+            hits[i] = hits[child];
+            i = child;
+        }
+    } else {
+        return;
+    }
+    hits[i] = hit;
+}
+
+INLINE int compare_hits(const void* a, const void* b) {
+    return hit_worse((const Hit*)b, (const Hit*)a) ? -1 : hit_worse((const Hit*)a, (const Hit*)b);
+}
+
+// Chunks of the distinct sequences of the batch against every distinct query
+INLINE void search_job(ThreadWork* work, void* arg) {
+    Search* ctx = (Search*)arg;
+    const size_t num_queries = ctx->queries.seqs.count;
+    const size_t distinct = ctx->batch.seqs.count;
+    AlignTask* tasks = ctx->tasks + work->id * ctx->rows_per_chunk * num_queries;
+
+    size_t chunk;
+    while ((chunk = __atomic_fetch_add(&ctx->next_chunk, 1, __ATOMIC_RELAXED)) < ctx->num_chunks) {
+        const size_t lo = chunk * ctx->rows_per_chunk;
+        const size_t hi = lo + ctx->rows_per_chunk < distinct ? lo + ctx->rows_per_chunk : distinct;
+
+        // Query major, so the pairs of a query that do not fit the lanes reuse its profile
+        size_t n = 0;
+        for (size_t q = 0; q < num_queries; q++) {
+            for (size_t r = lo; r < hi; r++, n++) {
+                tasks[n] = interned_task(&ctx->queries, q, &ctx->batch, r, ctx->scoring);
+                tasks[n].score = &ctx->scores[q * g_config.batch_size + r];
+            }
+        }
+        align_tasks_cached(&work->lanes, &work->misses, tasks, 0, n, true);
+    }
+}
+
+// Chunks of the rows of the batch, every query row takes the score of its sequence against the row's
+INLINE void rank_job(ThreadWork* work, void* arg) {
+    Search* ctx = (Search*)arg;
+    const size_t num_queries = ctx->queries.rows;
+    const size_t count = ctx->batch.rows;
+    HitHeap* heaps = ctx->heaps + work->id * num_queries;
+
+    size_t chunk;
+    while ((chunk = __atomic_fetch_add(&ctx->next_chunk, 1, __ATOMIC_RELAXED)) < ctx->num_chunks) {
+        const size_t lo = chunk * ctx->rows_per_chunk;
+        const size_t hi = lo + ctx->rows_per_chunk < count ? lo + ctx->rows_per_chunk : count;
+
+        for (size_t q = 0; q < num_queries; q++) {
+            const int* scores = ctx->scores + ctx->queries.ids[q] * g_config.batch_size;
+            for (size_t r = lo; r < hi; r++) {
+                const int score = scores[ctx->batch.ids[r]];
+                if (below_threshold(score)) continue;
+                heap_push(&heaps[q], g_config.top_k, (Hit){score, ctx->first_row + r, ctx->rows[r].line});
+            }
+        }
+    }
+}
+
+INLINE void run_search_job(ThreadJob job, Search* ctx, const size_t count) {
+    ctx->num_chunks = (count + ctx->rows_per_chunk - 1) / ctx->rows_per_chunk;
+    ctx->next_chunk = 0;
+    if (g_config.multithread) {
+        run_job(job, ctx);
+    } else {
+        run_job_here(job, ctx);
+    }
+}
+
+// Lines copied before end with a newline, lines of this part may end with the input
+INLINE size_t hit_line_len(const Hit* hit, const size_t first_row, const char* end) {
+    const char* line = hit->line;
+    const size_t limit = hit->row >= first_row ? (size_t)(end - line) : SIZE_MAX;
+    size_t len = 0;
+    while (len < limit && line[len] != '\n' && line[len] != '\r' && line[len]) len++;
+    return len;
+}
+
+/* Merges the heaps of every thread into the first one and copies the lines of its hits out of the part of the
+ * input that was just searched, stdin windows are reused for the next part
+ * Hits of earlier parts point into the other buffer, so this one can grow to the length of all kept lines */
+INLINE void keep_hits(Search* ctx, const size_t first_row, const char* end) {
+    const size_t num_queries = ctx->queries.rows;
+    const size_t k = g_config.top_k;
+    const int b = ctx->line_buffer = !ctx->line_buffer;
+
+    size_t size = 0;
+    for (size_t q = 0; q < num_queries; q++) {
+        HitHeap* heap = &ctx->heaps[q];
+        for (int t = 1; t < ctx->num_threads; t++) {
+            HitHeap* other = &ctx->heaps[t * num_queries + q];
+            for (int h = 0; h < other->size; h++) heap_push(heap, k, other->hits[h]);
+            other->size = 0;
+        }
+        for (int h = 0; h < heap->size; h++) size += hit_line_len(&heap->hits[h], first_row, end) + 1;
+    }
+    if (size > ctx->line_capacity[b]) {
+        ctx->line_capacity[b] = size;
+        ctx->lines[b] = (char*)realloc(ctx->lines[b], size);
+    }
+
+    char* to = ctx->lines[b];
+    for (size_t q = 0; q < num_queries; q++) {
+        HitHeap* heap = &ctx->heaps[q];
+        for (int h = 0; h < heap->size; h++) {
+            const size_t len = hit_line_len(&heap->hits[h], first_row, end);
+            memcpy(to, heap->hits[h].line, len);
+            to[len] = '\n';
+            heap->hits[h].line = to;
+            to += len + 1;
+        }
+    }
+}
+
+// Writes query,rank,score followed by the database row as it appears in the input
+INLINE void write_hits(Files* files, Search* ctx) {
+    WriteBuffer* writer = &files->writer;
+    const char* header = files->header ? files->header : "";
+    write_data(writer, "query,rank,score,", 17);
+    write_data(writer, header, strlen(header));
+    write_data(writer, "\n", 1);
+
+    const size_t num_queries = ctx->queries.rows;
+    Hit* merged = (Hit*)malloc(sizeof(Hit) * g_config.top_k);
+
+    for (size_t q = 0; q < num_queries; q++) {
+        const HitHeap* heap = &ctx->heaps[q];
+        size_t total = heap->size;
+        memcpy(merged, heap->hits, sizeof(Hit) * total);
+        qsort(merged, total, sizeof(Hit), compare_hits);
+
+        const size_t id = ctx->queries.ids[q];
+        const char* query = interned_seq(&ctx->queries, id);
+        const size_t query_len = ctx->queries.seqs.lengths[id];
+        for (size_t rank = 0; rank < total; rank++) {
+            const char* line = merged[rank].line;
+            size_t line_len = 0;
+            while (line[line_len++] != '\n');
+
+            // Rows longer than the whole write buffer go through write_data in pieces
+            char fields[2 * NUMERIC_COL_MAX + 3];
+            char* buf = fields;
+            *buf++ = ',';
+            buf = int_to_str(buf, rank + 1);
+            *buf++ = ',';
+            buf = int_to_str(buf, merged[rank].score);
+            *buf++ = ',';
+            const size_t fields_len = buf - fields;
+
+            if (LIKELY(reserve_buffer(writer, query_len + fields_len + line_len))) {
+                buf = fast_strcpy(writer->buffer + writer->pos, query, query_len);
+                buf = fast_strcpy(buf, fields, fields_len);
+                buf = fast_strcpy(buf, line, line_len);
+                writer->pos = buf - writer->buffer;
+            } else {
+                write_data(writer, query, query_len);
+                write_data(writer, fields, fields_len);
+                write_data(writer, line, line_len);
+            }
+        }
+    }
+
+    free(merged);
+}
+
+INLINE void search_database(Files* files, const ScoringMatrix* scoring) {
+    Search ctx = {0};
+    ctx.scoring = scoring;
+
+    size_t query_size;
+    char* query_data = read_file(g_config.query_file, &query_size);
+    intern_init(&ctx.queries, scoring);
+    intern_rows(&ctx.queries, skip_header(query_data, query_data + query_size), query_data + query_size);
+    free(query_data);
+    const size_t num_queries = ctx.queries.rows;
+    const size_t distinct_queries = ctx.queries.seqs.count;
+    if (!num_queries) config_error("No sequences in query file ", g_config.query_file);
+
+    ctx.num_threads = g_config.multithread ? g_num_threads : 1;
+    ctx.heaps = (HitHeap*)calloc(ctx.num_threads * num_queries, sizeof(HitHeap));
+    for (size_t h = 0; h < ctx.num_threads * num_queries; h++) {
+        ctx.heaps[h].hits = (Hit*)malloc(sizeof(Hit) * g_config.top_k);
+    }
+    ctx.rows_per_chunk = distinct_queries < SEARCH_CHUNK_PAIRS ? SEARCH_CHUNK_PAIRS / distinct_queries : 1;
+    ctx.tasks = (AlignTask*)malloc(sizeof(AlignTask) * ctx.rows_per_chunk * distinct_queries * ctx.num_threads);
+
+    const size_t batch_size = g_config.batch_size;
+    ctx.scores = (int*)malloc(sizeof(int) * batch_size * distinct_queries);
+    ctx.rows = (Data*)malloc(sizeof(Data) * batch_size);
+    intern_init(&ctx.batch, scoring);
+
+    char *current, *end;
+    while (next_input(files, &current, &end, false)) {
+        const size_t first_row = ctx.first_row;
+        while (current < end && *current) {
+            intern_reset(&ctx.batch);
+            size_t count = 0;
+            while (count < batch_size && current < end && *current) {
+                view_csv_line(&current, &ctx.rows[count]);
+                intern_row(&ctx.batch, ctx.rows[count].seq, ctx.rows[count].len);
+                count++;
+            }
+
+            run_search_job(search_job, &ctx, ctx.batch.seqs.count);
+            run_search_job(rank_job, &ctx, count);
+            ctx.first_row += count;
+        }
+        keep_hits(&ctx, first_row, end);
+    }
+
+    if (g_config.write) write_hits(files, &ctx);
+
+    for (size_t h = 0; h < ctx.num_threads * num_queries; h++) free(ctx.heaps[h].hits);
+    free(ctx.heaps);
+    free(ctx.tasks);
+    free(ctx.scores);
+    free(ctx.rows);
+    free(ctx.lines[0]);
+    free(ctx.lines[1]);
+    intern_free(&ctx.batch);
+    intern_free(&ctx.queries);
+}
+
+#endif
@@ -1,115 +1,974 @@
 #ifndef SEQALIGN_H
 #define SEQALIGN_H
 
-#include "scoring.h"
+#include "striped.h"
+#include "config.h"
 
 #ifdef __cplusplus
 #define restrict __restrict
 #endif
 
+// Pairs longer than this in either sequence are aligned in linear space (Hirschberg, Myers and Miller for Gotoh)
+#define FULL_DP_LEN (MAX_SEQ_LEN < 128 ? MAX_SEQ_LEN : 128)
+#define FULL_DP_CELLS ((FULL_DP_LEN + 1) * (FULL_DP_LEN + 1))
+
 static const int8_t next_i[] = {-1, -1, 0};    // DIAG, UP, LEFT
 static const int8_t next_j[] = {-1, 0, -1};
 
-INLINE Alignment align_sequences(const char seq1[MAX_SEQ_LEN],
-                                 const size_t len1,
-                                 const char seq2[MAX_SEQ_LEN], 
-                                 const size_t len2,
-                                 const ScoringMatrix* restrict scoring) {
-    int matrix_stack[MAX_SEQ_LEN * MAX_SEQ_LEN];
+INLINE void seq_to_indices(const char* restrict seq, const size_t len, int* restrict indices,
+                           const ScoringMatrix* restrict scoring) {
+    for (size_t i = 0; i < len; ++i) {
+        indices[i] = scoring->lookup[(unsigned char)seq[i]];
+    }
+}
+
+INLINE void seq_to_indices8(const char* restrict seq, const size_t len, int8_t* restrict indices,
+                            const ScoringMatrix* restrict scoring) {
+    for (size_t i = 0; i < len; ++i) {
+        indices[i] = scoring->lookup[(unsigned char)seq[i]];
+    }
+}
+
+INLINE void reverse_ops(uint8_t* restrict ops, int len) {
+    for (int k = 0; k < len / 2; k++) {
+        uint8_t t = ops[k];
+        ops[k] = ops[len - k - 1];
+        ops[len - k - 1] = t;
+    }
+}
+
+
+/* Full matrix fill and traceback, (len1 + 1) * (len2 + 1) must fit in FULL_DP_CELLS
+ * Writes one AlignOp per column in order and returns their count */
+INLINE int align_full(const char* seq1, const Profile profile, const size_t len1,
+                      const char* seq2, const int* restrict seq2_indices, const size_t len2,
+                      const ScoringMatrix* restrict scoring, uint8_t* restrict ops, int* score) {
+    int matrix_stack[FULL_DP_CELLS + CACHE_LINE];
     int* restrict matrix = matrix_stack;
     const int cols = len1 + 1;
+    const int gap = scoring->gap_penalty;
 
     // Initialize first row
     int* restrict curr_row = matrix;
     curr_row[0] = 0;
-    
+
     #ifdef USE_AVX
     veci_t indices = FIRST_ROW_INDICES;
+    const veci_t gap_vec = set1_epi32(gap);
     for (int j = 1; j <= (int)len1; j += NUM_ELEMS) {
-        veci_t values = mullo_epi32(indices, GAP_PENALTY_VEC);
+        veci_t values = mullo_epi32(indices, gap_vec);
         indices = add_epi32(indices, set1_epi32(NUM_ELEMS));
         storeu((veci_t*)&curr_row[j], values);
     }
     #else
     matrix[0] = 0;
     for(int j = 1; j <= (int)len1; j++) {
-        matrix[j] = j * GAP_PENALTY;
+        matrix[j] = j * gap;
     }
     #endif
 
-    // Precompute seq1 indices
-    int seq1_indices[MAX_SEQ_LEN];
-    for (int i = 0; i < (int)len1; ++i) {
-        seq1_indices[i] = AMINO_LOOKUP[(int)seq1[i]];
-    }
-
     // Fill matrix
     #pragma GCC unroll 8
     for (int i = 1; i <= (int)len2; ++i) {
         int* restrict prev_row = curr_row;
         curr_row = matrix + i * cols;
-        curr_row[0] = i * GAP_PENALTY;
-        int c2_idx = AMINO_LOOKUP[(int)seq2[i - 1]];
+        curr_row[0] = i * gap;
+        const int* restrict scores = profile_row(profile, seq2_indices[i - 1]);
         #pragma GCC unroll 4
         for (int j = 1; j <= (int)len1; j++) {
-            int match = prev_row[j - 1] + scoring->matrix[seq1_indices[j - 1]][c2_idx];
-            int del = prev_row[j] + GAP_PENALTY;
-            int insert = curr_row[j - 1] + GAP_PENALTY;
+            int match = prev_row[j - 1] + scores[j - 1];
+            int del = prev_row[j] + gap;
+            int insert = curr_row[j - 1] + gap;
             curr_row[j] = match > del ? (match > insert ? match : insert) : (del > insert ? del : insert);
         }
     }
 
-    // Traceback    
-    char temp_seq1[ALIGN_BUF];
-    char temp_seq2[ALIGN_BUF];
+    // Traceback, written backwards then reversed in place
     int pos = 0;
     int i = len2, j = len1;
-    
+
     while (i > 0 || j > 0) {
         int curr_score = matrix[i * cols + j];
         int move = 0;
-        
+
         if (i > 0 && j > 0) {
             int diag_score = matrix[(i - 1) * cols + (j - 1)];
-            int match_score = scoring->matrix[seq1_indices[j - 1]][AMINO_LOOKUP[(int)seq2[i - 1]]];
+            int match_score = profile_row(profile, seq2_indices[i - 1])[j - 1];
             if (curr_score != diag_score + match_score) {
-                move = (i > 0 && curr_score == matrix[(i - 1) * cols + j] + GAP_PENALTY) ? 1 : 2;
+                move = (i > 0 && curr_score == matrix[(i - 1) * cols + j] + gap) ? 1 : 2;
             }
         } else {
             move = (i > 0) ? 1 : 2;
         }
 
-        temp_seq1[pos] = (move != 1) ? seq1[j-1] : '-';
-        temp_seq2[pos] = (move != 2) ? seq2[i-1] : '-';
-        pos++;
-        
+        if (move) {
+            ops[pos++] = move == 1 ? OP_INSERT : OP_DELETE;
+        } else {
+            ops[pos++] = seq1[j - 1] == seq2[i - 1] ? OP_MATCH : OP_MISMATCH;
+        }
+
         i += next_i[move];
         j += next_j[move];
     }
 
-    Alignment result = {0};
-    for (int k = 0; k < pos; k++) {
-        result.seq1_aligned[k] = temp_seq1[pos - k - 1];
-        result.seq2_aligned[k] = temp_seq2[pos - k - 1];
-    }
-    result.seq1_aligned[pos] = result.seq2_aligned[pos] = '\0';
-    result.score = matrix[len2 * cols + len1];
+    reverse_ops(ops, pos);
+    *score = matrix[len2 * cols + len1];
+    return pos;
+}
 
-    #if SIMILARITY_ANALYSIS == 1
+// Last DP row of seq1 against seq2, row[j] is the score of seq1[0..j) against all of seq2
+INLINE void score_row(const Profile profile, const size_t len1,
+                      const int* restrict seq2_indices, const size_t len2,
+                      const ScoringMatrix* restrict scoring, int* restrict row) {
+    const int gap = scoring->gap_penalty;
 
-    for (i = 0; i < pos; i++) {
-        if (result.seq1_aligned[i] == result.seq2_aligned[i]) {
-            result.matches++;
-        } else if (result.seq1_aligned[i] == '-') {
-            result.gaps++;
+    #ifdef USE_AVX
+    if (len1 >= STRIPED_MIN_LEN && len2 > 0 && striped_fits(len1, len2, scoring)) {
+        Striped s;
+        striped_init(&s, profile, len1, scoring);
+        striped_reset(&s, scoring);
+        for (int i = 1; i <= (int)len2; ++i) {
+            striped_row(&s, seq2_indices[i - 1], i, gap);
         }
+        striped_extract(&s, len1, row);
+        striped_free(&s);
+        row[0] = len2 * gap;
+        return;
     }
-    
-    result.mismatches = pos - result.matches - result.gaps;
-    result.similarity = (double)result.matches / pos;
     #endif
 
+    for (int j = 0; j <= (int)len1; j++) {
+        row[j] = j * gap;
+    }
+
+    for (int i = 1; i <= (int)len2; ++i) {
+        const int* restrict scores = profile_row(profile, seq2_indices[i - 1]);
+        int diag = row[0];
+        row[0] = i * gap;
+        #pragma GCC unroll 4
+        for (int j = 1; j <= (int)len1; j++) {
+            int up = row[j];
+            int match = diag + scores[j - 1];
+            int del = up + gap;
+            int insert = row[j - 1] + gap;
+            row[j] = match > del ? (match > insert ? match : insert) : (del > insert ? del : insert);
+            diag = up;
+        }
+    }
+}
+
+/* Gotoh's recurrence, H is the best score of a cell, E of one ending in a gap in seq1 (OP_INSERT)
+ * and F of one ending in a gap in seq2 (OP_DELETE), E and F pay the open penalty to start from H and the extend
+ * penalty to grow. Used for affine gaps and for the local and semi-global modes, linear gaps run as open == extend
+ * Local cells are floored at 0, local and semi-global edges are free (edge_cost) */
+
+#define GOTOH_NEG_INF (INT_MIN / 2)    // clear of INT_MIN so adding a penalty cannot wrap
+#define TRACE_E_OPEN (4)               // E of the cell opened from H above instead of extending
+#define TRACE_F_OPEN (8)               // F of the cell opened from H to the left
+#define TRACE_ZERO (16)                // local cell floored at 0, the alignment starts here
+
+/* Score only, the last row is left in row and e is len1 + 1 ints of scratch
+ * Returns SCORE_DISCARDED as soon as no cell left can reach scoring->threshold */
+INLINE int score_gotoh(const Profile profile, const size_t len1,
+                       const int* restrict seq2_indices, const size_t len2,
+                       const ScoringMatrix* restrict scoring, int* restrict row, int* restrict e) {
+    const AlignMode mode = scoring->mode;
+    const int open = open_penalty(scoring);
+    const int extend = extend_penalty(scoring);
+    const int floor = mode == ALIGN_LOCAL ? 0 : GOTOH_NEG_INF;
+    const bool filter = scoring->threshold != NO_THRESHOLD;
+
+    for (int j = 0; j <= (int)len1; j++) {
+        row[j] = edge_cost(scoring, j);
+        e[j] = GOTOH_NEG_INF;
+    }
+
+    int best = mode == ALIGN_GLOBAL ? INT_MIN : 0;    // local: best cell so far, semi-global: best of the last column
+    for (int i = 1; i <= (int)len2; ++i) {
+        const int* restrict scores = profile_row(profile, seq2_indices[i - 1]);
+        int diag = row[0];
+        int f = GOTOH_NEG_INF;
+        row[0] = edge_cost(scoring, i);
+        int row_best = row[0];
+        #pragma GCC unroll 4
+        for (int j = 1; j <= (int)len1; j++) {
+            int up = row[j];
+            e[j] = up + open > e[j] + extend ? up + open : e[j] + extend;
+            f = row[j - 1] + open > f + extend ? row[j - 1] + open : f + extend;
+            int h = diag + scores[j - 1];
+            if (e[j] > h) h = e[j];
+            if (f > h) h = f;
+            if (floor > h) h = floor;
+            row[j] = h;
+            row_best = h > row_best ? h : row_best;
+            diag = up;
+        }
+
+        if (mode == ALIGN_LOCAL && row_best > best) best = row_best;
+        if (mode == ALIGN_SEMIGLOBAL && row[len1] > best) best = row[len1];
+        if (filter && i < (int)len2 && best < scoring->threshold &&
+            reach_bound(scoring, row_best, len2 - i) < scoring->threshold) {
+            return SCORE_DISCARDED;
+        }
+    }
+
+    if (mode == ALIGN_GLOBAL) return row[len1];
+    if (mode == ALIGN_SEMIGLOBAL) {
+        for (size_t j = 0; j < len1; j++) best = row[j] > best ? row[j] : best;
+    }
+    return best;
+}
+
+/* Linear space Gotoh (Myers and Miller) for pairs whose trace does not fit FULL_DP_CELLS, Hirschberg with the E row
+ * of both halves kept so a gap in seq1 can run across the middle row. Local and semi-global pairs find the cell
+ * align_gotoh ends on with one pass, where the alignment starts with a pass back from there, and align the part
+ * between end to end. Ties can pick another alignment of the same score than align_gotoh does */
+
+typedef struct {
+    int score;
+    size_t i;
+    size_t j;
+} GotohCell;
+
+typedef struct {
+    const char* seq1;
+    const char* seq2;
+    Profile profile;             // of seq1
+    Profile profile_reversed;    // of seq1 back to front
+    const int* seq2_indices;
+    const int* seq2_reversed;
+    size_t len1;
+    size_t len2;
+    int* forward;    // H then E of the upper half
+    int* reverse;    // H then E of the lower half, back to front
+    const ScoringMatrix* scoring;
+} MyersMiller;
+
+/* End to end rows from the corner, the last rows of H and E are left in h and e
+ * top is what a gap in seq1 down the first column starts with, the extend penalty when it carries on a gap
+ * from the part above. best, when given, gets the highest cell (local) or the highest of the last row and column
+ * (semi-global), the start of the alignment when run back from where it ends */
+INLINE void gotoh_rows(const Profile profile, const size_t n, const int* restrict seq2_indices, const size_t m,
+                       const int top, const ScoringMatrix* restrict scoring, int* restrict h, int* restrict e,
+                       GotohCell* restrict best) {
+    const int open = open_penalty(scoring);
+    const int extend = extend_penalty(scoring);
+    const bool every_cell = best && scoring->mode == ALIGN_LOCAL;
+    const bool edges = best && scoring->mode == ALIGN_SEMIGLOBAL;
+
+    h[0] = 0;
+    e[0] = GOTOH_NEG_INF;
+    for (size_t j = 1; j <= n; j++) {
+        h[j] = open + (int)(j - 1) * extend;
+        e[j] = GOTOH_NEG_INF;
+    }
+    if (edges && h[n] > best->score) *best = (GotohCell){h[n], 0, n};
+
+    for (size_t i = 1; i <= m; ++i) {
+        const int* restrict scores = profile_row(profile, seq2_indices[i - 1]);
+        int diag = h[0];
+        int f = GOTOH_NEG_INF;
+        h[0] = e[0] = top + (int)(i - 1) * extend;
+        for (size_t j = 1; j <= n; j++) {
+            int up = h[j];
+            e[j] = up + open > e[j] + extend ? up + open : e[j] + extend;
+            f = h[j - 1] + open > f + extend ? h[j - 1] + open : f + extend;
+            int cell = diag + scores[j - 1];
+            if (e[j] > cell) cell = e[j];
+            if (f > cell) cell = f;
+            h[j] = cell;
+            diag = up;
+            if (every_cell && cell > best->score) *best = (GotohCell){cell, i, j};
+        }
+        if (edges && h[n] > best->score) *best = (GotohCell){h[n], i, n};
+    }
+
+    for (size_t j = 0; edges && j < n; j++) {
+        if (h[j] > best->score) *best = (GotohCell){h[j], m, j};
+    }
+}
+
+// Cell the traceback of align_gotoh starts from, with the same ties, row and e are len1 + 1 ints
+INLINE GotohCell gotoh_end(const Profile profile, const size_t len1, const int* restrict seq2_indices,
+                           const size_t len2, const ScoringMatrix* restrict scoring, int* restrict row,
+                           int* restrict e) {
+    const AlignMode mode = scoring->mode;
+    const int open = open_penalty(scoring);
+    const int extend = extend_penalty(scoring);
+
+    for (size_t j = 0; j <= len1; j++) {
+        row[j] = edge_cost(scoring, j);
+        e[j] = GOTOH_NEG_INF;
+    }
+
+    GotohCell end = {0, 0, 0};
+    int column_best = INT_MIN;
+    size_t column_i = 0;
+    for (size_t i = 1; i <= len2; ++i) {
+        const int* restrict scores = profile_row(profile, seq2_indices[i - 1]);
+        int diag = row[0];
+        int f = GOTOH_NEG_INF;
+        row[0] = edge_cost(scoring, i);
+        for (size_t j = 1; j <= len1; j++) {
+            int up = row[j];
+            e[j] = up + open >= e[j] + extend ? up + open : e[j] + extend;
+            f = row[j - 1] + open >= f + extend ? row[j - 1] + open : f + extend;
+            int h = diag + scores[j - 1];
+            if (e[j] > h) h = e[j];
+            if (f > h) h = f;
+            if (mode == ALIGN_LOCAL) {
+                if (h <= 0) {
+                    h = 0;
+                } else if (h > end.score) {
+                    end = (GotohCell){h, i, j};
+                }
+            }
+            row[j] = h;
+            diag = up;
+        }
+        if (mode == ALIGN_SEMIGLOBAL && i < len2 && row[len1] > column_best) {
+            column_best = row[len1];
+            column_i = i;
+        }
+    }
+
+    if (mode == ALIGN_SEMIGLOBAL) {
+        end = (GotohCell){row[len1], len2, len1};
+        if (len2 > 0 && 0 > end.score) end = (GotohCell){0, 0, len1};
+        if (column_best > end.score) end = (GotohCell){column_best, column_i, len1};
+        for (size_t j = 0; j < len1; j++) {
+            if (row[j] > end.score) end = (GotohCell){row[j], len2, j};
+        }
+    }
+    return end;
+}
+
+/* Aligns seq1[lo1..hi1) with seq2[lo2..hi2) end to end, appends the columns at ops + pos and returns the new pos
+ * top and bottom are what a gap in seq1 in the first column starts with and in the last column ends with,
+ * the extend penalty when it joins a gap of the part above or below */
+INLINE int myers_miller(const MyersMiller* mm, size_t lo1, size_t hi1, size_t lo2, size_t hi2, int top, int bottom,
+                        uint8_t* restrict ops, int pos) {
+    const size_t n = hi1 - lo1;
+    const size_t m = hi2 - lo2;
+    const ScoringMatrix* scoring = mm->scoring;
+    const int open = open_penalty(scoring);
+    const int extend = extend_penalty(scoring);
+
+    if (m == 0 || n == 0) {
+        for (size_t j = lo1; j < hi1; j++) ops[pos++] = OP_DELETE;
+        for (size_t i = lo2; i < hi2; i++) ops[pos++] = OP_INSERT;
+        return pos;
+    }
+
+    if (m == 1) {
+        // One residue of seq2 either matches its best placed partner in seq1 or becomes a gap next to one of seq1
+        const int* scores = profile_row(mm->profile, mm->seq2_indices[lo2]);
+        size_t best = lo1;
+        int best_score = INT_MIN;
+        for (size_t j = lo1; j < hi1; j++) {
+            int total = gap_cost(scoring, j - lo1) + scores[j] + gap_cost(scoring, hi1 - j - 1);
+            if (total > best_score) {
+                best_score = total;
+                best = j;
+            }
+        }
+        const int gap_score = (top > bottom ? top : bottom) + gap_cost(scoring, n);
+        if (gap_score > best_score) {
+            if (top > bottom) ops[pos++] = OP_INSERT;
+            for (size_t j = lo1; j < hi1; j++) ops[pos++] = OP_DELETE;
+            if (top <= bottom) ops[pos++] = OP_INSERT;
+            return pos;
+        }
+        for (size_t j = lo1; j < hi1; j++) {
+            if (j == best) {
+                ops[pos++] = mm->seq1[j] == mm->seq2[lo2] ? OP_MATCH : OP_MISMATCH;
+            } else {
+                ops[pos++] = OP_DELETE;
+            }
+        }
+        return pos;
+    }
+
+    const size_t mid = lo2 + m / 2;
+    int* h_forward = mm->forward;
+    int* e_forward = mm->forward + mm->len1 + 1;
+    int* h_reverse = mm->reverse;
+    int* e_reverse = mm->reverse + mm->len1 + 1;
+    gotoh_rows(profile_from(mm->profile, lo1), n, mm->seq2_indices + lo2, mid - lo2, top, scoring,
+               h_forward, e_forward, NULL);
+    gotoh_rows(profile_from(mm->profile_reversed, mm->len1 - hi1), n, mm->seq2_reversed + (mm->len2 - hi2),
+               hi2 - mid, bottom, scoring, h_reverse, e_reverse, NULL);
+
+    // Either the path crosses the middle row at a cell, or a gap in seq1 runs across it and only starts once
+    size_t split = 0;
+    bool across = false;
+    int best = INT_MIN;
+    for (size_t k = 0; k <= n; k++) {
+        const int through = h_forward[k] + h_reverse[n - k];
+        const int gap = e_forward[k] + e_reverse[n - k] - open + extend;
+        if (through > best) {
+            best = through;
+            split = k;
+            across = false;
+        }
+        if (gap > best) {
+            best = gap;
+            split = k;
+            across = true;
+        }
+    }
+
+    if (!across) {
+        pos = myers_miller(mm, lo1, lo1 + split, lo2, mid, top, open, ops, pos);
+        return myers_miller(mm, lo1 + split, hi1, mid, hi2, open, bottom, ops, pos);
+    }
+    pos = myers_miller(mm, lo1, lo1 + split, lo2, mid - 1, top, extend, ops, pos);
+    ops[pos++] = OP_INSERT;
+    ops[pos++] = OP_INSERT;
+    return myers_miller(mm, lo1 + split, hi1, mid + 1, hi2, extend, bottom, ops, pos);
+}
+
+INLINE int align_gotoh_linear_space(const char* seq1, const size_t len1, const char* seq2, const size_t len2,
+                                    const ScoringMatrix* restrict scoring, uint8_t* restrict ops,
+                                    Alignment* restrict result) {
+    const AlignMode mode = scoring->mode;
+    const int open = open_penalty(scoring);
+    const int extend = extend_penalty(scoring);
+    const size_t profile_size = profile_ints(scoring, len1);
+    int* buffer = (int*)malloc(sizeof(int) * (2 * len1 + 2 * len2 + 4 * (len1 + 1) + 2 * profile_size));
+    if (!buffer) config_error("Cannot allocate the DP rows of a long pair", "");
+    int* seq1_indices = buffer;
+    int* seq1_reversed = seq1_indices + len1;
+    int* seq2_indices = seq1_reversed + len1;
+    int* seq2_reversed = seq2_indices + len2;
+    int* forward = seq2_reversed + len2;
+    int* reverse = forward + 2 * (len1 + 1);
+    int* profile_rows = reverse + 2 * (len1 + 1);
+
+    seq_to_indices(seq1, len1, seq1_indices, scoring);
+    seq_to_indices(seq2, len2, seq2_indices, scoring);
+    for (size_t j = 0; j < len1; j++) seq1_reversed[j] = seq1_indices[len1 - j - 1];
+    for (size_t i = 0; i < len2; i++) seq2_reversed[i] = seq2_indices[len2 - i - 1];
+
+    MyersMiller mm = {
+        .seq1 = seq1, .seq2 = seq2,
+        .profile = build_profile(profile_rows, seq1_indices, len1, scoring),
+        .profile_reversed = build_profile(profile_rows + profile_size, seq1_reversed, len1, scoring),
+        .seq2_indices = seq2_indices, .seq2_reversed = seq2_reversed,
+        .len1 = len1, .len2 = len2,
+        .forward = forward, .reverse = reverse,
+        .scoring = scoring
+    };
+
+    int pos = 0;
+    result->start1 = result->start2 = 0;
+    if (mode == ALIGN_GLOBAL) {
+        pos = myers_miller(&mm, 0, len1, 0, len2, open, open, ops, 0);
+
+        // Score of the chosen path, a gap pays open on its first residue
+        int total = 0;
+        for (int k = 0, j = 0, i = 0; k < pos; k++) {
+            if (ops[k] == OP_INSERT || ops[k] == OP_DELETE) {
+                total += k && ops[k - 1] == ops[k] ? extend : open;
+                i += ops[k] == OP_INSERT;
+                j += ops[k] == OP_DELETE;
+            } else {
+                total += profile_row(mm.profile, seq2_indices[i++])[j++];
+            }
+        }
+        result->score = total;
+        free(buffer);
+        return pos;
+    }
+
+    const GotohCell end = gotoh_end(mm.profile, len1, seq2_indices, len2, scoring, forward, forward + len1 + 1);
+    result->score = end.score;
+    if (mode == ALIGN_LOCAL && end.score <= 0) {
+        free(buffer);
+        return 0;
+    }
+
+    // Run back from the end, the start is at the same distance from it
+    GotohCell start = {GOTOH_NEG_INF, 0, 0};
+    gotoh_rows(profile_from(mm.profile_reversed, len1 - end.j), end.j, seq2_reversed + (len2 - end.i), end.i,
+               open, scoring, forward, forward + len1 + 1, &start);
+    const size_t start1 = end.j - start.j;
+    const size_t start2 = end.i - start.i;
+
+    // Semi-global leading and trailing gaps are free but still part of the alignment
+    if (mode == ALIGN_SEMIGLOBAL) {
+        for (size_t i = 0; i < start2; i++) ops[pos++] = OP_INSERT;
+        for (size_t j = 0; j < start1; j++) ops[pos++] = OP_DELETE;
+    } else {
+        result->start1 = start1;
+        result->start2 = start2;
+    }
+    pos = myers_miller(&mm, start1, end.j, start2, end.i, open, open, ops, pos);
+    for (size_t i = end.i; mode == ALIGN_SEMIGLOBAL && i < len2; i++) ops[pos++] = OP_INSERT;
+    for (size_t j = end.j; mode == ALIGN_SEMIGLOBAL && j < len1; j++) ops[pos++] = OP_DELETE;
+
+    free(buffer);
+    return pos;
+}
+
+/* Fill and traceback, keeps two rows of H and E and one trace byte per cell (the move out of H in the low bits
+ * plus the TRACE_ flags) on the stack, pairs whose trace is larger than FULL_DP_CELLS go to align_gotoh_linear_space
+ * Ties go diagonal, then E, then F, and to opening over extending. Local alignments end on the first best cell
+ * in row order, semi-global ones on the corner, then the last column and then the last row, whichever is higher
+ * first. The lanes read the same order from their matrices */
+INLINE int align_gotoh(const char* seq1, const size_t len1, const char* seq2, const size_t len2,
+                       const ScoringMatrix* restrict scoring, uint8_t* restrict ops, Alignment* restrict result) {
+    const AlignMode mode = scoring->mode;
+    const size_t cols = len1 + 1;
+    const size_t cells = cols * (len2 + 1);
+    const int open = open_penalty(scoring);
+    const int extend = extend_penalty(scoring);
+    if (UNLIKELY(cells > FULL_DP_CELLS)) return align_gotoh_linear_space(seq1, len1, seq2, len2, scoring, ops, result);
+
+    uint8_t trace[FULL_DP_CELLS];
+    int rows_stack[3 * (FULL_DP_LEN + 1) + FULL_DP_LEN + (MAX_ALPHABET + 1) * FULL_DP_LEN];
+    int* buffer = rows_stack;
+    if (UNLIKELY(len1 > FULL_DP_LEN || len2 > FULL_DP_LEN)) {
+        buffer = (int*)malloc(sizeof(int) * (3 * cols + len1 + len2 + profile_ints(scoring, len1)));
+        if (!buffer) config_error("Cannot allocate the DP rows of a long pair", "");
+    }
+    int* seq1_indices = buffer;
+    int* seq2_indices = seq1_indices + len1;
+    int* row = seq2_indices + len2;
+    int* e = row + cols;
+
+    seq_to_indices(seq1, len1, seq1_indices, scoring);
+    seq_to_indices(seq2, len2, seq2_indices, scoring);
+    const Profile profile = build_profile(e + cols, seq1_indices, len1, scoring);
+    for (size_t j = 0; j < cols; j++) {
+        row[j] = edge_cost(scoring, j);
+        e[j] = GOTOH_NEG_INF;
+    }
+    memset(trace, mode == ALIGN_LOCAL ? TRACE_ZERO : 0, cols);
+
+    // Where the traceback starts, local ends on the first best cell and semi-global collects its last column here
+    int best = 0;
+    size_t end_i = 0, end_j = 0;
+    int column_best = INT_MIN;
+    size_t column_i = 0;
+
+    for (size_t i = 1; i <= len2; ++i) {
+        uint8_t* restrict trace_row = trace + i * cols;
+        const int* restrict scores = profile_row(profile, seq2_indices[i - 1]);
+        int diag = row[0];
+        int f = GOTOH_NEG_INF;
+        row[0] = edge_cost(scoring, i);
+        trace_row[0] = mode == ALIGN_LOCAL ? TRACE_ZERO : 0;
+        for (size_t j = 1; j <= len1; j++) {
+            int up = row[j];
+            uint8_t t = 0;
+            if (up + open >= e[j] + extend) {
+                e[j] = up + open;
+                t |= TRACE_E_OPEN;
+            } else {
+                e[j] += extend;
+            }
+            if (row[j - 1] + open >= f + extend) {
+                f = row[j - 1] + open;
+                t |= TRACE_F_OPEN;
+            } else {
+                f += extend;
+            }
+            int h = diag + scores[j - 1];
+            if (e[j] > h) {
+                h = e[j];
+                t |= 1;
+            }
+            if (f > h) {
+                h = f;
+                t = (t & ~3) | 2;
+            }
+            if (mode == ALIGN_LOCAL) {
+                if (h <= 0) {
+                    h = 0;
+                    t |= TRACE_ZERO;
+                } else if (h > best) {
+                    best = h;
+                    end_i = i;
+                    end_j = j;
+                }
+            }
+            trace_row[j] = t;
+            row[j] = h;
+            diag = up;
+        }
+        if (mode == ALIGN_SEMIGLOBAL && i < len2 && row[len1] > column_best) {
+            column_best = row[len1];
+            column_i = i;
+        }
+    }
+
+    if (mode == ALIGN_GLOBAL) {
+        best = row[len1];
+        end_i = len2;
+        end_j = len1;
+    } else if (mode == ALIGN_SEMIGLOBAL) {
+        best = row[len1];
+        end_i = len2;
+        end_j = len1;
+        // Row 0 of the last column is 0 like the corner of an empty seq2
+        if (len2 > 0 && 0 > best) {
+            best = 0;
+            end_i = 0;
+        }
+        if (column_best > best) {
+            best = column_best;
+            end_i = column_i;
+        }
+        for (size_t j = 0; j < len1; j++) {
+            if (row[j] > best) {
+                best = row[j];
+                end_i = len2;
+                end_j = j;
+            }
+        }
+    }
+    result->score = best;
+
+    // Traceback, state is the matrix the walk is in with the same numbering as the moves
+    int pos = 0;
+    int i = end_i, j = end_j;
+    int state = 0;
+
+    // Semi-global trailing gaps are free but still part of the alignment
+    for (size_t k = len1; mode == ALIGN_SEMIGLOBAL && k > end_j; k--) ops[pos++] = OP_DELETE;
+    for (size_t k = len2; mode == ALIGN_SEMIGLOBAL && k > end_i; k--) ops[pos++] = OP_INSERT;
+
+    while (i > 0 || j > 0) {
+        const uint8_t t = trace[i * cols + j];
+        if (!state && (t & TRACE_ZERO)) break;
+        const int move = i == 0 ? 2 : j == 0 ? 1 : state ? state : t & 3;
+
+        if (move == 1) {
+            ops[pos++] = OP_INSERT;
+            state = (t & TRACE_E_OPEN) ? 0 : 1;
+        } else if (move == 2) {
+            ops[pos++] = OP_DELETE;
+            state = (t & TRACE_F_OPEN) ? 0 : 2;
+        } else {
+            ops[pos++] = seq1[j - 1] == seq2[i - 1] ? OP_MATCH : OP_MISMATCH;
+        }
+
+        i += next_i[move];
+        j += next_j[move];
+    }
+    result->start1 = j;
+    result->start2 = i;
+
+    reverse_ops(ops, pos);
+    if (buffer != rows_stack) free(buffer);
+    return pos;
+}
+
+typedef struct {
+    const char* seq1;
+    const char* seq2;
+    Profile profile;             // of seq1
+    Profile profile_reversed;    // of seq1 back to front
+    const int* seq2_indices;
+    const int* seq2_reversed;
+    size_t len1;
+    size_t len2;
+    int* forward;
+    int* reverse;
+    const ScoringMatrix* scoring;
+} Hirschberg;
+
+// Aligns seq1[lo1..hi1) with seq2[lo2..hi2), appends the columns at ops + pos and returns the new pos
+INLINE int hirschberg(const Hirschberg* h, size_t lo1, size_t hi1, size_t lo2, size_t hi2,
+                      uint8_t* restrict ops, int pos) {
+    const size_t n = hi1 - lo1;
+    const size_t m = hi2 - lo2;
+    const int gap = h->scoring->gap_penalty;
+
+    if (m == 0 || n == 0) {
+        for (size_t j = lo1; j < hi1; j++) ops[pos++] = OP_DELETE;
+        for (size_t i = lo2; i < hi2; i++) ops[pos++] = OP_INSERT;
+        return pos;
+    }
+
+    if ((n + 1) * (m + 1) <= FULL_DP_CELLS) {
+        int score;
+        return pos + align_full(h->seq1 + lo1, profile_from(h->profile, lo1), n,
+                                h->seq2 + lo2, h->seq2_indices + lo2, m,
+                                h->scoring, ops + pos, &score);
+    }
+
+    if (m == 1) {
+        // One residue of seq2 either matches its best partner in seq1 or becomes a gap
+        const int* scores = profile_row(h->profile, h->seq2_indices[lo2]);
+        size_t best = lo1;
+        for (size_t j = lo1 + 1; j < hi1; j++) {
+            if (scores[j] > scores[best]) best = j;
+        }
+        bool match = scores[best] >= 2 * gap;
+        for (size_t j = lo1; j < hi1; j++) {
+            if (match && j == best) {
+                ops[pos++] = h->seq1[j] == h->seq2[lo2] ? OP_MATCH : OP_MISMATCH;
+            } else {
+                ops[pos++] = OP_DELETE;
+            }
+        }
+        if (!match) ops[pos++] = OP_INSERT;
+        return pos;
+    }
+
+    const size_t mid = lo2 + m / 2;
+    score_row(profile_from(h->profile, lo1), n, h->seq2_indices + lo2, mid - lo2, h->scoring, h->forward);
+    score_row(profile_from(h->profile_reversed, h->len1 - hi1), n, h->seq2_reversed + (h->len2 - hi2), hi2 - mid, h->scoring, h->reverse);
+
+    size_t split = 0;
+    int best = INT_MIN;
+    for (size_t k = 0; k <= n; k++) {
+        int total = h->forward[k] + h->reverse[n - k];
+        if (total > best) {
+            best = total;
+            split = k;
+        }
+    }
+
+    pos = hirschberg(h, lo1, lo1 + split, lo2, mid, ops, pos);
+    return hirschberg(h, lo1 + split, hi1, mid, hi2, ops, pos);
+}
+
+INLINE int align_linear_space(const char* seq1, const size_t len1,
+                              const char* seq2, const size_t len2,
+                              const ScoringMatrix* restrict scoring, uint8_t* restrict ops, int* score) {
+    const size_t profile_size = profile_ints(scoring, len1);
+    int* buffer = (int*)malloc(sizeof(int) * (2 * len1 + 2 * len2 + 2 * (len1 + 1) + 2 * profile_size));
+    int* seq1_indices = buffer;
+    int* seq1_reversed = seq1_indices + len1;
+    int* seq2_indices = seq1_reversed + len1;
+    int* seq2_reversed = seq2_indices + len2;
+    int* forward = seq2_reversed + len2;
+    int* reverse = forward + len1 + 1;
+    int* profile_rows = reverse + len1 + 1;
+
+    seq_to_indices(seq1, len1, seq1_indices, scoring);
+    seq_to_indices(seq2, len2, seq2_indices, scoring);
+    for (size_t j = 0; j < len1; j++) seq1_reversed[j] = seq1_indices[len1 - j - 1];
+    for (size_t i = 0; i < len2; i++) seq2_reversed[i] = seq2_indices[len2 - i - 1];
+
+    Hirschberg h = {
+        .seq1 = seq1, .seq2 = seq2,
+        .profile = build_profile(profile_rows, seq1_indices, len1, scoring),
+        .profile_reversed = build_profile(profile_rows + profile_size, seq1_reversed, len1, scoring),
+        .seq2_indices = seq2_indices, .seq2_reversed = seq2_reversed,
+        .len1 = len1, .len2 = len2,
+        .forward = forward, .reverse = reverse,
+        .scoring = scoring
+    };
+    int pos = hirschberg(&h, 0, len1, 0, len2, ops, 0);
+
+    // Score of the chosen path
+    const int gap = scoring->gap_penalty;
+    int total = 0;
+    for (int k = 0, j = 0, i = 0; k < pos; k++) {
+        if (ops[k] == OP_INSERT) {
+            total += gap;
+            i++;
+        } else if (ops[k] == OP_DELETE) {
+            total += gap;
+            j++;
+        } else {
+            total += profile_row(h.profile, seq2_indices[i++])[j++];
+        }
+    }
+    *score = total;
+
+    free(buffer);
+    return pos;
+}
+
+// Packs the pos columns of ops into the result and fills in the similarity analysis
+INLINE void finish_alignment(Alignment* restrict result, const uint8_t* restrict ops, const int pos) {
+    memset(result->ops, 0, (pos + 3) / 4);
+    result->length = pos;
+
+    result->matches = result->gaps = 0;
+    for (int i = 0; i < pos; i++) {
+        result->ops[i >> 2] |= ops[i] << ((i & 3) * 2);
+        result->matches += ops[i] == OP_MATCH;
+        result->gaps += ops[i] == OP_INSERT;
+    }
+
+    result->mismatches = pos - result->matches - result->gaps;
+    result->similarity = pos ? (double)result->matches / pos : 0;
+}
+
+INLINE Alignment align_sequences(const char seq1[MAX_SEQ_LEN],
+                                 const size_t len1,
+                                 const char seq2[MAX_SEQ_LEN],
+                                 const size_t len2,
+                                 const ScoringMatrix* restrict scoring) {
+    Alignment result;
+    uint8_t ops[ALIGN_BUF];
+    int pos;
+
+    result.start1 = result.start2 = 0;
+    if (!linear_engine(scoring)) {
+        pos = align_gotoh(seq1, len1, seq2, len2, scoring, ops, &result);
+    } else if (len1 <= FULL_DP_LEN && len2 <= FULL_DP_LEN) {
+        int seq1_indices[FULL_DP_LEN];
+        int seq2_indices[FULL_DP_LEN];
+        int profile_rows[(MAX_ALPHABET + 1) * FULL_DP_LEN];
+        seq_to_indices(seq1, len1, seq1_indices, scoring);
+        seq_to_indices(seq2, len2, seq2_indices, scoring);
+        const Profile profile = build_profile(profile_rows, seq1_indices, len1, scoring);
+        pos = align_full(seq1, profile, len1, seq2, seq2_indices, len2, scoring, ops, &result.score);
+    } else {
+        pos = align_linear_space(seq1, len1, seq2, len2, scoring, ops, &result.score);
+    }
+    finish_alignment(&result, ops, pos);
     return result;
 }
 
-#endif
\ No newline at end of file
+// One side of the gapped alignment, gap is OP_INSERT for seq1 and OP_DELETE for seq2, returns the end of out
+INLINE char* render_aligned(const Alignment* restrict result, const char* restrict seq, const AlignOp gap,
+                            char* restrict out) {
+    seq += gap == OP_INSERT ? result->start1 : result->start2;
+    for (int k = 0; k < result->length; k++) *out++ = get_op(result, k) == gap ? '-' : *seq++;
+    return out;
+}
+
+/* Query profile of the last seq1 scored with align_score_cached, kept until seq1 changes so a query
+ * scored against a run of sequences (search, all-vs-all) pays for it once, rows are filled as the
+ * residues of the seq2s come up, a short seq2 rarely holds every residue
+ * Sequences are told apart by address, the owner calls profile_cache_reset before that memory is reused */
+typedef struct {
+    const char* seq1;    // NULL when empty
+    size_t len1;
+    Profile profile;
+    uint64_t filled;     // bit c + 1 for every filled row c
+    int* rows;           // profile rows then the seq1 indices
+    int* seq1_indices;
+    size_t capacity;
+    #ifdef USE_AVX
+    Striped striped;
+    bool striped_ready;
+    #endif
+    int stack[(MAX_ALPHABET + 2) * FULL_DP_LEN];
+} ProfileCache;
+
+INLINE void profile_cache_init(ProfileCache* restrict cache) {
+    cache->seq1 = NULL;
+    cache->rows = cache->stack;
+    cache->capacity = sizeof(cache->stack) / sizeof(int);
+    #ifdef USE_AVX
+    cache->striped_ready = false;
+    #endif
+}
+
+INLINE void profile_cache_reset(ProfileCache* restrict cache) {
+    cache->seq1 = NULL;
+    #ifdef USE_AVX
+    if (cache->striped_ready) striped_free(&cache->striped);
+    cache->striped_ready = false;
+    #endif
+}
+
+INLINE void profile_cache_free(ProfileCache* restrict cache) {
+    profile_cache_reset(cache);
+    if (cache->rows != cache->stack) free(cache->rows);
+}
+
+INLINE void profile_cache_set(ProfileCache* restrict cache, const char* seq1, const size_t len1,
+                              const ScoringMatrix* restrict scoring) {
+    if (cache->seq1 == seq1 && cache->len1 == len1) return;
+    profile_cache_reset(cache);
+
+    const size_t needed = profile_ints(scoring, len1) + len1;
+    if (needed > cache->capacity) {
+        if (cache->rows != cache->stack) free(cache->rows);
+        cache->rows = (int*)malloc(sizeof(int) * needed);
+        cache->capacity = needed;
+    }
+    cache->seq1_indices = cache->rows + profile_ints(scoring, len1);
+    seq_to_indices(seq1, len1, cache->seq1_indices, scoring);
+    cache->profile = (Profile){cache->rows, len1};
+    cache->filled = 0;
+    cache->seq1 = seq1;
+    cache->len1 = len1;
+}
+
+// Fills the rows of the len2 residues, or every row when seq2_indices is NULL
+INLINE void profile_cache_fill(ProfileCache* restrict cache, const int* restrict seq2_indices, const size_t len2,
+                               const ScoringMatrix* restrict scoring) {
+    const size_t count = seq2_indices ? len2 : (size_t)scoring->size + 1;
+    for (size_t i = 0; i < count; i++) {
+        const int c = seq2_indices ? seq2_indices[i] : (int)i - 1;
+        if (cache->filled & (1ULL << (c + 1))) continue;
+        fill_profile_row(cache->rows, cache->seq1_indices, cache->len1, scoring, c);
+        cache->filled |= 1ULL << (c + 1);
+    }
+}
+
+// Score only, keeps a single DP row and skips the traceback and similarity analysis
+INLINE int align_score_cached(ProfileCache* restrict cache,
+                              const char* seq1, const size_t len1,
+                              const char* seq2, const size_t len2,
+                              const ScoringMatrix* restrict scoring) {
+    profile_cache_set(cache, seq1, len1, scoring);
+    const bool linear = linear_engine(scoring) && scoring->threshold == NO_THRESHOLD;
+
+    int stack[3 * (FULL_DP_LEN + 1)];
+    int* buffer = stack;
+    if (UNLIKELY(len1 > FULL_DP_LEN || len2 > FULL_DP_LEN)) {
+        buffer = (int*)malloc(sizeof(int) * (2 * len1 + len2 + 2));
+    }
+    int* seq2_indices = buffer;
+    int* row = seq2_indices + len2;
+    seq_to_indices(seq2, len2, seq2_indices, scoring);
+
+    int score;
+    #ifdef USE_AVX
+    if (len1 >= STRIPED_MIN_LEN && len2 > 0 && striped_fits(len1, len2, scoring)) {
+        // The striped profile only depends on seq1 and outlives the pair with the rest of the cache
+        Striped* s = &cache->striped;
+        if (!cache->striped_ready) {
+            profile_cache_fill(cache, NULL, 0, scoring);
+            striped_init(s, cache->profile, len1, scoring);
+            cache->striped_ready = true;
+        }
+        striped_reset(s, scoring);
+        if (linear) {
+            for (int i = 1; i <= (int)len2; ++i) striped_row(s, seq2_indices[i - 1], i, scoring->gap_penalty);
+            score = striped_cell(s, len1 - 1);
+        } else {
+            score = striped_score(s, seq2_indices, len1, len2, scoring);
+        }
+        if (buffer != stack) free(buffer);
+        return score;
+    }
+    #endif
+
+    profile_cache_fill(cache, seq2_indices, len2, scoring);
+    if (linear) {
+        score_row(cache->profile, len1, seq2_indices, len2, scoring, row);
+        score = row[len1];
+    } else {
+        score = score_gotoh(cache->profile, len1, seq2_indices, len2, scoring, row, row + len1 + 1);
+    }
+
+    if (buffer != stack) free(buffer);
+    return score;
+}
+
+INLINE int align_score(const char seq1[MAX_SEQ_LEN],
+                       const size_t len1,
+                       const char seq2[MAX_SEQ_LEN],
+                       const size_t len2,
+                       const ScoringMatrix* restrict scoring) {
+    ProfileCache cache;
+    profile_cache_init(&cache);
+    int score = align_score_cached(&cache, seq1, len1, seq2, len2, scoring);
+    profile_cache_free(&cache);
+    return score;
+}
+
+#endif
@@ -0,0 +1,236 @@
+#ifndef STRIPED_H
+#define STRIPED_H
+
+#include "scoring.h"
+
+/* Striped (Farrar) DP rows in saturating 16-bit lanes
+ * Column j0 of seq1 lives in lane j0 / seg_len of vector j0 % seg_len, so the diagonal and
+ * vertical terms are plain vector ops and only the left gap needs the lazy F correction loop
+ * The Gotoh rows keep the vertical gap per vector in s->e and the lazy loop carries the open/extend F,
+ * they serve affine gaps and the local and semi-global modes
+ * Only used when striped_fits holds, which keeps every real score clear of saturation */
+
+#ifdef USE_AVX
+
+#define STRIPED_MIN_LEN (32)
+#define STRIPED_STACK_LEN (128)
+#define STRIPED_STACK_SEGS ((STRIPED_STACK_LEN + NUM_ELEMS16 - 1) / NUM_ELEMS16)
+#define STRIPED_NEG_INF (INT16_MIN)
+
+typedef struct {
+    veci_t* profile;    // (size + 1) rows of seg_len vectors, row 0 for unknown residues
+    veci_t* h_prev;
+    veci_t* h_curr;
+    veci_t* e;          // Gotoh rows only, best score ending in a gap in seq1, for the next row
+    veci_t* heap;
+    int seg_len;
+    veci_t stack[(MAX_ALPHABET + 4) * STRIPED_STACK_SEGS];
+} Striped;
+
+INLINE bool striped_fits(const size_t len1, const size_t len2, const ScoringMatrix* restrict scoring) {
+    // Every residue of a path costs at most one gap open, validate_config keeps gap_open <= gap_extend
+    const int gap = open_penalty(scoring);
+    if (gap >= 0) return false;
+    const long long lowest = (long long)(len1 + len2 + 2) * gap + (scoring->min_score < 0 ? scoring->min_score : 0);
+    const long long highest = (long long)(len1 < len2 ? len1 : len2) * (scoring->max_score > 0 ? scoring->max_score : 0);
+    return lowest > INT16_MIN + 1 && highest < INT16_MAX;
+}
+
+// Stripes the query profile of seq1, striped_reset then starts the DP for every seq2
+INLINE void striped_init(Striped* restrict s, const Profile profile, const size_t len1,
+                         const ScoringMatrix* restrict scoring) {
+    const int seg_len = (len1 + NUM_ELEMS16 - 1) / NUM_ELEMS16;
+    s->seg_len = seg_len;
+    s->heap = NULL;
+    veci_t* buffer = s->stack;
+    if (UNLIKELY(seg_len > STRIPED_STACK_SEGS)) {
+        s->heap = buffer = (veci_t*)mat_aligned_alloc(BYTES, sizeof(veci_t) * (scoring->size + 4) * seg_len);
+    }
+    s->profile = buffer;
+    s->h_prev = buffer + (scoring->size + 1) * seg_len;
+    s->h_curr = s->h_prev + seg_len;
+    s->e = s->h_curr + seg_len;
+
+    for (int r = -1; r < scoring->size; r++) {
+        const int* restrict scores = profile_row(profile, r);
+        int16_t* out = (int16_t*)(s->profile + (r + 1) * seg_len);
+        for (int v = 0; v < seg_len; v++) {
+            for (int k = 0; k < NUM_ELEMS16; k++) {
+                const size_t j0 = (size_t)k * seg_len + v;
+                out[v * NUM_ELEMS16 + k] = j0 < len1 ? scores[j0] : 0;
+            }
+        }
+    }
+}
+
+INLINE void striped_reset(Striped* restrict s, const ScoringMatrix* restrict scoring) {
+    const int seg_len = s->seg_len;
+
+    // Row 0 of the DP, saturating past the end of seq1 is harmless as no real column reads those lanes
+    int16_t* first = (int16_t*)s->h_prev;
+    for (int v = 0; v < seg_len; v++) {
+        for (int k = 0; k < NUM_ELEMS16; k++) {
+            const int value = edge_cost(scoring, k * seg_len + v + 1);
+            first[v * NUM_ELEMS16 + k] = value < INT16_MIN ? INT16_MIN : (int16_t)value;
+        }
+    }
+
+    // Row 1 can only open a vertical gap below row 0
+    const veci_t open = set1_epi16(open_penalty(scoring));
+    for (int v = 0; v < seg_len; v++) s->e[v] = adds_epi16(s->h_prev[v], open);
+}
+
+INLINE void striped_free(Striped* restrict s) {
+    if (s->heap) mat_aligned_free(s->heap);
+}
+
+// Computes DP row i (1 based) from the previous one, the result is left in s->h_prev
+INLINE void striped_row(Striped* restrict s, const int c2_idx, const int i, const int gap) {
+    const int seg_len = s->seg_len;
+    const veci_t* restrict profile = s->profile + (c2_idx + 1) * seg_len;
+    const veci_t gap_vec = set1_epi16(gap);
+    veci_t* restrict h_prev = s->h_prev;
+    veci_t* restrict h_curr = s->h_curr;
+
+    // Lane 0 of the first vector borders column 0, whose scores are (i - 1) * gap and i * gap
+    veci_t diag = shift_in_epi16(h_prev[seg_len - 1], (i - 1) * gap);
+    veci_t f = shift_in_epi16(set1_epi16(STRIPED_NEG_INF), (i + 1) * gap);
+
+    for (int v = 0; v < seg_len; v++) {
+        veci_t h = adds_epi16(diag, profile[v]);
+        h = max_epi16(h, adds_epi16(h_prev[v], gap_vec));
+        h = max_epi16(h, f);
+        h_curr[v] = h;
+        f = adds_epi16(h, gap_vec);
+        diag = h_prev[v];
+    }
+
+    // Carry the left gap across lane boundaries until it no longer improves any cell
+    f = shift_in_epi16(f, STRIPED_NEG_INF);
+    int v = 0;
+    while (movemask_epi8(cmpgt_epi16(f, h_curr[v]))) {
+        h_curr[v] = max_epi16(h_curr[v], f);
+        f = adds_epi16(f, gap_vec);
+        if (++v == seg_len) {
+            v = 0;
+            f = shift_in_epi16(f, STRIPED_NEG_INF);
+        }
+    }
+
+    s->h_prev = h_curr;
+    s->h_curr = h_prev;
+}
+
+INLINE int16_t saturate16(const int value) {
+    return value < INT16_MIN ? INT16_MIN : value > INT16_MAX ? INT16_MAX : (int16_t)value;
+}
+
+// striped_row with Gotoh's recurrence, i is 1 based and the result is left in s->h_prev
+INLINE void striped_row_gotoh(Striped* restrict s, const int c2_idx, const int i, const ScoringMatrix* restrict scoring) {
+    const int seg_len = s->seg_len;
+    const veci_t* restrict profile = s->profile + (c2_idx + 1) * seg_len;
+    const veci_t open = set1_epi16(open_penalty(scoring));
+    const veci_t extend = set1_epi16(extend_penalty(scoring));
+    const veci_t floor = set1_epi16(scoring->mode == ALIGN_LOCAL ? 0 : STRIPED_NEG_INF);
+    veci_t* restrict h_prev = s->h_prev;
+    veci_t* restrict h_curr = s->h_curr;
+    veci_t* restrict e = s->e;
+
+    // Column 0 holds a single gap of i residues, column 1 can only open a new one after it
+    veci_t diag = shift_in_epi16(h_prev[seg_len - 1], saturate16(edge_cost(scoring, i - 1)));
+    veci_t f = shift_in_epi16(set1_epi16(STRIPED_NEG_INF), saturate16(edge_cost(scoring, i) + open_penalty(scoring)));
+
+    for (int v = 0; v < seg_len; v++) {
+        veci_t h = adds_epi16(diag, profile[v]);
+        h = max_epi16(h, e[v]);
+        h = max_epi16(h, f);
+        h = max_epi16(h, floor);
+        h_curr[v] = h;
+        const veci_t h_open = adds_epi16(h, open);
+        e[v] = max_epi16(adds_epi16(e[v], extend), h_open);
+        f = max_epi16(adds_epi16(f, extend), h_open);
+        diag = h_prev[v];
+    }
+
+    /* F below h + open - extend can neither raise h nor beat the F the first pass already
+     * opened from h, a cell it does raise also reopens the vertical gap below it */
+    const veci_t reopen = set1_epi16(open_penalty(scoring) - extend_penalty(scoring));
+    f = shift_in_epi16(f, STRIPED_NEG_INF);
+    int v = 0;
+    while (movemask_epi8(cmpgt_epi16(f, adds_epi16(h_curr[v], reopen)))) {
+        h_curr[v] = max_epi16(h_curr[v], f);
+        e[v] = max_epi16(e[v], adds_epi16(h_curr[v], open));
+        f = adds_epi16(f, extend);
+        if (++v == seg_len) {
+            v = 0;
+            f = shift_in_epi16(f, STRIPED_NEG_INF);
+        }
+    }
+
+    s->h_prev = h_curr;
+    s->h_curr = h_prev;
+}
+
+INLINE int hmax_epi16(const veci_t v) {
+    int16_t lanes[NUM_ELEMS16];
+    storeu((veci_t*)lanes, v);
+    int best = lanes[0];
+    for (int k = 1; k < NUM_ELEMS16; k++) best = lanes[k] > best ? lanes[k] : best;
+    return best;
+}
+
+// Cell j0 (0 based) of the last computed row
+INLINE int striped_cell(const Striped* restrict s, const size_t j0) {
+    return ((const int16_t*)(s->h_prev + j0 % s->seg_len))[j0 / s->seg_len];
+}
+
+/* Score of seq1 (set up by striped_init and striped_reset) against seq2 with striped_row_gotoh for every mode,
+ * returns SCORE_DISCARDED once no cell left can reach scoring->threshold
+ * Padding lanes only ever copy real cells with a zero score or lower them, so they never raise a maximum */
+INLINE int striped_score(Striped* restrict s, const int* restrict seq2_indices, const size_t len1, const size_t len2,
+                         const ScoringMatrix* restrict scoring) {
+    const AlignMode mode = scoring->mode;
+    const bool filter = scoring->threshold != NO_THRESHOLD;
+    veci_t cells = set1_epi16(0);    // local: every cell so far
+    int best = mode == ALIGN_GLOBAL ? INT_MIN : 0;    // local: best cell so far, semi-global: best of the last column
+
+    for (size_t i = 1; i <= len2; ++i) {
+        striped_row_gotoh(s, seq2_indices[i - 1], i, scoring);
+        if (mode == ALIGN_SEMIGLOBAL && striped_cell(s, len1 - 1) > best) best = striped_cell(s, len1 - 1);
+        if (mode != ALIGN_LOCAL && !filter) continue;
+
+        veci_t row = s->h_prev[0];
+        for (int v = 1; v < s->seg_len; v++) row = max_epi16(row, s->h_prev[v]);
+        if (mode == ALIGN_LOCAL) {
+            cells = max_epi16(cells, row);
+            best = hmax_epi16(cells);
+        }
+        if (filter && i < len2 && best < scoring->threshold) {
+            // Column 0 is not in the striped row
+            const int row_best = hmax_epi16(row) > edge_cost(scoring, i) ? hmax_epi16(row) : edge_cost(scoring, i);
+            if (reach_bound(scoring, row_best, len2 - i) < scoring->threshold) return SCORE_DISCARDED;
+        }
+    }
+
+    if (mode == ALIGN_LOCAL) return best;
+    if (mode == ALIGN_GLOBAL) return striped_cell(s, len1 - 1);
+    for (size_t j0 = 0; j0 < len1; j0++) best = striped_cell(s, j0) > best ? striped_cell(s, j0) : best;
+    return best;
+}
+
+// Writes the last computed row to row[1..len1], row[0] is left to the caller
+INLINE void striped_extract(const Striped* restrict s, const size_t len1, int* restrict row) {
+    const int16_t* h = (const int16_t*)s->h_prev;
+    const int seg_len = s->seg_len;
+    for (int k = 0; k < NUM_ELEMS16; k++) {
+        for (int v = 0; v < seg_len; v++) {
+            const size_t j0 = (size_t)k * seg_len + v;
+            if (j0 >= len1) return;
+            row[j0 + 1] = h[v * NUM_ELEMS16 + k];
+        }
+    }
+}
+
+#endif
+
+#endif
@@ -1,54 +1,25 @@
 #ifndef THREAD_H
 #define THREAD_H
 
-#include "seqalign.h"
+#include "result_store.h"
 
 #define MAX_THREADS (16)
 
-#ifdef _WIN32
+typedef struct ThreadWork ThreadWork;
 
-#include <synchapi.h>
+// Runs on every thread in place of the task range, threads split the work between them
+typedef void (*ThreadJob)(ThreadWork* work, void* arg);
 
-#define pthread_create(t, _, sr, a) (void)(*t = CreateThread(NULL, 0, (LPTHREAD_START_ROUTINE)sr, a, 0, NULL))
-#define pthread_join(t, _) WaitForSingleObject(t, INFINITE)
-
-typedef HANDLE sem_t;
-#define sem_init(sem, _, value) *sem = CreateSemaphore(NULL, value, LONG_MAX, NULL)
-#define sem_post(sem) ReleaseSemaphore(*sem, 1, NULL)
-#define sem_wait(sem) WaitForSingleObject(*sem, INFINITE)
-#define sem_destroy(sem) CloseHandle(*sem)
-
-#else
-
-#include <semaphore.h>
-
-#endif
-
-typedef struct {
-    char data[MAX_SEQ_LEN];
-} Sequence;
-
-typedef struct {
-    char data[MAX_CSV_LINE - MAX_SEQ_LEN];
-} OtherData;
-
-typedef struct {
-    const char* seq1;
-    const char* seq2;
-    size_t len1;
-    size_t len2;
-    const ScoringMatrix* scoring;
-    Alignment* result;
-} AlignTask;
-
-typedef struct {
-    AlignTask* tasks;
-    size_t start;
-    size_t end;
+struct ThreadWork {
     sem_t* work_ready;
     sem_t* work_done;
     int active;
-} ThreadWork;
+    int id;
+    LaneScratch lanes;
+    CacheMisses misses;
+    ThreadJob job;
+    void* job_arg;
+};
 
 static ThreadWork* g_thread_work;
 static pthread_t* g_threads;
@@ -74,11 +45,8 @@ INLINE T_Func thread_pool_worker(void* arg) {
         sem_wait(work->work_ready);
         if (!work->active) break;
         
-        for (size_t i = work->start; i < work->end; i++) {
-            AlignTask* task = &work->tasks[i];
-            *task->result = align_sequences(task->seq1, task->len1, task->seq2, task->len2, task->scoring);
-        }
-        
+        work->job(work, work->job_arg);
+
         sem_post(work->work_done);
     }
     T_Ret(NULL);
@@ -87,7 +55,8 @@ INLINE T_Func thread_pool_worker(void* arg) {
 INLINE void init_thread_pool(void) {
     g_num_threads = get_num_threads();
     g_threads = (pthread_t*)malloc(sizeof(pthread_t) * g_num_threads);
-    g_thread_work = (ThreadWork*)malloc(sizeof(ThreadWork) * g_num_threads);
+    // The scratch holds vector members, malloc alone only aligns to 16 bytes
+    g_thread_work = (ThreadWork*)mat_aligned_alloc(CACHE_LINE, sizeof(ThreadWork) * g_num_threads);
     
     for (int t = 0; t < g_num_threads; t++) {
         g_thread_work[t].work_ready = (sem_t*)malloc(sizeof(sem_t));
@@ -95,10 +64,125 @@ INLINE void init_thread_pool(void) {
         sem_init(g_thread_work[t].work_ready, 0, 0);
         sem_init(g_thread_work[t].work_done, 0, 0);
         g_thread_work[t].active = 1;
+        g_thread_work[t].id = t;
+        g_thread_work[t].job = NULL;
+        lanes_init(&g_thread_work[t].lanes);
+        g_thread_work[t].misses = (CacheMisses){0};
         pthread_create(&g_threads[t], NULL, thread_pool_worker, &g_thread_work[t]);
     }
 }
 
+// Returns once every thread has picked up the job, wait_job blocks until they are all done with it
+INLINE void start_job(ThreadJob job, void* arg) {
+    for (int t = 0; t < g_num_threads; t++) {
+        g_thread_work[t].job = job;
+        g_thread_work[t].job_arg = arg;
+        sem_post(g_thread_work[t].work_ready);
+    }
+}
+
+INLINE void wait_job(void) {
+    for (int t = 0; t < g_num_threads; t++) {
+        sem_wait(g_thread_work[t].work_done);
+        g_thread_work[t].job = NULL;
+    }
+}
+
+INLINE void run_job(ThreadJob job, void* arg) {
+    start_job(job, arg);
+    wait_job();
+}
+
+// Same as run_job on the calling thread only
+INLINE void run_job_here(ThreadJob job, void* arg) {
+    ThreadWork work = {0};
+    lanes_init(&work.lanes);
+    job(&work, arg);
+    lanes_free(&work.lanes);
+    free_cache_misses(&work.misses);
+}
+
+/* Dynamic scheduling of a task array, the tasks are cut into chunks of about equal DP cost
+ * and threads pull the next chunk from an atomic counter until none are left,
+ * so a thread that drew long pairs takes fewer chunks instead of holding up the batch */
+
+#define CHUNKS_PER_THREAD (8)
+#define MIN_CHUNK_TASKS (256)    // keeps the lane groups of a chunk full after sorting
+#define MAX_CHUNKS (MAX_THREADS * CHUNKS_PER_THREAD)
+
+typedef struct {
+    AlignTask* tasks;
+    size_t bounds[MAX_CHUNKS + 1];    // chunk c covers tasks [bounds[c], bounds[c + 1])
+    size_t num_chunks;
+    size_t next_chunk;
+    bool score_only;
+} TaskQueue;
+
+INLINE size_t task_cost(const AlignTask* restrict task) {
+    return (task->len1 + 1) * (task->len2 + 1);
+}
+
+// Claims the next chunk and aligns it, returns false once the queue is empty
+INLINE bool align_next_chunk(ThreadWork* work, TaskQueue* queue, size_t* chunk) {
+    *chunk = __atomic_fetch_add(&queue->next_chunk, 1, __ATOMIC_RELAXED);
+    if (*chunk >= queue->num_chunks) return false;
+    align_tasks_cached(&work->lanes, &work->misses, queue->tasks, queue->bounds[*chunk], queue->bounds[*chunk + 1], queue->score_only);
+    return true;
+}
+
+INLINE void task_queue_job(ThreadWork* work, void* arg) {
+    size_t chunk;
+    while (align_next_chunk(work, (TaskQueue*)arg, &chunk));
+}
+
+// Chunks are pulled with task_queue_job, the queue must outlive the job
+INLINE void plan_tasks(TaskQueue* queue, AlignTask* tasks, const size_t count, const bool score_only) {
+    size_t max_chunks = count / MIN_CHUNK_TASKS;
+    if (max_chunks > (size_t)g_num_threads * CHUNKS_PER_THREAD) max_chunks = g_num_threads * CHUNKS_PER_THREAD;
+    if (!max_chunks) max_chunks = 1;
+
+    size_t total_cost = 0;
+    for (size_t t = 0; t < count; t++) total_cost += task_cost(&tasks[t]);
+
+    queue->tasks = tasks;
+    queue->score_only = score_only;
+    queue->num_chunks = queue->next_chunk = 0;
+    queue->bounds[0] = 0;
+
+    // Cut whenever the running cost passes the next multiple of total_cost / max_chunks
+    size_t cost = 0;
+    for (size_t t = 0; t < count && queue->num_chunks < max_chunks - 1; t++) {
+        cost += task_cost(&tasks[t]);
+        if (cost * max_chunks >= total_cost * (queue->num_chunks + 1)) queue->bounds[++queue->num_chunks] = t + 1;
+    }
+    queue->bounds[++queue->num_chunks] = count;
+}
+
+INLINE void run_tasks(AlignTask* tasks, const size_t count, const bool score_only) {
+    TaskQueue queue;
+    plan_tasks(&queue, tasks, count, score_only);
+    run_job(task_queue_job, &queue);
+}
+
+typedef struct {
+    char* data;
+    size_t size;
+} TouchJob;
+
+// Each thread faults in its own slice, so the pages land on the nodes of the threads instead of all on the caller's
+INLINE void touch_job(ThreadWork* work, void* arg) {
+    const TouchJob* job = (const TouchJob*)arg;
+    const size_t lo = job->size * work->id / g_num_threads;
+    const size_t hi = job->size * (work->id + 1) / g_num_threads;
+    for (size_t p = (lo + SMALL_PAGE - 1) & ~(size_t)(SMALL_PAGE - 1); p < hi; p += SMALL_PAGE) job->data[p] = 0;
+}
+
+// Faults in a fresh arena up front so the first batches do not pay for it
+INLINE void touch_pages(void* data, const size_t size) {
+    TouchJob job = {(char*)data, size};
+    run_job(touch_job, &job);
+}
+
 INLINE void destroy_thread_pool(void) {
     for (int t = 0; t < g_num_threads; t++) {
         g_thread_work[t].active = 0;
@@ -108,8 +192,10 @@ INLINE void destroy_thread_pool(void) {
         sem_destroy(g_thread_work[t].work_done);
         free(g_thread_work[t].work_ready);
         free(g_thread_work[t].work_done);
+        lanes_free(&g_thread_work[t].lanes);
+        free_cache_misses(&g_thread_work[t].misses);
     }
-    free(g_thread_work);
+    mat_aligned_free(g_thread_work);
     free(g_threads);
 }
 
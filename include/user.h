@@ -2,16 +2,40 @@
 #define USER_H
 
 // Note: The provided values are defaults and can be changed.
+// Everything except MAX_CSV_LINE and MAX_SEQ_LEN can also be overridden at runtime, see bin/main --help
 
 // The maximum length of any line in your CSV file
 #define MAX_CSV_LINE 256
 
 // The maximum length of any sequence in your CSV file
+// Raise it together with MAX_CSV_LINE to align long proteins, and lower BATCH_SIZE to keep the memory use down
+// Longer sequences can still be scored, the alignment and similarity columns stop with an error on them
 #define MAX_SEQ_LEN 64
 
+// Substitution matrix in the NCBI text format (see matrices/), left empty the built in BLOSUM50 is used
+// Residues are matched case sensitively, ones outside the matrix score 0 against everything
+#define MATRIX_FILE
+
 // The gap penalty for the alignment
 #define GAP_PENALTY -4
 
+// Affine gaps (Gotoh), a gap of k residues scores GAP_OPEN + (k - 1) * GAP_EXTEND instead of k * GAP_PENALTY
+// With MAX_SEQ_LEN raised past 128 longer pairs are aligned in linear space (Myers and Miller) like linear gaps are
+#define MODE_AFFINE 0
+#define GAP_OPEN -10
+#define GAP_EXTEND -1
+
+// Alignment is global (Needleman-Wunsch) unless one of these is set
+// Local (Smith-Waterman) aligns the best scoring pair of substrings, the alignment column only holds that part
+#define MODE_LOCAL 0
+// Semi-global does not penalize gaps at either end of either sequence (overlaps, short sequences inside long ones)
+#define MODE_SEMIGLOBAL 0
+
+// Pairs scoring below SCORE_THRESHOLD are left out of the output, pairs that cannot reach it stop aligning early
+// Applies to pair CSV output and search mode
+#define MODE_THRESHOLD 0
+#define SCORE_THRESHOLD 50
+
 /* INPUT CSV FORMAT RULES
  * - One sequence per line
  * - Fixed number of columns
@@ -44,6 +68,7 @@
 #define WRITE_CSV_HEADER "sequence1,sequence2,label1,label2,score,alignment,matches,mismatches,gaps,similarity\n"
 
 // Sequence 2 position is automatically calculated (this + 1)
+// A negative alignment position leaves the column out, only scores are computed if similarity analysis is also off
 #define WRITE_CSV_SEQ1_POS 0
 #define WRITE_CSV_SCORE_POS 4
 #define WRITE_CSV_ALIGN_POS 5
@@ -54,23 +79,51 @@
 
 // Alignment format for printf, only rules are to have two %s and to follow printf syntax
 #define WRITE_CSV_ALIGN_FMT "\"('%s', '%s')\""
+// Writes the alignment column as a CIGAR string instead, runs of = (match), X (mismatch), I (gap in sequence 1)
+// and D (gap in sequence 2), WRITE_CSV_ALIGN_FMT is not used then
+#define WRITE_CSV_ALIGN_CIGAR 0
 
 // Paths must be absolute. You can populate these with the python user script, or just copy paste the desired absolute paths.
+// "-" reads the input from stdin and writes the CSV to stdout, all-vs-all and binary outputs need a file
+// gzip and zstd inputs are read as they are, an OUTPUT_FILE ending in .gz or .zst is compressed
 #define INPUT_FILE
 #define OUTPUT_FILE
 
+/* Search mode, set to align every input row against each sequence in this CSV (same format as the input)
+ * Only the TOP_K best rows per query are written, as query,rank,score followed by the input row */
+#define QUERY_FILE
+#define TOP_K 10
+
 // Modes //
 #define MODE_MULTITHREAD 0
 #define SIMILARITY_ANALYSIS 1
 #define MODE_WRITE 1
+// Scores every sequence against every other and writes an N x N int32 matrix to OUTPUT_FILE instead of CSV
+#define MODE_ALL_VS_ALL 0
+// Writes pair results as binary columns (read with scripts/aligner.py read_columns) instead of CSV
+#define MODE_BINARY 0
 
 // Speed constants //
 #define BATCH_SIZE 32768
 
+// Results of pairs seen before are copied from a cache of this size instead of aligned again, 0 turns it off
+// Pays off on inputs with repeated pairs of sequences, the hit rate is printed at the end
+#define RESULT_CACHE_MB 64
+
+// Results are also kept in this file across runs, rerunning an input that grew only aligns the pairs not seen before
+// Records are kept per substitution matrix, gap, mode and threshold setting, all-vs-all does not use it
+#define RESULT_STORE_FILE
+
+// Output is handed to a writer thread in a ring of WRITE_BUFFERS buffers of WRITE_BUFFER_KB each,
+// alignment only waits on the disk once every buffer is queued
+#define WRITE_BUFFER_KB 1024
+#define WRITE_BUFFERS 4
+// Drops written output from the page cache as it goes, for outputs larger than RAM (Linux only)
+#define WRITE_DROP_CACHE 0
+
 // Helper constants, do not change //
 #define KiB (1ULL << 10)
 #define MiB (KiB  << 10)
 #define GiB (MiB  << 10)
 
-#define WRITE_BUF (128 * KiB) // Buffer size for writing output
 #endif
\ No newline at end of file
@@ -0,0 +1,265 @@
+"""In-process alignment through the shared library built with `make lib`"""
+
+import ctypes
+import platform
+import struct
+from array import array
+from dataclasses import dataclass
+from pathlib import Path
+
+try:
+    from .config_schema import project_root, DEFAULT_VALUES
+except ImportError:
+    from config_schema import project_root, DEFAULT_VALUES
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+MATRIX_MAGIC = b"SEQALNMX"
+MATRIX_HEADER_SIZE = 64
+COLUMNS_MAGIC = b"SEQALNCL"
+COLUMNS_HEADER_SIZE = 384
+_COLUMN_INFO = struct.Struct("<16s8sQQ")
+_ARRAY_TYPECODES = {"<i4": "i", "<u8": "Q", "<f8": "d", "|S1": "B"}
+
+LIBRARY_NAME = "libseqalign.dll" if platform.system() == "Windows" else "libseqalign.so"
+DEFAULT_LIBRARY = project_root / "bin" / LIBRARY_NAME
+ALIGN_MODES = ("global", "local", "semiglobal")    # AlignMode order in include/common.h
+
+_i32_p = ctypes.POINTER(ctypes.c_int32)
+_i64_p = ctypes.POINTER(ctypes.c_int64)
+_f64_p = ctypes.POINTER(ctypes.c_double)
+
+
+@dataclass
+class BatchResult:
+    scores: object
+    alignments: list = None
+    matches: object = None
+    mismatches: object = None
+    gaps: object = None
+    similarity: object = None
+
+    def __len__(self):
+        return len(self.scores)
+
+
+def _pack(seqs):
+    """Returns (buffer, offsets, lengths) for a batch of sequences
+
+    Accepts str/bytes iterables and NumPy arrays of fixed width bytes ('S' dtype),
+    the latter are passed to the library without joining
+    """
+    if np is not None and isinstance(seqs, np.ndarray):
+        if seqs.dtype.kind != "S":
+            raise TypeError("NumPy sequence arrays must have a bytes ('S') dtype")
+        seqs = np.ascontiguousarray(seqs)
+        itemsize = seqs.dtype.itemsize
+        offsets = np.arange(len(seqs), dtype=np.int64) * itemsize
+        lengths = np.char.str_len(seqs).astype(np.int64)
+        return (
+            seqs.tobytes(),
+            array("q", offsets.tobytes()),
+            array("q", lengths.tobytes()),
+        )
+
+    encoded = [s.encode("ascii") if isinstance(s, str) else bytes(s) for s in seqs]
+    lengths = array("q", map(len, encoded))
+    offsets = array("q", [0]) * len(encoded)
+    pos = 0
+    for i, length in enumerate(lengths):
+        offsets[i] = pos
+        pos += length
+    return b"".join(encoded), offsets, lengths
+
+
+def _pointer(buffer, ctype):
+    return ctypes.cast(buffer.buffer_info()[0], ctype) if len(buffer) else None
+
+
+def _as_array(values, typecode):
+    if np is not None:
+        return np.frombuffer(values, dtype={"i": np.int32, "d": np.float64}[typecode])
+    return values
+
+
+def read_score_matrix(path):
+    """Reads the N x N int32 matrix written by `bin/main --all-vs-all 1`
+
+    Returns a read-only NumPy memmap when NumPy is available, otherwise a list of rows
+    """
+    with open(path, "rb") as f:
+        header = f.read(MATRIX_HEADER_SIZE)
+        if len(header) < MATRIX_HEADER_SIZE or header[:8] != MATRIX_MAGIC:
+            raise ValueError(f"Not a score matrix file: {path}")
+        count = int.from_bytes(header[8:16], "little")
+
+        if np is not None:
+            return np.memmap(
+                path,
+                dtype=np.int32,
+                mode="r",
+                offset=MATRIX_HEADER_SIZE,
+                shape=(count, count),
+            )
+
+        scores = array("i")
+        scores.fromfile(f, count * count)
+    return [scores[i * count : (i + 1) * count] for i in range(count)]
+
+
+def read_columns(path):
+    """Reads the pair results written by `bin/main --binary 1` into a dict of columns
+
+    Always has "score", "matches", "mismatches", "gaps" and "similarity" with similarity analysis,
+    "align_offsets" and "alignment" with an alignment column. Row i is input rows i and i + 1.
+    Columns are read-only NumPy memmaps when NumPy is available, otherwise arrays.
+    Use read_alignment to get the aligned strings of a row.
+    """
+    with open(path, "rb") as f:
+        header = f.read(COLUMNS_HEADER_SIZE)
+        if len(header) < COLUMNS_HEADER_SIZE or header[:8] != COLUMNS_MAGIC:
+            raise ValueError(f"Not a binary columns file: {path}")
+        num_columns = int.from_bytes(header[16:20], "little")
+
+        columns = {}
+        for c in range(num_columns):
+            name, dtype, offset, length = _COLUMN_INFO.unpack_from(
+                header, 24 + c * _COLUMN_INFO.size
+            )
+            name = name.rstrip(b"\0").decode()
+            dtype = dtype.rstrip(b"\0").decode()
+
+            if np is not None:
+                columns[name] = (
+                    np.memmap(path, dtype=dtype, mode="r", offset=offset, shape=(length,))
+                    if length
+                    else np.empty(0, dtype=dtype)
+                )
+            else:
+                values = array(_ARRAY_TYPECODES[dtype])
+                f.seek(offset)
+                values.fromfile(f, length)
+                columns[name] = values
+    return columns
+
+
+def read_alignment(columns, row):
+    """Aligned (seq1, seq2) strings of one row of read_columns"""
+    start, end = int(columns["align_offsets"][row]), int(columns["align_offsets"][row + 1])
+    half = (end - start) // 2
+    heap = bytes(columns["alignment"][start:end])
+    return heap[:half].decode(), heap[half:].decode()
+
+
+class Aligner:
+    """Wraps align_sequences from include/seqalign.h
+
+    Alignments are limited to the MAX_SEQ_LEN value the library was compiled with,
+    scores alone work for any length. The gap penalty is passed on every call,
+    giving gap_open switches to affine gaps (gap_open + (k - 1) * gap_extend for k residues)
+    and mode picks global, local (Smith-Waterman) or semiglobal (free end gaps) alignment.
+    matrix is the path of a substitution matrix in the NCBI text format, BLOSUM50 when left out
+    """
+
+    def __init__(
+        self,
+        gap_penalty=int(DEFAULT_VALUES["GAP_PENALTY"]),
+        library=None,
+        gap_open=None,
+        gap_extend=int(DEFAULT_VALUES["GAP_EXTEND"]),
+        mode="global",
+        matrix=None,
+    ):
+        path = Path(library) if library else DEFAULT_LIBRARY
+        if not path.exists():
+            raise FileNotFoundError(
+                f"Alignment library not found: {path} (build it with `make lib`)"
+            )
+        if gap_penalty >= 0:
+            raise ValueError("Gap penalty must be <0")
+        if gap_open is not None and not gap_open <= gap_extend < 0:
+            raise ValueError("Gap extend must be <0 and gap open at most gap extend")
+        if mode not in ALIGN_MODES:
+            raise ValueError(f"Mode must be one of {', '.join(ALIGN_MODES)}")
+        if matrix and not Path(matrix).is_file():
+            raise FileNotFoundError(f"Substitution matrix not found: {matrix}")
+
+        self.gap_penalty = gap_penalty
+        self.gap_open = gap_open or 0
+        self.gap_extend = gap_extend
+        self.mode = ALIGN_MODES.index(mode)
+        self.matrix = str(matrix).encode() if matrix else None
+        self._lib = ctypes.CDLL(str(path))
+        self._lib.seqalign_align_batch.restype = ctypes.c_int64
+        self._lib.seqalign_align_batch.argtypes = [
+            ctypes.c_char_p, _i64_p, _i64_p,
+            ctypes.c_char_p, _i64_p, _i64_p,
+            ctypes.c_int64, ctypes.c_int, ctypes.c_int, ctypes.c_int,
+            ctypes.c_int, ctypes.c_char_p, _i32_p,
+            ctypes.c_char_p, ctypes.c_char_p,
+            _i32_p, _f64_p,
+        ]
+        self.max_seq_len = self._lib.seqalign_max_seq_len()
+        self.align_buf = self._lib.seqalign_align_buf()
+
+    def _aligned_str(self, buffer, index):
+        start = index * self.align_buf
+        return buffer[start : start + self.align_buf].split(b"\0", 1)[0].decode()
+
+    def align(self, seq1, seq2):
+        result = self.align_batch([seq1], [seq2])
+        return result.scores[0], result.alignments[0]
+
+    def align_batch(self, seqs1, seqs2, alignments=True):
+        data1, offsets1, lengths1 = _pack(seqs1)
+        data2, offsets2, lengths2 = _pack(seqs2)
+        count = len(lengths1)
+        if count != len(lengths2):
+            raise ValueError(f"Batch sizes differ ({count} and {len(lengths2)})")
+
+        scores = array("i", [0]) * count
+        aligned1 = aligned2 = None
+        if alignments:
+            aligned1 = ctypes.create_string_buffer(count * self.align_buf)
+            aligned2 = ctypes.create_string_buffer(count * self.align_buf)
+        # Without alignments the library uses the score only engine
+        stats = array("i", [0]) * (count * 3) if alignments else None
+        similarity = array("d", [0.0]) * count if alignments else None
+
+        done = self._lib.seqalign_align_batch(
+            data1, _pointer(offsets1, _i64_p), _pointer(lengths1, _i64_p),
+            data2, _pointer(offsets2, _i64_p), _pointer(lengths2, _i64_p),
+            count, self.gap_penalty, self.gap_open, self.gap_extend,
+            self.mode, self.matrix, _pointer(scores, _i32_p),
+            aligned1, aligned2,
+            _pointer(stats, _i32_p) if alignments else None,
+            _pointer(similarity, _f64_p) if alignments else None,
+        )
+        if done < 0:
+            raise ValueError(f"Cannot read substitution matrix {self.matrix.decode()}")
+        if done != count:
+            raise ValueError(
+                f"Pair {done} has a sequence longer than {self.max_seq_len - 1}, "
+                "use alignments=False or rebuild with a larger MAX_SEQ_LEN"
+            )
+
+        result = BatchResult(scores=_as_array(scores, "i"))
+        if alignments:
+            result.alignments = [
+                (self._aligned_str(aligned1, i), self._aligned_str(aligned2, i))
+                for i in range(count)
+            ]
+            result.matches = _as_array(stats[0::3], "i")
+            result.mismatches = _as_array(stats[1::3], "i")
+            result.gaps = _as_array(stats[2::3], "i")
+            result.similarity = _as_array(similarity, "d")
+        return result
+
+
+if __name__ == "__main__":
+    aligner = Aligner()
+    score, (aligned1, aligned2) = aligner.align("KPVSLS", "LNNSRA")
+    print(f"{aligned1}\n{aligned2}\nScore: {score}")
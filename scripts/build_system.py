@@ -5,9 +5,9 @@ import atexit
 from pathlib import Path
 
 try:
-    from .config_schema import project_root
+    from .config_schema import project_root, config_file
 except ImportError:
-    from config_schema import project_root
+    from config_schema import project_root, config_file
 
 
 class BuildEnvironment:
@@ -215,7 +215,12 @@ class BuildEnvironment:
         else:
             binary_path = str(cwd / "bin" / binary_name)
         output_fn("\f")
-        self._run_process(binary_path, output_fn, cwd, process_key=name)
+        self._run_process(
+            f'"{binary_path}" --config "{config_file}"',
+            output_fn,
+            cwd,
+            process_key=name,
+        )
         self._update_button_states(False)
 
     def build_and_run(self, output_fn, binary, target, cwd=project_root):
@@ -2,12 +2,21 @@ from pathlib import Path
 
 project_root = Path(__file__).parent.parent.resolve()
 user_file = project_root / "include" / "user.h"
+config_file = project_root / "user.cfg"
+
+# Only these are compiled in, everything else is read from config_file at startup
+COMPILE_TIME_KEYS = ("MAX_CSV_LINE", "MAX_SEQ_LEN")
+# Used only by the editor, bin/main does not accept it
+EDITOR_ONLY_KEYS = ("READ_CSV_HEADER",)
 
 TOOLTIPS = {
     "MAX_CSV_LINE": "Maximum length of any line in CSV files (must be ≥32)",
     "MAX_SEQ_LEN": "Maximum length of any sequence (must be ≥1)",
     "GAP_PENALTY": "Penalty for gaps when aligning sequences",
+    "GAP_OPEN": "Penalty for the first residue of a gap with affine gaps (must be ≤ Gap Extend)",
+    "GAP_EXTEND": "Penalty for every further residue of a gap with affine gaps, a gap of k residues scores open + (k - 1) * extend",
     "BATCH_SIZE": "Number of sequences to process in each batch for multi-threaded mode",
+    "RESULT_CACHE_MB": "Memory for results of pairs seen before, repeated pairs are copied instead of aligned again (0 turns it off)",
     "READ_CSV_HEADER": """Input CSV Format Rules:
 - One sequence per line
 - Fixed number of columns 
@@ -32,24 +41,39 @@ type_orig,type_comp,name1,name2,seq_first,seq_second,aligned_sequence,points
 if similarity analysis enabled, add: similarity,matches,mismatches,gaps""",
     "WRITE_CSV_SEQ1_POS": "Position of first sequence in output",
     "WRITE_CSV_SCORE_POS": "Position of alignment score in output",
-    "WRITE_CSV_ALIGN_POS": "Position of alignment result in output",
+    "WRITE_CSV_ALIGN_POS": "Position of alignment result in output (negative to leave it out)",
     "WRITE_CSV_MATCHES_POS": "Position of matches in output",
     "WRITE_CSV_MISMATCHES_POS": "Position of mismatches in output",
     "WRITE_CSV_GAPS_POS": "Position of number of gaps in output",
     "WRITE_CSV_SIMILARITY_POS": "Position of similarity in output",
     "WRITE_CSV_ALIGN_FMT": "Printf format for alignment (must contain two %s)",
+    "WRITE_CSV_ALIGN_CIGAR": "Write the alignment column as a CIGAR string (runs of = match, X mismatch, I gap in sequence 1, D gap in sequence 2) instead of the two gapped sequences",
     "INPUT_FILE": "Path to input file",
     "OUTPUT_FILE": "Path to output file",
     "MODE_MULTITHREAD": "Uncheck to disable multithreaded mode (singlethreaded mode will be used)",
     "SIMILARITY_ANALYSIS": "Enable similarity analysis (make sure to update the write header accordingly)",
     "MODE_WRITE": "Uncheck to disable writing to output CSV file",
+    "QUERY_FILE": "Optional CSV of query sequences (same format as the input), when set each query is searched against every input row and only its best hits are written",
+    "MATRIX_FILE": "Optional substitution matrix in NCBI format (see matrices/, e.g. BLOSUM62 or DNA), empty uses the built in BLOSUM50",
+    "RESULT_STORE_FILE": "Optional file that keeps results across runs, rerunning an input that grew only aligns the pairs not seen before (created if missing, not used by all-vs-all)",
+    "TOP_K": "Number of best hits kept and written per query in search mode",
+    "MODE_ALL_VS_ALL": "Score every sequence against every other and write an N x N int32 matrix to the output file instead of CSV (read it with scripts/aligner.py read_score_matrix)",
+    "MODE_BINARY": "Write pair results as binary columns instead of CSV, the alignment and similarity settings still choose the columns (read it with scripts/aligner.py read_columns)",
+    "MODE_AFFINE": "Use affine gaps (Gotoh) with Gap Open and Gap Extend instead of the linear Gap Penalty",
+    "MODE_LOCAL": "Local alignment (Smith-Waterman), scores the best matching region and the alignment only covers that region",
+    "MODE_SEMIGLOBAL": "Semi-global alignment, gaps before and after either sequence are free",
+    "MODE_THRESHOLD": "Leave pairs scoring below Score Threshold out of the CSV and search output, most of them are discarded before they are fully scored",
+    "SCORE_THRESHOLD": "Lowest score written when the score threshold is enabled",
 }
 
 DEFAULT_VALUES = {
     "MAX_CSV_LINE": "256",
     "MAX_SEQ_LEN": "64",
     "GAP_PENALTY": "-4",
+    "GAP_OPEN": "-10",
+    "GAP_EXTEND": "-1",
     "BATCH_SIZE": "32768",
+    "RESULT_CACHE_MB": "64",
     "READ_CSV_HEADER": "sequence,label",
     "READ_CSV_SEQ_POS": "0",
     "READ_CSV_COLS": "2",
@@ -64,19 +88,34 @@ DEFAULT_VALUES = {
     "WRITE_CSV_ALIGN_FMT": "\"('%s', '%s')\"",
     "INPUT_FILE": str(Path(str(project_root / "datasets" / "avpdb.csv")).as_posix()),
     "OUTPUT_FILE": str(Path(str(project_root / "results" / "results.csv")).as_posix()),
+    "QUERY_FILE": "",
+    "MATRIX_FILE": "",
+    "RESULT_STORE_FILE": "",
+    "TOP_K": "10",
+    "SCORE_THRESHOLD": "50",
 }
 
 DEFAULT_CHECKBOXES = {
     "MODE_MULTITHREAD": False,
     "SIMILARITY_ANALYSIS": True,
     "MODE_WRITE": True,
+    "MODE_ALL_VS_ALL": False,
+    "MODE_BINARY": False,
+    "WRITE_CSV_ALIGN_CIGAR": False,
+    "MODE_AFFINE": False,
+    "MODE_LOCAL": False,
+    "MODE_SEMIGLOBAL": False,
+    "MODE_THRESHOLD": False,
 }
 
 DISPLAY_NAMES = {
     "MAX_CSV_LINE": "Maximum CSV Line Length",
     "MAX_SEQ_LEN": "Maximum Sequence Length",
     "GAP_PENALTY": "Gap Penalty",
+    "GAP_OPEN": "Gap Open Penalty",
+    "GAP_EXTEND": "Gap Extend Penalty",
     "BATCH_SIZE": "Batch Size",
+    "RESULT_CACHE_MB": "Result Cache (MB)",
     "READ_CSV_HEADER": "Input CSV Header",
     "READ_CSV_SEQ_POS": "Sequence Column Position",
     "READ_CSV_COLS": "Number of Columns",
@@ -91,9 +130,21 @@ DISPLAY_NAMES = {
     "WRITE_CSV_ALIGN_FMT": "Alignment Format",
     "INPUT_FILE": "Input File",
     "OUTPUT_FILE": "Output File",
+    "QUERY_FILE": "Query File (search mode)",
+    "MATRIX_FILE": "Substitution Matrix File",
+    "RESULT_STORE_FILE": "Result Store File",
+    "TOP_K": "Hits per Query",
+    "SCORE_THRESHOLD": "Score Threshold",
     "MODE_MULTITHREAD": "Enable Multithreaded Mode (faster for files larger than ~10k-100k lines)",
     "SIMILARITY_ANALYSIS": "Enable Similarity Analysis",
     "MODE_WRITE": "Enable Writing to CSV File (useful during development)",
+    "MODE_ALL_VS_ALL": "All-vs-All Score Matrix",
+    "MODE_BINARY": "Binary Columns Output",
+    "WRITE_CSV_ALIGN_CIGAR": "CIGAR Alignment Column",
+    "MODE_AFFINE": "Affine Gaps (Gotoh)",
+    "MODE_LOCAL": "Local Alignment (Smith-Waterman)",
+    "MODE_SEMIGLOBAL": "Semi-global Alignment",
+    "MODE_THRESHOLD": "Score Threshold Filter",
 }
 
 
@@ -104,13 +155,38 @@ def validate_config(fields, checkboxes):
             return False, "Input Header cannot be empty"
 
         read_cols = read_header.count(",") + 1
-        write_mode = checkboxes["MODE_WRITE"].get()
+        query_path = fields["QUERY_FILE"].get().strip()
+        if query_path and checkboxes["MODE_ALL_VS_ALL"].get():
+            return False, "Query File and All-vs-All cannot be combined"
+        if checkboxes["MODE_BINARY"].get() and (
+            query_path or checkboxes["MODE_ALL_VS_ALL"].get()
+        ):
+            return False, "Binary Columns Output only applies to neighbouring pairs"
+        if checkboxes["MODE_LOCAL"].get() and checkboxes["MODE_SEMIGLOBAL"].get():
+            return False, "Local and Semi-global Alignment cannot be combined"
+        if checkboxes["MODE_THRESHOLD"].get() and (
+            checkboxes["MODE_ALL_VS_ALL"].get() or checkboxes["MODE_BINARY"].get()
+        ):
+            return False, "Score Threshold Filter only applies to CSV pair output and search"
+
+        # The all-vs-all matrix, the search hits and binary columns replace the CSV output, so its columns are not checked
+        write_mode = (
+            checkboxes["MODE_WRITE"].get()
+            and not checkboxes["MODE_ALL_VS_ALL"].get()
+            and not checkboxes["MODE_BINARY"].get()
+            and not query_path
+        )
 
         numeric_rules = {
             "MAX_CSV_LINE": (32, "≥32"),
             "MAX_SEQ_LEN": (1, "≥1"),
             "BATCH_SIZE": (1, "≥1"),
+            "RESULT_CACHE_MB": (0, "≥0"),
+            "TOP_K": (1, "≥1"),
             "GAP_PENALTY": (0, "<0", lambda x: x < 0),
+            "GAP_OPEN": (0, "<0", lambda x: x < 0),
+            "GAP_EXTEND": (0, "<0", lambda x: x < 0),
+            "SCORE_THRESHOLD": (0, "a whole number", lambda x: True),
             "READ_CSV_SEQ_POS": (
                 read_cols,
                 f"between 0 and {read_cols-1}",
@@ -132,14 +208,26 @@ def validate_config(fields, checkboxes):
             except ValueError:
                 return False, f"Invalid numeric value for {DISPLAY_NAMES[key]}"
 
+        if checkboxes["MODE_AFFINE"].get() and int(fields["GAP_OPEN"].get()) > int(
+            fields["GAP_EXTEND"].get()
+        ):
+            return False, "Gap Open Penalty must be at most Gap Extend Penalty"
+
         if write_mode:
             write_header = fields["WRITE_CSV_HEADER"].get().strip()
             if not write_header:
                 return False, "Output Header cannot be empty"
 
             write_cols = write_header.count(",") + 1
+            try:
+                has_align = int(fields["WRITE_CSV_ALIGN_POS"].get()) >= 0
+            except ValueError:
+                return False, f"Invalid numeric value for {DISPLAY_NAMES['WRITE_CSV_ALIGN_POS']}"
             expected_cols = (
-                2 * read_cols + 2 + 4 * checkboxes["SIMILARITY_ANALYSIS"].get()
+                2 * read_cols
+                + 1
+                + has_align
+                + 4 * checkboxes["SIMILARITY_ANALYSIS"].get()
             )
             if write_cols != expected_cols:
                 return (
@@ -157,22 +245,23 @@ def validate_config(fields, checkboxes):
                 "WRITE_CSV_SIMILARITY_POS",
             ]
 
-            for field in pos_fields:
+            required_fields = pos_fields[:2]
+            if checkboxes["SIMILARITY_ANALYSIS"].get():
+                required_fields = required_fields + pos_fields[3:]
+
+            for field in required_fields:
                 try:
-                    if (
-                        int(fields[field].get()) == -1
-                        and int(fields[field].get()) != -2
-                    ):
+                    if int(fields[field].get()) < 0:
                         return False, f"{DISPLAY_NAMES[field]} must be set"
                 except ValueError:
                     return False, f"Invalid numeric value for {DISPLAY_NAMES[field]}"
 
-            positions = [int(fields[k].get()) for k in pos_fields[:3]]
+            positions = [int(fields[k].get()) for k in pos_fields[: 2 + has_align]]
 
             if any(not 0 <= p < write_cols for p in positions):
                 return False, "Column positions must be within output column range"
 
-            if len(set(positions + [positions[0] + 1])) != 4:
+            if len(set(positions + [positions[0] + 1])) != len(positions) + 1:
                 return False, "Output columns must have unique positions"
 
             if fields["WRITE_CSV_ALIGN_FMT"].get().count("%s") != 2:
@@ -187,6 +276,17 @@ def validate_config(fields, checkboxes):
         if not Path(input_path).exists():
             return False, f"Input file does not exist: {input_path}"
 
+        if query_path and not Path(query_path).exists():
+            return False, f"Query file does not exist: {query_path}"
+
+        matrix_path = fields["MATRIX_FILE"].get().strip()
+        if matrix_path and not Path(matrix_path).is_file():
+            return False, f"Substitution matrix file does not exist: {matrix_path}"
+
+        store_path = fields["RESULT_STORE_FILE"].get().strip()
+        if store_path and Path(store_path).is_dir():
+            return False, f"Result store must be a file, not a directory: {store_path}"
+
         try:
             Path(output_path).parent.mkdir(parents=True, exist_ok=True)
         except Exception as e:
@@ -198,42 +298,57 @@ def validate_config(fields, checkboxes):
         return False, f"Unexpected validation error: {str(e)}"
 
 
-def save_config(fields, checkboxes):
-    try:
-        with open(user_file, "r") as f:
-            lines = f.readlines()
-
-        new_lines = []
-        for line in lines:
-            if not line.strip().startswith("#define"):
-                new_lines.append(line)
-                continue
-
-            name = line.split()[1]
-            if name in fields:
-                value = fields[name].get()
+def _read_user_defines():
+    with open(user_file, "r") as f:
+        return {
+            parts[1]: parts[2] if len(parts) > 2 else ""
+            for parts in (line.split(maxsplit=2) for line in f)
+            if parts and parts[0] == "#define"
+        }
 
-                if name.endswith("_FILE"):
-                    value = str(Path(value).as_posix())
-                if name.endswith("_HEADER"):
-                    value = value.rstrip("\n") + "\\n"
-                elif name.endswith("_FMT"):
-                    value = value.replace('"', '\\"')
 
-                if any(name.endswith(x) for x in ["_FILE", "_HEADER", "_FMT"]):
-                    value = f'"{value}"'
+def compile_settings_changed(fields):
+    defines = _read_user_defines()
+    return any(
+        defines.get(key, "").strip() != fields[key].get().strip()
+        for key in COMPILE_TIME_KEYS
+        if key in fields
+    )
 
-                new_lines.append(f"#define {name} {value}\n")
 
-            elif name in checkboxes:
-                value = "1" if checkboxes[name].get() else "0"
-                new_lines.append(f"#define {name} {value}\n")
+def save_config(fields, checkboxes):
+    try:
+        if compile_settings_changed(fields):
+            with open(user_file, "r") as f:
+                lines = f.readlines()
+
+            new_lines = []
+            for line in lines:
+                parts = line.split()
+                name = parts[1] if len(parts) > 1 and parts[0] == "#define" else None
+                if name in COMPILE_TIME_KEYS:
+                    new_lines.append(f"#define {name} {fields[name].get()}\n")
+                else:
+                    new_lines.append(line)
+
+            with open(user_file, "w") as f:
+                f.writelines(new_lines)
+
+        config_lines = ["# Generated by the configuration editor, see bin/main --help\n"]
+        for name, field in fields.items():
+            if name in COMPILE_TIME_KEYS or name in EDITOR_ONLY_KEYS:
+                continue
+            value = field.get()
+            # Path("") is ".", optional files stay empty
+            if name.endswith("_FILE") and value.strip():
+                value = str(Path(value).as_posix())
+            config_lines.append(f"{name}={value.rstrip()}\n")
 
-            else:
-                new_lines.append(line)
+        for name, checkbox in checkboxes.items():
+            config_lines.append(f"{name}={1 if checkbox.get() else 0}\n")
 
-        with open(user_file, "w") as f:
-            f.writelines(new_lines)
+        with open(config_file, "w") as f:
+            f.writelines(config_lines)
 
         return True, None
 
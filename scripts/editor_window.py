@@ -5,6 +5,7 @@ import tkinter as tk
 import logging
 from datetime import datetime
 import csv
+import gzip
 import os
 import subprocess
 
@@ -17,6 +18,7 @@ try:
         DEFAULT_CHECKBOXES,
         validate_config,
         save_config,
+        compile_settings_changed,
     )
 except ImportError:
     from build_system import DISPLAY_BINARY_PROFILE, build_env
@@ -27,6 +29,7 @@ except ImportError:
         DEFAULT_CHECKBOXES,
         validate_config,
         save_config,
+        compile_settings_changed,
     )
 
 try:
@@ -116,7 +119,9 @@ class ConfigEditor:
 
     def _read_csv_preview(self, file_path):
         try:
-            with open(file_path, "r") as csvfile:
+            with open(file_path, "rb") as f:
+                is_gzip = f.read(2) == b"\x1f\x8b"
+            with (gzip.open if is_gzip else open)(file_path, "rt") as csvfile:
                 reader = csv.reader(csvfile)
                 header = next(reader)
                 first_row = next(reader)
@@ -430,7 +435,18 @@ class ConfigEditor:
 
         for title, fields in {
             "Size Limits": [
-                k for k in ("MAX_CSV_LINE", "MAX_SEQ_LEN", "GAP_PENALTY", "BATCH_SIZE")
+                k
+                for k in (
+                    "MAX_CSV_LINE",
+                    "MAX_SEQ_LEN",
+                    "GAP_PENALTY",
+                    "GAP_OPEN",
+                    "GAP_EXTEND",
+                    "SCORE_THRESHOLD",
+                    "BATCH_SIZE",
+                    "RESULT_CACHE_MB",
+                    "TOP_K",
+                )
             ],
             "CSV Format": [
                 k
@@ -631,9 +647,7 @@ class ConfigEditor:
                     row,
                     text="Browse",
                     width=None if self.only_tk else 100,
-                    command=lambda e=entry, i=key.startswith(
-                        "INPUT"
-                    ): self._browse_file(e, i),
+                    command=lambda e=entry, k=key: self._browse_file(e, k),
                 ).pack(side="left", padx=5)
 
             self.fields[key] = entry
@@ -669,7 +683,7 @@ class ConfigEditor:
             for key in self.similarity_fields:
                 if key in self.fields:
                     self.fields[key].delete(0, "end")
-                    self.fields[key].insert(0, "-2")
+                    self.fields[key].insert(0, "-1")
 
             similarity_keys = ["Matches", "Mismatches", "Gaps", "Similarity"]
             for key in similarity_keys:
@@ -739,20 +753,28 @@ class ConfigEditor:
             widget.tooltip.destroy()
             del widget.tooltip
 
-    def _browse_file(self, entry, is_input):
+    def _browse_file(self, entry, key):
         current = Path(entry.get())
+        # Substitution matrices have no extension (BLOSUM62, DNA), the result store is not a CSV
+        is_csv = key not in ("MATRIX_FILE", "RESULT_STORE_FILE")
 
         if filename := (
-            filedialog.askopenfilename if is_input else filedialog.asksaveasfilename
+            filedialog.asksaveasfilename
+            if key in ("OUTPUT_FILE", "RESULT_STORE_FILE")
+            else filedialog.askopenfilename
         )(
             initialdir=current.parent,
             initialfile=current.name,
-            defaultextension=".csv",
-            filetypes=[("CSV files", "*.csv")],
+            defaultextension=".csv" if is_csv else "",
+            filetypes=(
+                [("CSV files", "*.csv *.csv.gz *.csv.zst"), ("All files", "*")]
+                if is_csv
+                else [("All files", "*")]
+            ),
         ):
             entry.delete(0, "end")
             entry.insert(0, str(Path(filename).absolute().as_posix()))
-            if is_input:
+            if key == "INPUT_FILE":
                 self._update_csv_info(filename)
 
     def _init_logging(self):
@@ -795,12 +817,16 @@ class ConfigEditor:
             messagebox.showerror("Error", error)
             return
 
+        rebuild = compile_settings_changed(self.fields)
         ok, error = save_config(self.fields, self.checkboxes)
         if not ok:
             messagebox.showerror("Error", error)
             return
 
         messagebox.showinfo("Success", "Configuration saved successfully!")
+        if not rebuild:
+            return
+
         build_env.reset_build_status()
         build_env.run_make(
             self.update_output,
@@ -0,0 +1,73 @@
+#include "seqalign.h"
+
+#ifdef _WIN32
+#define EXPORT __declspec(dllexport)
+#else
+#define EXPORT __attribute__((visibility("default")))
+#endif
+
+/* Shared library entry points used by scripts/aligner.py
+ * Sequences are passed as one contiguous buffer with an offset and length per sequence,
+ * which is the layout of both joined bytes objects and fixed width NumPy 'S' arrays */
+
+EXPORT int seqalign_max_seq_len(void) {
+    return MAX_SEQ_LEN;
+}
+
+EXPORT int seqalign_align_buf(void) {
+    return ALIGN_BUF;
+}
+
+/* Returns the number of aligned pairs, a gap_open of 0 keeps linear gaps and otherwise switches to affine ones
+ * mode takes the AlignMode values, local and semi-global alignments only cover the aligned region
+ * matrix_file is a substitution matrix in the NCBI text format or NULL for BLOSUM50, -1 if it cannot be read
+ * Score only calls (all output pointers except scores NULL) accept any length,
+ * otherwise stops early at the first pair with a sequence longer than MAX_SEQ_LEN */
+EXPORT int64_t seqalign_align_batch(const char* data1, const int64_t* offsets1, const int64_t* lengths1,
+                                    const char* data2, const int64_t* offsets2, const int64_t* lengths2,
+                                    int64_t count, int gap_penalty, int gap_open, int gap_extend,
+                                    int mode, const char* matrix_file, int32_t* scores,
+                                    char* aligned1, char* aligned2,
+                                    int32_t* stats, double* similarity) {
+    ScoringMatrix scoring;
+    init_scoring_matrix(&scoring);
+    if (matrix_file && load_matrix(&scoring, matrix_file)) return -1;
+    scoring.gap_penalty = gap_penalty;
+    scoring.affine = gap_open != 0;
+    scoring.gap_open = gap_open;
+    scoring.gap_extend = gap_extend;
+    scoring.mode = (AlignMode)mode;
+
+    const bool score_only = !aligned1 && !aligned2 && !stats && !similarity;
+    ProfileCache cache;
+    profile_cache_init(&cache);
+
+    for (int64_t n = 0; n < count; n++) {
+        if (score_only) {
+            scores[n] = align_score_cached(&cache, data1 + offsets1[n], lengths1[n],
+                                           data2 + offsets2[n], lengths2[n], &scoring);
+            continue;
+        }
+
+        if (UNLIKELY(lengths1[n] >= MAX_SEQ_LEN || lengths2[n] >= MAX_SEQ_LEN)) {
+            profile_cache_free(&cache);
+            return n;
+        }
+
+        Alignment result = align_sequences(data1 + offsets1[n], lengths1[n], data2 + offsets2[n], lengths2[n], &scoring);
+        scores[n] = result.score;
+
+        if (aligned1) *render_aligned(&result, data1 + offsets1[n], OP_INSERT, aligned1 + n * ALIGN_BUF) = '\0';
+        if (aligned2) *render_aligned(&result, data2 + offsets2[n], OP_DELETE, aligned2 + n * ALIGN_BUF) = '\0';
+
+        if (stats) {
+            stats[n * 3 + 0] = result.matches;
+            stats[n * 3 + 1] = result.mismatches;
+            stats[n * 3 + 2] = result.gaps;
+        }
+        if (similarity) similarity[n] = result.similarity;
+    }
+
+    profile_cache_free(&cache);
+    return count;
+}
@@ -1,135 +1,310 @@
-#include "csv.h"
+#include "all_vs_all.h"
+#include "search.h"
 
-#if MODE_MULTITHREAD == 1    
-#include "thread.h"
-#endif // MODE_MULTITHREAD
+/* Multithreaded pairs run as a pipeline over PIPELINE_DEPTH batches, while the main thread writes batch k - 1
+ * the pool parses batch k + 1 straight from the row index and then aligns and formats batch k, the main thread
+ * joins in once it is done writing */
 
-int main(void) {
-    SET_HIGH_CLASS();
-    #if MODE_MULTITHREAD == 1
-    init_thread_pool();
-    #else // MODE_MULTITHREAD == 0
-    PIN_THREAD(0);
-    #endif // MODE_MULTITHREAD
-    
-    Files files = get_files();
-    char* current = files.file_data;
-    char* end = files.file_data + files.data_size;
-    current = skip_header(current, end);
-    
-    init_format();
-    ScoringMatrix scoring;
-    init_scoring_matrix(&scoring);
+#define PIPELINE_DEPTH (3)
+#define PARSE_CHUNK_ROWS (1024)
 
-    #if MODE_MULTITHREAD == 1
-    Sequence* seqs = (Sequence*)malloc(sizeof(Sequence) * BATCH_SIZE);
-    OtherData* other = (OtherData*)malloc(sizeof(OtherData) * BATCH_SIZE);
-    size_t* seq_lens = (size_t*)malloc(sizeof(size_t) * BATCH_SIZE);
-    size_t seq_count = 1;
+static ColumnOutput g_columns;    // binary pair output
 
-    double start = get_time();
+// Formatted CSV lines of one chunk, kept across batches so it only grows until it fits the largest chunk
+typedef struct {
+    char* data;
+    size_t size;
+    size_t capacity;
+} ChunkOutput;
+
+// rows[0] is the last row of the previous batch parsed again, so the pair spanning the two is not lost
+typedef struct {
+    void* arena;    // rows, tasks and results, allocated once for the whole run
+    size_t arena_size;
+    Data* rows;
+    AlignTask* tasks;
+    Alignment* results;
+    size_t seq_count;
+    size_t first_pair;    // input row of rows[0], also the binary columns row of its pair
+    TaskQueue queue;
+    ChunkOutput out[MAX_CHUNKS];
+} Batch;
+
+#define ARENA_SLICE(bytes) (((bytes) + CACHE_LINE - 1) & ~(size_t)(CACHE_LINE - 1))
 
-    seq_lens[0] = parse_csv_line(&current, seqs[0].data, other[0].data);
-    while (current < end && *current) {
-        while (seq_count < BATCH_SIZE && current < end && *current) {
-            seq_lens[seq_count] = parse_csv_line(&current, seqs[seq_count].data, other[seq_count].data);
-            seq_count++;
+// Only the sequences of a task change between batches, the results stay in place
+INLINE void alloc_batch(Batch* batch, const size_t batch_size, const ScoringMatrix* scoring) {
+    const size_t rows_size = ARENA_SLICE(sizeof(Data) * batch_size);
+    const size_t tasks_size = ARENA_SLICE(sizeof(AlignTask) * batch_size);
+    batch->arena_size = rows_size + tasks_size + sizeof(Alignment) * batch_size;
+    batch->arena = arena_alloc(batch->arena_size);
+    if (!batch->arena) config_error("Cannot allocate the batch buffers, lower BATCH_SIZE", "");
+    touch_pages(batch->arena, batch->arena_size);
+
+    batch->rows = (Data*)batch->arena;
+    batch->tasks = (AlignTask*)((char*)batch->arena + rows_size);
+    batch->results = (Alignment*)((char*)batch->arena + rows_size + tasks_size);
+    batch->seq_count = 0;
+    batch->first_pair = 0;
+    memset(batch->out, 0, sizeof(batch->out));
+
+    for (size_t i = 0; i + 1 < batch_size; i++) {
+        batch->tasks[i] = (AlignTask){
+            .scoring = scoring,
+            .result = &batch->results[i],
+            .score = &batch->results[i].score
+        };
+    }
+}
+
+INLINE void free_batch(Batch* batch) {
+    arena_free(batch->arena, batch->arena_size);
+    for (size_t c = 0; c < MAX_CHUNKS; c++) free(batch->out[c].data);
+}
+
+// Parses rows [lo, hi) of the batch, each row fills in its side of both tasks it is part of
+INLINE void parse_rows(Batch* batch, const RowIndex* rows, const size_t lo, const size_t hi) {
+    const bool alignments = !score_only_mode();
+    for (size_t i = lo; i < hi; i++) {
+        char* line = (char*)rows->base + rows->starts[batch->first_pair + i];
+        Data* row = &batch->rows[i];
+        view_csv_line(&line, row);
+        if (alignments) check_alignable(row);
+        if (i) {
+            batch->tasks[i - 1].seq2 = row->seq;
+            batch->tasks[i - 1].len2 = row->len;
+        }
+        if (i + 1 < batch->seq_count) {
+            batch->tasks[i].seq1 = row->seq;
+            batch->tasks[i].len1 = row->len;
         }
+    }
+}
+
+// Runs on the thread that aligned the chunk while its results are still in cache
+INLINE void format_chunk(Batch* batch, const size_t chunk) {
+    ChunkOutput* out = &batch->out[chunk];
+    out->size = 0;
+    for (size_t i = batch->queue.bounds[chunk]; i < batch->queue.bounds[chunk + 1]; i++) {
+        if (below_threshold(batch->results[i].score)) continue;
 
-        size_t num_pairs = seq_count - 1;
-        AlignTask* tasks = (AlignTask*)malloc(sizeof(AlignTask) * num_pairs);
-        Alignment* results = (Alignment*)malloc(sizeof(Alignment) * num_pairs);
-
-        for (size_t i = 0; i < num_pairs; i++) {
-            tasks[i] = (AlignTask){
-                .seq1 = seqs[i].data,
-                .seq2 = seqs[i + 1].data,
-                .len1 = seq_lens[i],
-                .len2 = seq_lens[i + 1],
-                .scoring = &scoring,
-                .result = &results[i]
-            };
+        const size_t need = output_bound(&batch->rows[i], &batch->rows[i + 1]);
+        if (out->size + need > out->capacity) {
+            out->capacity = 2 * out->capacity + need;
+            out->data = (char*)realloc(out->data, out->capacity);
         }
+        out->size += buffer_output(out->data, out->size, &batch->rows[i], &batch->rows[i + 1], &batch->results[i]);
+    }
+}
 
-        size_t tasks_per_thread = num_pairs / g_num_threads;
-        for (int t = 0; t < g_num_threads; t++) {
-            g_thread_work[t].tasks = tasks;
-            g_thread_work[t].start = t * tasks_per_thread;
-            g_thread_work[t].end = (t == g_num_threads - 1) ? num_pairs : (t + 1) * tasks_per_thread;
-            sem_post(g_thread_work[t].work_ready);
+INLINE void store_chunk(const Batch* batch, const size_t chunk) {
+    for (size_t i = batch->queue.bounds[chunk]; i < batch->queue.bounds[chunk + 1]; i++) {
+        store_columns(&g_columns, batch->first_pair + i, &batch->results[i]);
+    }
+}
+
+INLINE void align_batch_job(ThreadWork* work, void* arg) {
+    Batch* batch = (Batch*)arg;
+    size_t chunk;
+    while (align_next_chunk(work, &batch->queue, &chunk)) {
+        if (!g_config.write) continue;
+        if (g_config.binary) {
+            store_chunk(batch, chunk);
+        } else {
+            format_chunk(batch, chunk);
         }
+    }
+}
 
-        for (int t = 0; t < g_num_threads; t++) sem_wait(g_thread_work[t].work_done);
+typedef struct {
+    const RowIndex* rows;
+    Batch* parsing;
+    Batch* aligning;    // NULL while the first batch is parsed
+    size_t parse_chunks;
+    size_t next_parse;
+} Stage;
 
-        #if MODE_WRITE == 1
-        for (size_t i = 0; i < num_pairs; i++) {
-            if (files.writer.pos >= WRITE_BUF - MAX_CSV_LINE * 2) {
-                flush_buffer(&files.writer);
-            }
+INLINE void plan_parse(Stage* stage, Batch* batch, const size_t first_row) {
+    const size_t left = first_row < stage->rows->count ? stage->rows->count - first_row : 0;
+    batch->first_pair = first_row;
+    const size_t batch_size = g_config.batch_size;
+    batch->seq_count = left < batch_size ? left : batch_size;
+    stage->parsing = batch;
+    stage->parse_chunks = (batch->seq_count + PARSE_CHUNK_ROWS - 1) / PARSE_CHUNK_ROWS;
+    stage->next_parse = 0;
+}
 
-            Data prev = {seqs[i].data, other[i].data, seq_lens[i]};
-            Data curr = {seqs[i + 1].data, other[i + 1].data, seq_lens[i + 1]};
-            files.writer.pos += buffer_output(files.writer.buffer, files.writer.pos, &prev, &curr, &results[i]);
+// Parsing goes first so the next batch is ready by the time the slowest aligning chunk finishes
+INLINE void stage_job(ThreadWork* work, void* arg) {
+    Stage* stage = (Stage*)arg;
+    Batch* batch = stage->parsing;
+    size_t chunk;
+    while ((chunk = __atomic_fetch_add(&stage->next_parse, 1, __ATOMIC_RELAXED)) < stage->parse_chunks) {
+        const size_t lo = chunk * PARSE_CHUNK_ROWS;
+        const size_t hi = lo + PARSE_CHUNK_ROWS < batch->seq_count ? lo + PARSE_CHUNK_ROWS : batch->seq_count;
+        parse_rows(batch, stage->rows, lo, hi);
+    }
+    if (stage->aligning) align_batch_job(work, stage->aligning);
+}
+
+// Chunks are already formatted, only their order is kept here
+INLINE void write_batch(Files* files, const Batch* batch) {
+    if (g_config.binary) {
+        for (size_t i = 0; i + 1 < batch->seq_count; i++) {
+            store_alignment(&g_columns, batch->first_pair + i, &batch->results[i],
+                            batch->rows[i].seq, batch->rows[i + 1].seq);
         }
-        #endif // MODE_WRITE
+        return;
+    }
+    for (size_t c = 0; c < batch->queue.num_chunks; c++) {
+        write_data(&files->writer, batch->out[c].data, batch->out[c].size);
+    }
+}
 
-        // Keep last sequence for next batch
-        strcpy(seqs[0].data, seqs[seq_count - 1].data);
-        strcpy(other[0].data, other[seq_count - 1].data);
-        seq_lens[0] = seq_lens[seq_count - 1];
-        seq_count = 1;
+INLINE void align_multithreaded(Files* files, const RowIndex* rows, const ScoringMatrix* scoring) {
+    const bool score_only = score_only_mode();
+    Batch batches[PIPELINE_DEPTH];
+    for (int b = 0; b < PIPELINE_DEPTH; b++) alloc_batch(&batches[b], g_config.batch_size, scoring);
 
-        free(tasks);
-        free(results);
-    }
+    ThreadWork helper = {0};
+    lanes_init(&helper.lanes);
 
-    free(seqs);
-    free(other);
-    free(seq_lens);
-    destroy_thread_pool();
+    Stage stage = {.rows = rows, .aligning = NULL};
+    Batch* next = &batches[0];
+    plan_parse(&stage, next, 0);
+    start_job(stage_job, &stage);
+    stage_job(&helper, &stage);
+    wait_job();
 
-    #else // MODE_MULTITHREAD == 0
+    Batch* written = NULL;
+    for (size_t k = 1; next->seq_count > 1; k++) {
+        Batch* aligning = next;
+        plan_tasks(&aligning->queue, aligning->tasks, aligning->seq_count - 1, score_only);
 
-    char seq[MAX_SEQ_LEN];
-    char prev_seq[MAX_SEQ_LEN];
-    char data[MAX_CSV_LINE - MAX_SEQ_LEN];
-    char prev_data[MAX_CSV_LINE - MAX_SEQ_LEN];
+        next = &batches[k % PIPELINE_DEPTH];
+        plan_parse(&stage, next, aligning->first_pair + aligning->seq_count - 1);
+        stage.aligning = aligning;
+        start_job(stage_job, &stage);
 
-    double start = get_time();
-    size_t prev_len = parse_csv_line(&current, prev_seq, prev_data);
-    while (current < end && *current) {
-        size_t curr_len = parse_csv_line(&current, seq, data);
-        Alignment result = align_sequences(prev_seq, prev_len, seq, curr_len, &scoring);
-
-        #if MODE_WRITE == 1
-        if (files.writer.pos >= WRITE_BUF - MAX_CSV_LINE * 2) {
-            flush_buffer(&files.writer);
+        if (written && g_config.write) write_batch(files, written);
+
+        stage_job(&helper, &stage);
+        wait_job();
+        written = aligning;
+    }
+    if (written && g_config.write) write_batch(files, written);
+
+    lanes_free(&helper.lanes);
+    free_cache_misses(&helper.misses);
+    for (int b = 0; b < PIPELINE_DEPTH; b++) free_batch(&batches[b]);
+}
+
+INLINE void align_singlethreaded(Files* files, char* current, char* end, const ScoringMatrix* scoring) {
+    const bool score_only = score_only_mode();
+    Data prev, curr;
+    ProfileCache cache;
+    profile_cache_init(&cache);
+
+    view_csv_line(&current, &prev);
+    if (!score_only) check_alignable(&prev);
+    for (size_t row = 0; current < end && *current; row++) {
+        view_csv_line(&current, &curr);
+        if (!score_only) check_alignable(&curr);
+        Alignment result;
+        AlignTask task = {prev.seq, curr.seq, prev.len, curr.len, scoring, &result, &result.score, NULL, NULL};
+        const uint64_t hash = g_results.sets || g_store.out ? pair_hash(&task) : 0;
+        if (!result_cache_get(&g_results, hash, &task)) {
+            const bool stored = result_store_get(&g_store, hash, &task);
+            if (!stored) {
+                align_task(&task, score_only, &cache);
+                result_cache_put(&g_results, hash, &task);
+            }
+            if (g_store.out) {
+                char record[STORE_RECORD_MAX];
+                const size_t size = stored ? 0 : pack_record(&g_store, record, hash, &task);
+                result_store_append(&g_store, record, size, size != 0, 1, stored);
+            }
         }
-        Data prev = {prev_seq, prev_data, prev_len};
-        Data curr = {seq, data, curr_len};
-        files.writer.pos += buffer_output(files.writer.buffer, files.writer.pos, &prev, &curr, &result);
-        #else // MODE_WRITE == 0
-        if (result.score < -1000000000) {
+
+        if (g_config.write && g_config.binary) {
+            if (row >= g_columns.count) break;    // trailing line of spaces, not an indexed row
+            store_columns(&g_columns, row, &result);
+            store_alignment(&g_columns, row, &result, prev.seq, curr.seq);
+        } else if (g_config.write && !below_threshold(result.score)) {
+            const size_t need = output_bound(&prev, &curr);
+            if (LIKELY(reserve_buffer(&files->writer, need))) {
+                files->writer.pos += buffer_output(files->writer.buffer, files->writer.pos, &prev, &curr, &result);
+            } else {
+                char* line = (char*)malloc(need);
+                write_data(&files->writer, line, buffer_output(line, 0, &prev, &curr, &result));
+                free(line);
+            }
+        } else if (!g_config.write && result.score < -1000000000 && result.score != SCORE_DISCARDED) {
             // Will never happen but prevents compiler from removing unused result when not writing
             printf("Unexpected score (-1000000000)!\n");
         }
-        #endif // MODE_WRITE
 
-        strcpy(prev_data, data);
-        strcpy(prev_seq, seq);
-        prev_len = curr_len;
+        prev = curr;
     }
+    profile_cache_free(&cache);
+}
+
+int main(int argc, char** argv) {
+    parse_args(argc, argv);
 
-    #endif // MODE_MULTITHREAD
+    SET_HIGH_CLASS();
+    if (g_config.multithread) {
+        init_thread_pool();
+    } else {
+        PIN_THREAD(0);
+    }
 
-    #if MODE_WRITE == 1
-    flush_buffer(&files.writer);
-    #endif // MODE_WRITE
+    Files files = get_files();
+    char *current, *end;
+
+    if (pair_mode()) init_format();
+    ScoringMatrix scoring;
+    init_scoring_matrix(&scoring);
+    configure_scoring(&scoring);
+    // All-vs-all pairs are all different, only pairs and search rows repeat
+    if (!g_config.all_vs_all) {
+        const bool alignments = pair_mode() && !score_only_mode();
+        open_result_cache(&g_results, g_config.result_cache_mb, alignments);
+        open_result_store(&g_store, g_config.result_store_file, &scoring, alignments);
+    }
+
+    double start = get_time();
+
+    const bool binary = pair_mode() && g_config.write && g_config.binary;
+    if (g_config.all_vs_all) {
+        if (next_input(&files, &current, &end, false)) align_all_vs_all(current, end, &scoring);
+    } else if (g_config.query_file[0]) {
+        search_database(&files, &scoring);
+    } else {
+        // Binary outputs need a mapped input, which is a single part
+        while (next_input(&files, &current, &end, true)) {
+            RowIndex rows = {0};
+            if (g_config.multithread || binary) index_rows(&rows, current, end);
+            if (binary) open_columns(&g_columns, rows.count ? rows.count - 1 : 0);
+            if (g_config.multithread) {
+                align_multithreaded(&files, &rows, &scoring);
+            } else {
+                align_singlethreaded(&files, current, end, &scoring);
+            }
+            free_row_index(&rows);
+        }
+    }
+    if (g_config.multithread) destroy_thread_pool();
+
+    if (csv_output()) close_writer(&files.writer);
+    if (binary) close_columns(&g_columns);
 
     double endt = get_time();
 
     free_files(&files);
-    
+
     printf("Alignment time: %f seconds\n", endt - start);
+    close_result_cache(&g_results);
+    close_result_store(&g_store);
     return 0;
-}
\ No newline at end of file
+}
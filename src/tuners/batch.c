@@ -17,67 +17,54 @@ INLINE BatchTiming measure_batch_performance(char* start, char* end, size_t batc
     size_t rows_processed = 0;
     size_t seq_count = 1;
     
-    Sequence* seqs = (Sequence*)malloc(sizeof(Sequence) * batch_size);
-    OtherData* other = (OtherData*)malloc(sizeof(OtherData) * batch_size);
-    size_t* seq_lens = (size_t*)malloc(sizeof(size_t) * batch_size);
+    // Same buffers as the batches of bin/main, faulted in before the clock starts
+    const size_t rows_size = sizeof(Data) * batch_size;
+    const size_t tasks_size = sizeof(AlignTask) * batch_size;
+    const size_t arena_size = rows_size + tasks_size + sizeof(Alignment) * batch_size;
+    char* arena = (char*)arena_alloc(arena_size);
+    touch_pages(arena, arena_size);
+    Data* rows = (Data*)arena;
+    AlignTask* tasks = (AlignTask*)(arena + rows_size);
+    Alignment* results = (Alignment*)(arena + rows_size + tasks_size);
     
     double start_time = get_time();
     
-    seq_lens[0] = parse_csv_line(&current, seqs[0].data, other[0].data);
+    view_csv_line(&current, &rows[0]);
     rows_processed++;
     while (current < end && rows_processed < TUNING_ROWS) {
         while (seq_count < batch_size && current < end && rows_processed < TUNING_ROWS) {
-            seq_lens[seq_count] = parse_csv_line(&current, seqs[seq_count].data, other[seq_count].data);
-            seq_count++;
+            view_csv_line(&current, &rows[seq_count++]);
             rows_processed++;
         }
 
         size_t num_pairs = seq_count - 1;
-        AlignTask* tasks = malloc(sizeof(AlignTask) * num_pairs);
-        Alignment* results = malloc(sizeof(Alignment) * num_pairs);
-
         for (size_t i = 0; i < num_pairs; i++) {
             tasks[i] = (AlignTask){
-                .seq1 = seqs[i].data,
-                .seq2 = seqs[i + 1].data,
-                .len1 = seq_lens[i],
-                .len2 = seq_lens[i + 1],
+                .seq1 = rows[i].seq,
+                .seq2 = rows[i + 1].seq,
+                .len1 = rows[i].len,
+                .len2 = rows[i + 1].len,
                 .scoring = scoring,
-                .result = &results[i]
+                .result = &results[i],
+                .score = &results[i].score
             };
         }
 
-        size_t tasks_per_thread = num_pairs / g_num_threads;
-        for (int t = 0; t < g_num_threads; t++) {
-            g_thread_work[t].tasks = tasks;
-            g_thread_work[t].start = t * tasks_per_thread;
-            g_thread_work[t].end = (t == g_num_threads - 1) ? num_pairs : (t + 1) * tasks_per_thread;
-            sem_post(g_thread_work[t].work_ready);
-        }
+        run_tasks(tasks, num_pairs, true);
 
-        for (int t = 0; t < g_num_threads; t++) {
-            sem_wait(g_thread_work[t].work_done);
-        }
-
-        strcpy(seqs[0].data, seqs[seq_count - 1].data);
-        strcpy(other[0].data, other[seq_count - 1].data);
-        seq_lens[0] = seq_lens[seq_count - 1];
+        rows[0] = rows[seq_count - 1];
         seq_count = 1;
-
-        free(tasks);
-        free(results);
     }
     
     double time_taken = get_time() - start_time;
 
-    free(seq_lens);
-    free(other);
-    free(seqs);
+    arena_free(arena, arena_size);
     
     return (BatchTiming){batch_size, time_taken};
 }
 
-int main(void) {
+int main(int argc, char** argv) {
+    parse_args(argc, argv);
     SET_HIGH_CLASS();
 
     Files files = get_files();
@@ -88,6 +75,7 @@ int main(void) {
     init_format();
     ScoringMatrix scoring;
     init_scoring_matrix(&scoring);
+    configure_scoring(&scoring);
     init_thread_pool();
 
     printf("\nTesting batch sizes from %d to %d\n", MIN_BATCH_SIZE, MAX_BATCH_SIZE);